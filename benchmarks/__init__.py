@@ -0,0 +1,17 @@
+"""
+benchmarks
+~~~~~~~~~~
+
+Microbenchmarks for Gargoyle's evaluation and admin hot paths, run against
+an in-memory SQLite database and the locmem cache. Each module can be run on
+its own from the repository root::
+
+    python -m benchmarks.compiled
+
+or all of them, writing the results as JSON (see ``benchmarks.__main__``)::
+
+    python -m benchmarks --output=results.json
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
@@ -0,0 +1,127 @@
+"""
+benchmarks.__main__
+~~~~~~~~~~~~~~~~~~~
+
+Runs every benchmark (or those named on the command line), each in its own
+process, and writes the results as JSON so that runs can be compared across
+commits::
+
+    python -m benchmarks --output=before.json
+    python -m benchmarks --output=after.json --compare=before.json
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+from benchmarks.utils import RESULTS_ENV
+
+BENCHMARKS = ('fastpath', 'compiled', 'switches', 'bulk', 'templates', 'nexus_index', 'cohorts')
+
+
+def get_commit():
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    commit = process.communicate()[0].strip()
+    if process.returncode:
+        return None
+    return commit
+
+
+def run(names):
+    """
+    Runs the benchmark modules ``names``, returning the list of results
+    they report.
+    """
+    results = []
+    for name in names:
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            env = dict(os.environ)
+            env[RESULTS_ENV] = path
+            returncode = subprocess.call([sys.executable, '-m', 'benchmarks.%s' % name], env=env)
+            if returncode:
+                raise SystemExit('benchmarks.%s failed' % name)
+
+            fp = open(path)
+            try:
+                for line in fp:
+                    result = json.loads(line)
+                    result['benchmark'] = name
+                    results.append(result)
+            finally:
+                fp.close()
+        finally:
+            os.unlink(path)
+    return results
+
+
+def compare(previous, results):
+    """
+    Prints the change in each result which is also in the ``previous`` run.
+    """
+    before = dict(((r.get('benchmark'), r['group'], r['label']), r['usec']) for r in previous['results'])
+    print
+    print 'compared with %s' % (previous.get('commit') or 'previous run')
+    for result in results:
+        usec = before.get((result['benchmark'], result['group'], result['label']))
+        if not usec:
+            continue
+        print '    %-60s %10.2f -> %10.2f usec/call (%+.1f%%)' % (
+            '%s: %s' % (result['group'], result['label']), usec, result['usec'],
+            (result['usec'] - usec) / usec * 100)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('--output', default='benchmark-results.json',
+                      help='Write the results to this file (default: %default).')
+    parser.add_option('--compare', default=None,
+                      help='Compare the results with those of a previous run.')
+    options, names = parser.parse_args()
+
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark %r (choose from %s).' % (name, ', '.join(BENCHMARKS)))
+
+    import django
+
+    results = run(names or BENCHMARKS)
+    run_info = {
+        'commit': get_commit(),
+        'timestamp': int(time.time()),
+        'python': sys.version.split()[0],
+        'django': django.get_version(),
+        'results': results,
+    }
+
+    fp = open(options.output, 'w')
+    try:
+        json.dump(run_info, fp, indent=2, sort_keys=True)
+    finally:
+        fp.close()
+    print
+    print 'results written to %s' % options.output
+
+    if options.compare:
+        fp = open(options.compare)
+        try:
+            previous = json.load(fp)
+        finally:
+            fp.close()
+        compare(previous, results)
+
+
+if __name__ == '__main__':
+    main()
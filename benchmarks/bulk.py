@@ -0,0 +1,56 @@
+"""
+benchmarks.bulk
+~~~~~~~~~~~~~~~
+
+Compares ``SwitchManager.is_active_many`` with calling ``is_active`` in a
+loop, for a page checking a few hundred switches against one request.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from benchmarks.utils import setup, manager, bench, report
+
+
+def main():
+    setup()
+
+    from django.contrib.auth.models import User
+    from gargoyle.builtins import UserConditionSet, IPAddressConditionSet
+    from gargoyle.models import Switch, GLOBAL, DISABLED, SELECTIVE, INHERIT
+
+    gargoyle = manager(UserConditionSet(User), IPAddressConditionSet())
+
+    keys = []
+    for i in xrange(50):
+        Switch.objects.create(key='global%d' % i, status=GLOBAL)
+        Switch.objects.create(key='disabled%d' % i, status=DISABLED)
+        Switch.objects.create(key='global%d:child' % i, status=INHERIT)
+        Switch.objects.create(key='selective%d' % i, status=SELECTIVE, value={
+            'auth.user': {
+                'percent': [['i', '0-%d' % (i * 2)]],
+                'is_staff': [['i', '1']],
+            },
+            'ip': {
+                'ip_address': [['i', '10.0.0.%d' % i]],
+            },
+        })
+        keys.extend(['global%d' % i, 'disabled%d' % i, 'global%d:child' % i, 'selective%d' % i])
+
+    request = gargoyle.as_request(user=User(pk=8771, username='nobody'), ip_address='192.168.1.1')
+
+    expected = dict((key, gargoyle.is_active(key, request)) for key in keys)
+    assert gargoyle.is_active_many(keys, request) == expected
+
+    def loop():
+        for key in keys:
+            gargoyle.is_active(key, request)
+
+    report('%d switches, one request' % len(keys), [
+        ('is_active loop', bench(loop, number=200)),
+        ('is_active_many', bench(lambda: gargoyle.is_active_many(keys, request), number=200)),
+    ])
+
+
+if __name__ == '__main__':
+    main()
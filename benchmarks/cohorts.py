@@ -0,0 +1,64 @@
+"""
+benchmarks.cohorts
+~~~~~~~~~~~~~~~~~~
+
+Compares ``SwitchManager.percent_mask`` with calling ``is_active`` for a
+``User`` per id, over 10 million ids. Timings are per id.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from array import array
+
+from benchmarks.utils import setup, manager, bench, report
+
+COUNT = 10000000
+SAMPLE = 100000
+
+
+def main():
+    setup()
+
+    from django.contrib.auth.models import User
+    from gargoyle.builtins import UserConditionSet
+    from gargoyle.cohorts import numpy
+    from gargoyle.models import Switch, SELECTIVE
+
+    gargoyle = manager(UserConditionSet(User))
+    condition_set = UserConditionSet(User).get_id()
+
+    Switch.objects.create(key='cohort', status=SELECTIVE, value={
+        'auth.user': {
+            'percent': [['i', '0-30'], ['i', '60-75'], ['e', '20-25']],
+        },
+    })
+
+    ids = array('l', xrange(COUNT))
+    mask = gargoyle.percent_mask('cohort', ids, condition_set)
+    for pk in xrange(0, COUNT, COUNT / 1000):
+        assert bool(mask[pk]) == gargoyle.is_active('cohort', User(pk=pk))
+
+    sample = [User(pk=pk) for pk in xrange(SAMPLE)]
+
+    def loop():
+        for user in sample:
+            gargoyle.is_active('cohort', user)
+
+    results = [
+        ('is_active per User (%d sampled)' % SAMPLE, bench(loop, number=1) / SAMPLE),
+        ('percent_mask, array', bench(lambda: gargoyle.percent_mask('cohort', ids, condition_set),
+                                      number=1) / COUNT),
+    ]
+
+    if numpy is not None:
+        ids = numpy.arange(COUNT, dtype=numpy.int64)
+        assert list(gargoyle.percent_mask('cohort', ids, condition_set)) == map(bool, mask)
+        results.append(('percent_mask, numpy', bench(lambda: gargoyle.percent_mask('cohort', ids, condition_set),
+                                                     number=1) / COUNT))
+
+    report('%d ids, per id' % COUNT, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+benchmarks.compiled
+~~~~~~~~~~~~~~~~~~~
+
+Compares evaluating a selective switch through its compiled conditions with
+walking the raw ``Switch.value`` on every check.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import itertools
+
+from benchmarks.utils import setup, manager, bench, report
+
+
+def raw_is_active(registry, conditions, instances):
+    """
+    The uncompiled evaluation: every check walks the raw conditions and
+    hands the unparsed condition strings to ``Field.is_active``.
+    """
+    from gargoyle.models import EXCLUDE
+
+    return_value = False
+    for condition_set in registry:
+        set_value = None
+        for instance in itertools.chain(instances, [None]):
+            if not condition_set.can_execute(instance):
+                continue
+            result = None
+            for name, field in condition_set.fields.iteritems():
+                field_conditions = conditions.get(condition_set.get_namespace(), {}).get(name)
+                if field_conditions:
+                    value = condition_set.get_field_value(instance, name)
+                    for status, condition in field_conditions:
+                        if field.is_active(condition, value):
+                            if status == EXCLUDE:
+                                return False
+                            result = True
+            if result is True:
+                set_value = True
+        if set_value is True:
+            return_value = True
+    return return_value
+
+
+def main():
+    setup()
+
+    from django.contrib.auth.models import User
+    from gargoyle.builtins import UserConditionSet, IPAddressConditionSet, HostConditionSet
+    from gargoyle.models import Switch, SELECTIVE
+
+    gargoyle = manager(UserConditionSet(User), IPAddressConditionSet(), HostConditionSet())
+
+    Switch.objects.create(key='selective', status=SELECTIVE, value={
+        'auth.user': {
+            'percent': [['i', '0-50'], ['e', '90-99']],
+            'username': [['i', 'user%d' % i] for i in xrange(20)],
+            'is_staff': [['i', '1']],
+        },
+    })
+
+    switch = gargoyle['selective']
+    user = User(pk=8771, username='nobody')
+    instances = [user]
+    registry = list(gargoyle.get_condition_sets())
+
+    assert raw_is_active(registry, switch.value, instances) == gargoyle.is_active('selective', user)
+
+    def compiled():
+        for c in gargoyle.compile(switch):
+            c.has_active_condition(instances)
+
+    report('selective switch, user conditions', [
+        ('raw conditions', bench(lambda: raw_is_active(registry, switch.value, instances))),
+        ('compiled conditions', bench(compiled)),
+        ('SwitchManager.is_active', bench(lambda: gargoyle.is_active('selective', user))),
+    ])
+
+
+if __name__ == '__main__':
+    main()
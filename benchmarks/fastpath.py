@@ -0,0 +1,95 @@
+"""
+benchmarks.fastpath
+~~~~~~~~~~~~~~~~~~~
+
+Measures the time per ``is_active`` call for switches whose result doesn't
+depend on the instances (global, disabled, and their children), compared with
+a selective switch, along with how many of those calls went through a full
+evaluation and how many objects each call leaves behind.
+
+Python 2 can't trace every allocation (``tracemalloc`` only exists on Python
+3), so short-lived allocations are not measured; only the objects tracked by
+the garbage collector which are still alive after the calls are counted.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import gc
+
+from benchmarks.utils import setup, manager, bench, report
+
+
+def retained(func, number=1000):
+    """
+    Returns the number of objects tracked by the garbage collector which are
+    still alive after calling ``func``, per call.
+    """
+    func()
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        for _ in xrange(number):
+            func()
+        after = len(gc.get_objects())
+    finally:
+        gc.enable()
+    return float(after - before) / number
+
+
+def evaluated(gargoyle, func, number=1000):
+    """
+    Returns the share of calls to ``func`` which went through a full
+    evaluation, rather than the fast path.
+    """
+    calls = []
+    evaluate = gargoyle._evaluate
+
+    def counting(key, evaluation):
+        calls.append(key)
+        return evaluate(key, evaluation)
+
+    gargoyle._evaluate = counting
+    try:
+        for _ in xrange(number):
+            func()
+    finally:
+        del gargoyle._evaluate
+    return float(len(calls)) / number
+
+
+def main():
+    setup()
+
+    from django.contrib.auth.models import User
+    from gargoyle.builtins import UserConditionSet
+    from gargoyle.models import Switch, GLOBAL, DISABLED, SELECTIVE, INHERIT
+
+    gargoyle = manager(UserConditionSet(User))
+
+    Switch.objects.create(key='global', status=GLOBAL)
+    Switch.objects.create(key='disabled', status=DISABLED)
+    Switch.objects.create(key='global:a:b', status=INHERIT)
+    Switch.objects.create(key='disabled:a:b', status=GLOBAL)
+    Switch.objects.create(key='selective', status=SELECTIVE, value={
+        'auth.user': {'percent': [['i', '0-50']]},
+    })
+
+    user = User(pk=8771)
+
+    results = []
+    counts = []
+    for key in ('global', 'disabled', 'global:a:b', 'disabled:a:b', 'selective'):
+        func = lambda: gargoyle.is_active(key, user)
+        results.append((key, bench(func, number=50000)))
+        counts.append((key, evaluated(gargoyle, func), retained(func)))
+
+    report('is_active', results)
+
+    print 'per call (short-lived allocations are not measured on Python 2)'
+    for key, evaluations, objects in counts:
+        print '    %-40s %6.2f evaluations %6.2f objects retained' % (key, evaluations, objects)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+benchmarks.nexus_index
+~~~~~~~~~~~~~~~~~~~~~~
+
+Measures the Nexus index view listing 5,000 switches.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from benchmarks.utils import setup, bench, report
+
+SWITCHES = 5000
+
+
+def main():
+    setup()
+
+    from django.contrib.auth.models import User
+    from django.core.urlresolvers import resolve
+    from django.test.client import RequestFactory
+    from gargoyle.models import Switch, GLOBAL, DISABLED, SELECTIVE
+
+    switches = []
+    for i in xrange(SWITCHES):
+        if i % 3 == 0:
+            switches.append(Switch(key='switch%d' % i, status=SELECTIVE, value={
+                'auth.user': {
+                    'percent': [['i', '0-50']],
+                    'username': [['i', 'user%d' % j] for j in xrange(5)],
+                },
+                'ip': {'ip_address': [['i', '10.0.0.0/8']]},
+            }))
+        else:
+            switches.append(Switch(key='switch%d' % i, status=(GLOBAL, DISABLED)[i % 3 - 1]))
+    Switch.objects.bulk_create(switches)
+
+    user = User.objects.create(username='admin', is_staff=True, is_superuser=True)
+    request = RequestFactory().get('/nexus/gargoyle/')
+    request.user = user
+    view = resolve('/nexus/gargoyle/').func
+
+    response = view(request)
+    assert response.status_code == 200, response.status_code
+    assert 'switch%d' % (SWITCHES - 1) in response.content
+
+    report('nexus index, %d switches' % SWITCHES, [
+        ('index', bench(lambda: view(request), number=1)),
+    ])
+
+
+if __name__ == '__main__':
+    main()
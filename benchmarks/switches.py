@@ -0,0 +1,143 @@
+"""
+benchmarks.switches
+~~~~~~~~~~~~~~~~~~~
+
+Measures ``SwitchManager.is_active``, ``ConditionSet.is_active`` and
+``Switch.to_dict`` for global, disabled and selective switches, nested keys,
+large include lists, membership lists, several instances and many registered
+condition sets, and how long other processes take to pick up a change.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from benchmarks.utils import setup, manager, bench, report
+
+LIST_SIZE = 5000
+CONDITION_SETS = 100
+INSTANCES = 5
+BETA_SIZE = 20000
+SWITCHES = 2000
+
+
+def main():
+    setup()
+
+    from django.contrib.auth.models import User
+    from gargoyle.builtins import UserConditionSet, IPAddressConditionSet, HostConditionSet
+    from gargoyle.conditions import ModelConditionSet, String
+    from gargoyle.manager import SwitchManager
+    from gargoyle.models import Switch, GLOBAL, DISABLED, SELECTIVE, INHERIT
+
+    gargoyle = manager(UserConditionSet(User), IPAddressConditionSet(), HostConditionSet())
+
+    Switch.objects.create(key='global', status=GLOBAL)
+    Switch.objects.create(key='disabled', status=DISABLED)
+    Switch.objects.create(key='selective', status=SELECTIVE, value={
+        'auth.user': {
+            'percent': [['i', '0-50'], ['e', '90-99']],
+            'username': [['i', 'user%d' % i] for i in xrange(20)],
+            'is_staff': [['i', '1']],
+        },
+    })
+    Switch.objects.create(key='global:a:b:c', status=INHERIT)
+    Switch.objects.create(key='selective:a', status=INHERIT)
+    Switch.objects.create(key='selective:a:b', status=SELECTIVE, value={
+        'auth.user': {'percent': [['i', '0-75']]},
+    })
+    Switch.objects.create(key='selective:a:b:c', status=INHERIT)
+    Switch.objects.create(key='usernames', status=SELECTIVE, value={
+        'auth.user': {'username': [['i', 'user%d' % i] for i in xrange(LIST_SIZE)]},
+    })
+    Switch.objects.create(key='ip_addresses', status=SELECTIVE, value={
+        'ip': {'ip_address': [['i', '10.%d.%d.1' % (i // 256, i % 256)] for i in xrange(LIST_SIZE)]},
+    })
+
+    user = User(pk=8771, username='user%d' % (LIST_SIZE - 1))
+    request = gargoyle.as_request(user=user, ip_address='10.0.0.1')
+
+    report('SwitchManager.is_active', [
+        (key, bench(lambda: gargoyle.is_active(key, request), number=number))
+        for key, number in (('global', 10000), ('disabled', 10000), ('selective', 10000),
+                            ('global:a:b:c', 10000), ('selective:a:b:c', 10000), ('missing:a:b', 10000),
+                            ('usernames', 100), ('ip_addresses', 100))
+    ])
+
+    # Several model instances passed to each check, as views often do
+    instances = (request, user) + tuple([Switch(key='instance%d' % i) for i in xrange(INSTANCES - 2)])
+    report('SwitchManager.is_active, %d instances' % INSTANCES, [
+        (key, bench(lambda: gargoyle.is_active(key, *instances), number=10000))
+        for key in ('selective', 'selective:a:b:c')
+    ])
+
+    # A private beta, as conditions and as a membership list
+    usernames = ['beta%d' % i for i in xrange(BETA_SIZE)]
+    Switch.objects.create(key='beta_conditions', status=SELECTIVE, value={
+        'auth.user': {'username': [['i', username] for username in usernames]},
+    })
+    Switch.objects.create(key='beta_members', status=SELECTIVE)
+    gargoyle['beta_members'].add_members(UserConditionSet(User).get_id(), 'username', usernames)
+    member = User(pk=1, username='beta%d' % (BETA_SIZE - 1))
+    other = User(pk=1, username='other')
+
+    report('%d-username private beta' % BETA_SIZE, [
+        ('is_active, conditions', bench(lambda: gargoyle.is_active('beta_conditions', member))),
+        ('is_active, members (member)', bench(lambda: gargoyle.is_active('beta_members', member))),
+        ('is_active, members (non-member)', bench(lambda: gargoyle.is_active('beta_members', other))),
+        ('load switch, conditions', bench(lambda: Switch.objects.get(key='beta_conditions'), number=100)),
+        ('load switch, members', bench(lambda: Switch.objects.get(key='beta_members'), number=100)),
+    ])
+
+    condition_set = UserConditionSet(User)
+    report('ConditionSet.is_active', [
+        (key, bench(lambda: condition_set.is_active(user, gargoyle[key].value), number=number))
+        for key, number in (('selective', 1000), ('usernames', 10))
+    ])
+
+    report('Switch.to_dict', [
+        (key, bench(lambda: gargoyle[key].to_dict(gargoyle), number=number))
+        for key, number in (('global', 1000), ('selective', 1000), ('usernames', 10), ('ip_addresses', 10))
+    ])
+
+    # Many registered condition sets, of which a switch uses a single one
+    condition_sets = []
+    for i in xrange(CONDITION_SETS):
+        condition_sets.append(type('ConditionSet%d' % i, (ModelConditionSet,), {
+            'name': String(),
+            'get_namespace': lambda self, i=i: 'namespace%d' % i,
+        })(User))
+    many = manager(UserConditionSet(User), *condition_sets)
+
+    report('%d registered condition sets' % (CONDITION_SETS + 1), [
+        (key, bench(lambda: many.is_active(key, user), number=number))
+        for key, number in (('global', 10000), ('selective', 10000), ('usernames', 100))
+    ])
+
+    # Another process picking up a change to one of many switches, from the
+    # change log and by fetching every switch from the shared cache
+    from django.db.models.signals import post_save, post_delete
+
+    Switch.objects.bulk_create([Switch(key='switch%d' % i, status=GLOBAL) for i in xrange(SWITCHES)])
+    reader = manager(UserConditionSet(User))
+    post_save.disconnect(reader._post_save, sender=Switch)
+    post_delete.disconnect(reader._post_delete, sender=Switch)
+    reader._populate(reset=True)
+    switches, version = reader._cache, reader._version
+    Switch.objects.get(key='switch0').save()
+
+    def refresh(max_changes):
+        def func():
+            reader._cache, reader._version = switches, version
+            reader.max_changes = max_changes
+            reader._cleanup()
+            reader._populate()
+        return func
+
+    report('refresh after a change, %d switches' % len(switches), [
+        ('change log', bench(refresh(SwitchManager.max_changes), number=100)),
+        ('fetch every switch', bench(refresh(0), number=100)),
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+benchmarks.templates
+~~~~~~~~~~~~~~~~~~~~
+
+Measures rendering a template with a few hundred ``ifswitch`` blocks against
+one request, as a page rendering many feature flags would.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from benchmarks.utils import setup, bench, report
+
+SWITCHES = 50
+
+
+def main():
+    setup()
+
+    from django.contrib.auth.models import User
+    from django.template import Context, Template
+    from gargoyle import gargoyle
+    from gargoyle.models import Switch, GLOBAL, DISABLED, SELECTIVE, INHERIT
+
+    keys = []
+    for i in xrange(SWITCHES):
+        Switch.objects.create(key='global%d' % i, status=GLOBAL)
+        Switch.objects.create(key='disabled%d' % i, status=DISABLED)
+        Switch.objects.create(key='global%d:child' % i, status=INHERIT)
+        Switch.objects.create(key='selective%d' % i, status=SELECTIVE, value={
+            'auth.user': {
+                'percent': [['i', '0-%d' % (i * 2)]],
+                'is_staff': [['i', '1']],
+            },
+        })
+        keys.extend(['global%d' % i, 'disabled%d' % i, 'global%d:child' % i, 'selective%d' % i])
+
+    template = Template('{% load gargoyle_tags %}' + ''.join([
+        '{%% ifswitch "%s" %%}on{%% else %%}off{%% endifswitch %%}' % key for key in keys
+    ]) + ''.join([
+        '{%% ifswitch "%s" user %%}on{%% endifswitch %%}' % key for key in keys
+    ]))
+
+    user = User(pk=8771, username='nobody')
+    request = gargoyle.as_request(user=user, ip_address='192.168.1.1')
+    context = Context({'request': request, 'user': user})
+
+    report('template with %d ifswitch tags' % (len(keys) * 2), [
+        ('render', bench(lambda: template.render(context), number=100)),
+    ])
+
+
+if __name__ == '__main__':
+    main()
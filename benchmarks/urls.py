@@ -0,0 +1,17 @@
+"""
+benchmarks.urls
+~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from django.conf.urls.defaults import *
+
+import nexus
+
+nexus.autodiscover()
+
+urlpatterns = patterns('',
+    url(r'^nexus/', include(nexus.site.urls)),
+)
@@ -0,0 +1,98 @@
+"""
+benchmarks.utils
+~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import json
+import os
+import time
+
+from django.conf import settings
+
+#: If set, each result reported is also appended to this file as a line of
+#: JSON. ``python -m benchmarks`` uses it to collect the results of a run.
+RESULTS_ENV = 'GARGOYLE_BENCHMARK_RESULTS'
+
+
+def setup():
+    """
+    Configures Django against an in-memory SQLite database and the locmem
+    cache, and creates the tables needed by Gargoyle.
+    """
+    if not settings.configured:
+        settings.configure(
+            DATABASES={
+                'default': {
+                    'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': ':memory:',
+                },
+            },
+            CACHES={
+                'default': {
+                    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                },
+            },
+            INSTALLED_APPS=[
+                'django.contrib.auth',
+                'django.contrib.contenttypes',
+                'django.contrib.sessions',
+                'nexus',
+                'gargoyle',
+            ],
+            ROOT_URLCONF='benchmarks.urls',
+            DEBUG=False,
+        )
+
+    from django.core.management import call_command
+    call_command('syncdb', interactive=False, verbosity=0)
+
+
+def manager(*condition_sets):
+    """
+    Returns a fresh ``SwitchManager`` with ``condition_sets`` registered.
+    """
+    from gargoyle.manager import SwitchManager
+    from gargoyle.models import Switch
+
+    gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+    for condition_set in condition_sets:
+        gargoyle.register(condition_set)
+    return gargoyle
+
+
+def bench(func, number=10000, repeat=3):
+    """
+    Calls ``func`` ``number`` times, ``repeat`` times over, and returns the
+    best time per call in microseconds.
+    """
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for _ in xrange(number):
+            func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / number * 1e6
+
+
+def report(name, results):
+    """
+    Prints ``results``, a list of ``(label, microseconds)`` pairs, and records
+    them if ``RESULTS_ENV`` is set.
+    """
+    print name
+    for label, usec in results:
+        print '    %-40s %10.2f usec/call' % (label, usec)
+
+    path = os.environ.get(RESULTS_ENV)
+    if path:
+        fp = open(path, 'a')
+        try:
+            for label, usec in results:
+                fp.write(json.dumps({'group': name, 'label': label, 'usec': usec}) + '\n')
+        finally:
+            fp.close()
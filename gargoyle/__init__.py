@@ -37,6 +37,7 @@ def autodiscover():
             # this import will have to reoccur on the next request and this
             # could raise NotRegistered and AlreadyRegistered exceptions
             gargoyle._registry = before_import_registry
+            gargoyle._index_condition_sets()
 
     # load builtins
     __import__('gargoyle.builtins')
@@ -0,0 +1,156 @@
+"""
+gargoyle.audience
+~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+# Queries are ``Q`` objects, or ``True`` and ``False`` for every and no row.
+
+
+def query_and(a, b):
+    if a is False or b is False:
+        return False
+    elif a is True:
+        return b
+    elif b is True:
+        return a
+    return a & b
+
+
+def query_or(a, b):
+    if a is True or b is True:
+        return True
+    elif a is False:
+        return b
+    elif b is False:
+        return a
+    return a | b
+
+
+def query_not(a):
+    if a is True:
+        return False
+    elif a is False:
+        return True
+    return ~a
+
+
+def query_any(queries):
+    result = False
+    for query in queries:
+        result = query_or(result, query)
+    return result
+
+
+class Audience(object):
+    """
+    The objects of a queryset for which a switch is active, as returned by
+    ``SwitchManager.audience``.
+
+    When every condition which applies could be translated into a query
+    (``exact`` is ``True``), ``queryset`` selects exactly those objects.
+    Otherwise ``queryset`` is the whole queryset, and iterating or counting
+    the audience checks each object with ``is_active``, ``chunk_size`` rows
+    at a time, or across worker processes (see ``gargoyle.parallel``).
+    """
+    def __init__(self, manager, key, queryset, query):
+        self.manager = manager
+        self.key = key
+        self.base_queryset = queryset
+        self.query = query
+
+    def __iter__(self):
+        return self.iterator()
+
+    @property
+    def exact(self):
+        return self.query is not None
+
+    @property
+    def queryset(self):
+        if self.query is True or self.query is None:
+            return self.base_queryset.all()
+        elif self.query is False:
+            return self.base_queryset.none()
+        return self.base_queryset.filter(self.query)
+
+    def iterator(self, chunk_size=1000):
+        if self.exact:
+            return self.queryset.iterator()
+        return self.filter(chunk_size)
+
+    def filter(self, chunk_size=1000):
+        """
+        Yields the objects for which the switch is active, loading them
+        ``chunk_size`` at a time in primary key order.
+        """
+        queryset = self.base_queryset.order_by('pk')
+        last_pk = None
+        while True:
+            if last_pk is None:
+                chunk = list(queryset[:chunk_size])
+            else:
+                chunk = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            for obj in chunk:
+                if self.manager.is_active(self.key, obj):
+                    yield obj
+            last_pk = chunk[-1].pk
+
+    def count(self, processes=None, chunks=None):
+        """
+        Returns the size of the audience. If it isn't ``exact`` and
+        ``processes`` is given, objects are checked by that many worker
+        processes, over ``chunks`` ranges of primary keys.
+        """
+        if self.exact:
+            return self.queryset.count()
+        elif processes:
+            from gargoyle.parallel import evaluate
+            return evaluate(self, processes, chunks)
+
+        count = 0
+        for obj in self.filter():
+            count += 1
+        return count
+
+    def write_ids(self, path, processes=None, chunks=None):
+        """
+        Writes the primary keys of the audience to ``path``, one per line and
+        in order, and returns how many were written. ``processes`` and
+        ``chunks`` are as for ``count``.
+        """
+        if processes and not self.exact:
+            from gargoyle.parallel import evaluate
+            return evaluate(self, processes, chunks, path)
+
+        if self.exact:
+            pks = self.queryset.order_by('pk').values_list('pk', flat=True).iterator()
+        else:
+            pks = (obj.pk for obj in self.filter())
+
+        count = 0
+        fp = open(path, 'w')
+        try:
+            for pk in pks:
+                fp.write('%s\n' % (pk,))
+                count += 1
+        finally:
+            fp.close()
+        return count
+
+    def estimate(self, sample_size=1000, window=100):
+        """
+        Returns an ``(estimate, sampled, matched)`` tuple estimating the size
+        of the audience from a sample of about ``sample_size`` objects, read
+        ``window`` at a time, or its exact size if the audience is ``exact``.
+        """
+        if self.exact:
+            count = self.queryset.count()
+            return count, count, count
+
+        from gargoyle.parallel import estimate
+        return estimate(self, sample_size, window)
@@ -8,14 +8,30 @@ gargoyle.builtins
 
 from gargoyle import gargoyle
 from gargoyle.conditions import ModelConditionSet, RequestConditionSet, Percent, String, Boolean, \
-    ConditionSet, OnOrAfterDate
+    ConditionSet, OnOrAfterDate, CompiledField, ValidationError
+from gargoyle.models import EXCLUDE
+from gargoyle.networks import parse_address, parse_network, format_network, NetworkSet
 
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, User
-from django.core.validators import validate_ipv4_address
 
+import os
 import socket
 
+_hostname = (None, None)
+
+
+def get_hostname():
+    """
+    Returns the hostname of the current process, which is only looked up
+    once per process (and again after a fork).
+    """
+    global _hostname
+    pid = os.getpid()
+    if _hostname[0] != pid:
+        _hostname = (pid, socket.gethostname())
+    return _hostname[1]
+
 
 class UserConditionSet(ModelConditionSet):
     username = String()
@@ -26,19 +42,27 @@ class UserConditionSet(ModelConditionSet):
     is_superuser = Boolean(label='Superuser')
     date_joined = OnOrAfterDate(label='Joined on or after')
 
+    dispatches_by_type = True
+
     def can_execute(self, instance):
         return isinstance(instance, (User, AnonymousUser))
 
-    def is_active(self, instance, conditions):
+    def get_field_query(self, field_name, field, condition):
+        if field_name == 'is_anonymous':
+            # is_anonymous() is never true for a saved User
+            return False
+        return super(UserConditionSet, self).get_field_query(field_name, field, condition)
+
+    def is_active_compiled(self, instance, compiled, field_values=None):
         """
         value is the current value of the switch
         instance is the instance of our type
         """
         if isinstance(instance, User):
-            return super(UserConditionSet, self).is_active(instance, conditions)
+            return super(UserConditionSet, self).is_active_compiled(instance, compiled, field_values)
 
         # HACK: allow is_authenticated to work on AnonymousUser
-        condition = conditions.get(self.get_namespace(), {}).get('is_anonymous')
+        condition = compiled.namespace_conditions.get('is_anonymous')
         if condition is not None:
             return bool(condition)
         return None
@@ -47,9 +71,107 @@ gargoyle.register(UserConditionSet(User))
 
 
 class IPAddress(String):
+    default_help_text = 'Enter an IP address, or a network in CIDR notation (e.g. 10.0.0.0/8)'
+
+    def is_active(self, condition, value):
+        """
+        ``value`` is either an address as returned by ``parse_address``, or a
+        string which is compared with ``condition`` as is.
+        """
+        try:
+            bits, length, network = parse_network(condition)
+        except ValueError:
+            return condition == value
+        if not isinstance(value, tuple):
+            return False
+        address_bits, address = value
+        return bits == address_bits and address >> (bits - length) == network >> (bits - length)
+
+    def compile(self, conditions):
+        return CompiledIPAddress(self, conditions)
+
     def clean(self, value):
-        validate_ipv4_address(value)
-        return value
+        try:
+            return format_network(parse_network(value))
+        except ValueError:
+            raise ValidationError('Enter a valid IPv4 or IPv6 address or network.')
+
+
+class CompiledIPAddress(object):
+    """
+    ``ip_address`` conditions, with the networks to include and exclude each
+    compiled into a ``NetworkSet``.
+    """
+    def __init__(self, field, conditions):
+        self.include = NetworkSet()
+        self.exclude = NetworkSet()
+        other = []
+        for status, condition in conditions:
+            try:
+                network = parse_network(condition)
+            except ValueError:
+                other.append((status, condition))
+                continue
+            if status == EXCLUDE:
+                self.exclude.add(network)
+            else:
+                self.include.add(network)
+        # conditions which aren't addresses can still match the value exactly
+        self.other = other and CompiledField(field, other) or None
+
+    def is_active(self, value):
+        return_value = None
+        if isinstance(value, tuple):
+            if value in self.exclude:
+                return False
+            elif value in self.include:
+                return_value = True
+        elif self.other is not None:
+            result = self.other.is_active(value)
+            if result is False:
+                return False
+            elif result is True:
+                return_value = True
+        return return_value
+
+
+_internal_ips = (None, None, None)
+
+
+def is_internal_ip(value, address=None):
+    """
+    Returns ``True`` if the IP address ``value`` is listed in
+    ``settings.INTERNAL_IPS``, which may also contain networks in CIDR
+    notation. ``address`` may be given as ``value`` already parsed by
+    ``parse_address``.
+
+    A list, tuple or set is compiled into a ``NetworkSet`` once, and again
+    whenever the setting is replaced or its length changes (an edit in place
+    which keeps the length isn't noticed). Any other container (such as a
+    list subclass matching wildcards) is asked for membership directly.
+    """
+    global _internal_ips
+    internal_ips = settings.INTERNAL_IPS
+    if type(internal_ips) not in (list, tuple, set, frozenset):
+        return value in internal_ips
+
+    if _internal_ips[0] is not internal_ips or _internal_ips[1] != len(internal_ips):
+        try:
+            networks = NetworkSet(internal_ips)
+        except ValueError:
+            networks = None
+        _internal_ips = (internal_ips, len(internal_ips), networks)
+
+    networks = _internal_ips[2]
+    if networks is not None:
+        if address is None:
+            try:
+                address = parse_address(value)
+            except ValueError:
+                pass
+        if address is not None:
+            return address in networks
+    return value in internal_ips
 
 
 class IPAddressConditionSet(RequestConditionSet):
@@ -61,17 +183,50 @@ class IPAddressConditionSet(RequestConditionSet):
         return 'ip'
 
     def get_field_value(self, instance, field_name):
-        # XXX: can we come up w/ a better API?
-        # Ensure we map ``percent`` to the ``id`` column
+        """
+        ``percent`` is the integer value of the request's address, and
+        ``ip_address`` the address as returned by ``parse_address`` (or the
+        raw string if it isn't a valid address).
+        """
         if field_name == 'percent':
-            return sum([int(x) for x in instance.META['REMOTE_ADDR'].split('.')])
+            address = self.get_address(instance, instance.META['REMOTE_ADDR'])
+            if address is None:
+                return None
+            return address[1]
         elif field_name == 'ip_address':
             # use our better internalized ip middleware
-            return getattr(instance, 'ip', instance.META['REMOTE_ADDR'])
+            value = getattr(instance, 'ip', instance.META['REMOTE_ADDR'])
+            address = self.get_address(instance, value)
+            if address is None:
+                return value
+            return address
         elif field_name == 'internal_ip':
-            return instance.META['REMOTE_ADDR'] in settings.INTERNAL_IPS
+            value = instance.META['REMOTE_ADDR']
+            return is_internal_ip(value, self.get_address(instance, value))
         return super(IPAddressConditionSet, self).get_field_value(instance, field_name)
 
+    def get_address(self, instance, value):
+        """
+        Returns ``value`` parsed by ``parse_address``, or ``None`` if it isn't
+        a valid address. Addresses are parsed once per request.
+        """
+        try:
+            addresses = instance._gargoyle_addresses
+        except AttributeError:
+            addresses = instance._gargoyle_addresses = {}
+
+        try:
+            return addresses[value]
+        except KeyError:
+            pass
+
+        try:
+            address = parse_address(value)
+        except ValueError:
+            address = None
+        addresses[value] = address
+        return address
+
     def get_group_label(self):
         return 'IP Address'
 
@@ -81,6 +236,9 @@ gargoyle.register(IPAddressConditionSet())
 class HostConditionSet(ConditionSet):
     hostname = String()
 
+    uses_request_user = False
+    dispatches_by_type = True
+
     def get_namespace(self):
         return 'host'
 
@@ -89,7 +247,17 @@ class HostConditionSet(ConditionSet):
 
     def get_field_value(self, instance, field_name):
         if field_name == 'hostname':
-            return socket.gethostname()
+            return get_hostname()
+
+    def compile(self, conditions, switch_key=None):
+        compiled = super(HostConditionSet, self).compile(conditions, switch_key)
+        # The hostname can't change between checks, so the result is computed
+        # once for each compiled switch
+        compiled.result = super(HostConditionSet, self).is_active_compiled(None, compiled)
+        return compiled
+
+    def is_active_compiled(self, instance, compiled, field_values=None):
+        return compiled.result
 
     def get_group_label(self):
         return 'Host'
@@ -0,0 +1,33 @@
+"""
+gargoyle.cohorts
+~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from array import array
+from itertools import imap, repeat
+from operator import mod
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def percent_mask(buckets, ids):
+    """
+    Returns a mask of which ``ids`` fall into an included bucket of
+    ``buckets``, as returned by ``Percent.buckets``.
+
+    If ``ids`` is a NumPy array, the mask is a boolean NumPy array. Otherwise
+    ``ids`` may be any sequence of integers (such as an ``array('l')``), and
+    the mask is an ``array('B')`` of ``1`` and ``0``.
+    """
+    if numpy is not None and isinstance(ids, numpy.ndarray):
+        table = numpy.array([bucket is True for bucket in buckets], dtype=bool)
+        return table[ids % 100]
+
+    table = [int(bucket is True) for bucket in buckets]
+    return array('B', imap(table.__getitem__, imap(mod, ids, repeat(100))))
@@ -11,12 +11,20 @@ gargoyle.conditions
 
 import datetime
 
+from functools import partial
+from operator import attrgetter
+
+from django.contrib.auth.models import User
 from django.http import HttpRequest
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.core.validators import ValidationError
+from django.db import connection
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
 
-from gargoyle.models import EXCLUDE
+from gargoyle.members import CompiledMembers
+from gargoyle.models import EXCLUDE, MEMBERS, SwitchMember
 
 import itertools
 
@@ -41,6 +49,38 @@ class Field(object):
     def is_active(self, condition, value):
         return condition == value
 
+    def compile(self, conditions):
+        """
+        Given the ``(status, condition)`` pairs set for this field on a
+        switch, returns a ``CompiledField`` which checks a value against
+        all of them.
+        """
+        return CompiledField(self, conditions)
+
+    def compile_condition(self, condition):
+        """
+        Returns a callable which, given a value, returns the same result as
+        ``is_active(condition, value)``. Subclasses can override this to parse
+        ``condition`` once instead of on every check.
+        """
+        return partial(self.is_active, condition)
+
+    def matches_equal_values(self):
+        """
+        Returns whether conditions only ever match values equal to them, so
+        that values can be looked up among them (or among the members of a
+        membership list) rather than checked against each one.
+        """
+        return False
+
+    def get_query(self, lookup, condition):
+        """
+        Returns a ``Q`` object matching the rows whose ``lookup`` column
+        satisfies ``is_active(condition, value)``, or ``None`` if that can't
+        be expressed in a query.
+        """
+        return None
+
     def validate(self, data):
         value = data.get(self.name)
         if value:
@@ -63,6 +103,9 @@ class Boolean(Field):
     def is_active(self, condition, value):
         return bool(value)
 
+    def get_query(self, lookup, condition):
+        return Q(**{lookup: True})
+
     def render(self, value):
         return mark_safe('<input type="hidden" value="1" name="%s"/>' % (escape(self.name),))
 
@@ -85,8 +128,52 @@ class Choice(Field):
 
 
 class Range(Field):
+    #: Parsed ``min-max`` operands, shared by all range fields.
+    parsed_ranges = {}
+    max_parsed_ranges = 1000
+
     def is_active(self, condition, value):
-        return value >= condition[0] and value <= condition[1]
+        lower, upper = self.parse(condition)
+        return value >= lower and value <= upper
+
+    def compile_condition(self, condition):
+        try:
+            lower, upper = self.parse(condition)
+        except (TypeError, ValueError, IndexError):
+            return partial(self.is_active, condition)
+
+        def is_active(value):
+            return value >= lower and value <= upper
+        return is_active
+
+    def get_query(self, lookup, condition):
+        try:
+            lower, upper = self.parse(condition)
+        except (TypeError, ValueError, IndexError):
+            return None
+        return Q(**{'%s__gte' % lookup: lower, '%s__lte' % lookup: upper})
+
+    def parse(self, condition):
+        """
+        Returns ``condition``, a ``min-max`` string or a pair of values, as a
+        tuple of two integers.
+        """
+        try:
+            return self.parsed_ranges[condition]
+        except (KeyError, TypeError):
+            pass
+
+        if isinstance(condition, basestring):
+            bounds = condition.split('-')
+        else:
+            bounds = condition
+        parsed = (int(bounds[0]), int(bounds[1]))
+
+        if isinstance(condition, basestring):
+            if len(self.parsed_ranges) >= self.max_parsed_ranges:
+                self.parsed_ranges.clear()
+            self.parsed_ranges[condition] = parsed
+        return parsed
 
     def validate(self, data):
         value = filter(None, [data.get(self.name + '[min]'), data.get(self.name + '[max]')]) or None
@@ -107,43 +194,113 @@ class Range(Field):
                          (escape(value[0]), escape(self.name), escape(value[1]), escape(self.name)))
 
     def display(self, value):
-        value = value.split('-')
-        return '%s: %s-%s' % (self.label, value[0], value[1])
+        lower, upper = self.parse(value)
+        return '%s: %s-%s' % (self.label, lower, upper)
 
 
 class Percent(Range):
     default_help_text = 'Enter two ranges. e.g. 0-50 is lower 50%'
 
     def is_active(self, condition, value):
-        condition = map(int, condition.split('-'))
+        # instances without a value (such as requests without a valid
+        # address) are in no bucket
+        if value is None:
+            return False
+        lower, upper = self.parse(condition)
         mod = value % 100
-        return mod >= condition[0] and mod <= condition[1]
+        return mod >= lower and mod <= upper
+
+    def compile_condition(self, condition):
+        try:
+            lower, upper = self.parse(condition)
+        except (TypeError, ValueError, IndexError):
+            return partial(self.is_active, condition)
+
+        def is_active(value):
+            if value is None:
+                return False
+            mod = value % 100
+            return mod >= lower and mod <= upper
+        return is_active
+
+    def get_query(self, lookup, condition):
+        # ``value % 100`` has no lookup; see ModelConditionSet.get_field_query
+        return None
+
+    def buckets(self, conditions):
+        """
+        Returns a list of the 100 buckets of ``value % 100``, each ``True``
+        if ``conditions`` include it, ``False`` if they exclude it, and
+        ``None`` otherwise (as ``CompiledField.is_active`` would return).
+        """
+        buckets = [None] * 100
+        for status, condition in conditions:
+            lower, upper = self.parse(condition)
+            for bucket in xrange(max(lower, 0), min(upper, 99) + 1):
+                if status == EXCLUDE:
+                    buckets[bucket] = False
+                elif buckets[bucket] is None:
+                    buckets[bucket] = True
+        return buckets
 
     def display(self, value):
-        value = value.split('-')
-        return '%s: %s%% (%s-%s)' % (self.label, int(value[1]) - int(value[0]), value[0], value[1])
+        lower, upper = self.parse(value)
+        return '%s: %s%% (%s-%s)' % (self.label, upper - lower, lower, upper)
 
     def clean(self, value):
         value = super(Percent, self).clean(value)
         if value:
-            numeric = value.split('-')
-            if int(numeric[0]) < 0 or int(numeric[1]) > 100:
+            lower, upper = self.parse(value)
+            if lower < 0 or upper > 100:
                 raise ValidationError('You must enter values between 0 and 100.')
-            if int(numeric[0]) > int(numeric[1]):
+            if lower > upper:
                 raise ValidationError('Start value must be less than end value.')
         return value
 
 
 class String(Field):
-    pass
+    def matches_equal_values(self):
+        # unless a subclass matches conditions some other way
+        return self.is_active.im_func is Field.is_active.im_func and \
+            self.compile_condition.im_func is Field.compile_condition.im_func
+
+    def compile(self, conditions):
+        # Conditions matched by equality can be looked up in sets
+        if self.matches_equal_values():
+            try:
+                return CompiledString(self, conditions)
+            except TypeError:
+                # unhashable conditions
+                pass
+        return super(String, self).compile(conditions)
+
+    def get_query(self, lookup, condition):
+        return Q(**{lookup: condition})
 
 
 class AbstractDate(Field):
     DATE_FORMAT = "%Y-%m-%d"
     PRETTY_DATE_FORMAT = "%d %b %Y"
 
+    #: The lookup type matching the same dates as ``date_is_active``.
+    lookup_type = None
+
+    #: Parsed date conditions, shared by all date fields.
+    parsed_dates = {}
+    max_parsed_dates = 1000
+
     def str_to_date(self, value):
-        return datetime.datetime.strptime(value, self.DATE_FORMAT).date()
+        try:
+            return self.parsed_dates[value]
+        except (KeyError, TypeError):
+            pass
+
+        date = datetime.datetime.strptime(value, self.DATE_FORMAT).date()
+
+        if len(self.parsed_dates) >= self.max_parsed_dates:
+            self.parsed_dates.clear()
+        self.parsed_dates[value] = date
+        return date
 
     def display(self, value):
         date = self.str_to_date(value)
@@ -172,20 +329,135 @@ class AbstractDate(Field):
         condition_date = self.str_to_date(condition)
         return self.date_is_active(condition_date, value)
 
+    def compile_condition(self, condition):
+        try:
+            condition_date = self.str_to_date(condition)
+        except (TypeError, ValueError):
+            return partial(self.is_active, condition)
+
+        date_is_active = self.date_is_active
+
+        def is_active(value):
+            if isinstance(value, datetime.datetime):
+                value = value.date()
+            return date_is_active(condition_date, value)
+        return is_active
+
+    def get_query(self, lookup, condition):
+        if self.lookup_type is None:
+            return None
+        try:
+            condition_date = self.str_to_date(condition)
+        except (TypeError, ValueError):
+            return None
+        return Q(**{'%s__%s' % (lookup, self.lookup_type): condition_date})
+
     def date_is_active(self, condition_date, value):
         raise NotImplementedError
 
 
 class BeforeDate(AbstractDate):
+    lookup_type = 'lt'
+
     def date_is_active(self, before_this_date, value):
         return value < before_this_date
 
 
 class OnOrAfterDate(AbstractDate):
+    lookup_type = 'gte'
+
     def date_is_active(self, after_this_date, value):
         return value >= after_this_date
 
 
+class CompiledField(object):
+    """
+    The conditions of a single field on a switch, each one prepared with
+    ``Field.compile_condition``.
+    """
+    def __init__(self, field, conditions):
+        self.field = field
+        self.conditions = [(status == EXCLUDE, field.compile_condition(condition))
+                           for status, condition in conditions]
+
+    def is_active(self, value):
+        """
+        Returns ``False`` if an excluding condition matches ``value``, ``True``
+        if an including condition matches, and ``None`` otherwise.
+        """
+        return_value = None
+        for exclude, is_active in self.conditions:
+            if is_active(value):
+                if exclude:
+                    return False
+                return_value = True
+        return return_value
+
+
+class CompiledString(object):
+    """
+    The conditions of a ``String`` field, compiled into sets of the values to
+    include and exclude, so checks take the same time however many there are.
+    """
+    def __init__(self, field, conditions):
+        self.field = field
+        self.include = set()
+        self.exclude = set()
+        for status, condition in conditions:
+            if status == EXCLUDE:
+                self.exclude.add(condition)
+            else:
+                self.include.add(condition)
+
+    def is_active(self, value):
+        """
+        Returns ``False`` if ``value`` is excluded, ``True`` if it is
+        included, and ``None`` otherwise.
+        """
+        try:
+            if value in self.exclude:
+                return False
+            elif value in self.include:
+                return True
+        except TypeError:
+            # unhashable values never equal a condition
+            pass
+        return None
+
+
+class CompiledConditionSet(object):
+    """
+    The conditions of a switch which belong to a single ConditionSet, with
+    every field's conditions (and membership list) compiled up front.
+    Membership lists are only compiled given the key of the switch.
+    """
+    def __init__(self, condition_set, conditions, switch_key=None):
+        namespace = condition_set.get_namespace()
+        self.condition_set = condition_set
+        self.conditions = conditions
+        self.switch_key = switch_key
+        self.namespace_conditions = conditions.get(namespace) or {}
+        self.members = {}
+        if switch_key is not None:
+            self.members = (conditions.get(MEMBERS) or {}).get(namespace) or {}
+        self.fields = []
+        for name, field in condition_set.fields.iteritems():
+            field_conditions = self.namespace_conditions.get(name)
+            compiled = None
+            if field_conditions:
+                compiled = field.compile(field_conditions)
+            if name in self.members:
+                compiled = CompiledMembers(switch_key, namespace, name, self.members[name], compiled)
+            if compiled is not None:
+                self.fields.append((name, compiled))
+
+    def has_active_condition(self, instances, field_values=None):
+        condition_set = self.condition_set
+        if condition_set.evaluates_compiled:
+            return condition_set.has_active_compiled_condition(self, instances, field_values)
+        return condition_set.has_active_condition(self.conditions, instances)
+
+
 class ConditionSetBase(type):
     def __new__(cls, name, bases, attrs):
         attrs['fields'] = {}
@@ -205,6 +477,25 @@ class ConditionSetBase(type):
                 field.set_values(field_name)
                 attrs['fields'][field_name] = field
 
+        # Precompiled accessors for ``get_field_value``, with ``percent``
+        # mapped to the ``id`` column
+        attrs['field_getters'] = dict(
+            (field_name, attrgetter(field_name == 'percent' and 'id' or field_name))
+            for field_name in attrs['fields']
+        )
+
+        # Condition sets which customise evaluation of the raw conditions, but
+        # not of compiled ones, keep being evaluated against the raw conditions.
+        if 'is_active_compiled' in attrs or 'has_active_compiled_condition' in attrs:
+            attrs.setdefault('evaluates_compiled', True)
+        elif 'is_active' in attrs or 'has_active_condition' in attrs:
+            attrs.setdefault('evaluates_compiled', False)
+
+        # Likewise, condition sets which customise which instances they are
+        # checked against aren't dispatched by type unless they say so.
+        if 'can_execute' in attrs or 'has_active_compiled_condition' in attrs:
+            attrs.setdefault('dispatches_by_type', False)
+
         instance = super(ConditionSetBase, cls).__new__(cls, name, bases, attrs)
 
         return instance
@@ -213,6 +504,19 @@ class ConditionSetBase(type):
 class ConditionSet(object):
     __metaclass__ = ConditionSetBase
 
+    #: Whether ``can_execute`` only depends on the type of the instance, so
+    #: that the manager can remember which condition sets apply to each type
+    #: rather than calling it for every instance on every check. Condition
+    #: sets which override ``can_execute`` must set this to ``True`` to be
+    #: dispatched by type.
+    dispatches_by_type = True
+
+    #: Whether ``request.user`` should be added to the instances this
+    #: condition set is evaluated against. Condition sets which never
+    #: execute against a user should set this to ``False``, so that the
+    #: session and user aren't loaded just to evaluate them.
+    uses_request_user = True
+
     def __repr__(self):
         return '<%s>' % (self.__class__.__name__,)
 
@@ -245,10 +549,13 @@ class ConditionSet(object):
         Default behavior will map the ``percent`` attribute to ``id``.
         """
         # XXX: can we come up w/ a better API?
-        # Ensure we map ``percent`` to the ``id`` column
-        if field_name == 'percent':
-            field_name = 'id'
-        value = getattr(instance, field_name)
+        try:
+            value = self.field_getters[field_name](instance)
+        except KeyError:
+            # Ensure we map ``percent`` to the ``id`` column
+            if field_name == 'percent':
+                field_name = 'id'
+            value = getattr(instance, field_name)
         if callable(value):
             value = value()
         return value
@@ -274,20 +581,104 @@ class ConditionSet(object):
         """
         Given an instance, and the conditions active for this switch, returns
         a boolean representing if the feature is active.
+
+        Conditions are checked one by one, as compiling them would take
+        longer for a single check; the manager compiles each switch once
+        instead. Membership lists, which are looked up by the switch's key,
+        are only checked compiled.
         """
+        namespace_conditions = conditions.get(self.get_namespace()) or {}
         return_value = None
         for name, field in self.fields.iteritems():
-            field_conditions = conditions.get(self.get_namespace(), {}).get(name)
+            field_conditions = namespace_conditions.get(name)
             if field_conditions:
                 value = self.get_field_value(instance, name)
                 for status, condition in field_conditions:
-                    exclude = status == EXCLUDE
                     if field.is_active(condition, value):
-                        if exclude:
+                        if status == EXCLUDE:
                             return False
                         return_value = True
         return return_value
 
+    def compile(self, conditions, switch_key=None):
+        """
+        Given the conditions active for a switch, returns a
+        ``CompiledConditionSet`` with the conditions belonging to this
+        ConditionSet parsed ahead of evaluation, along with its membership
+        lists if ``switch_key`` is given.
+        """
+        return CompiledConditionSet(self, conditions, switch_key)
+
+    def has_active_compiled_condition(self, compiled, instances, field_values=None):
+        """
+        Same as ``has_active_condition``, but checks conditions which were
+        compiled by ``compile``.
+
+        ``field_values`` is an optional dictionary used to remember the
+        field values read from each instance, so they can be shared across
+        switches (and, with the request cache enabled, across checks).
+        """
+        return_value = None
+        for instance in itertools.chain(instances, [None]):
+            if not self.can_execute(instance):
+                continue
+            result = self.is_active_compiled(instance, compiled, field_values)
+            if result is False:
+                return False
+            elif result is True:
+                return_value = True
+        return return_value
+
+    def has_active_executable_condition(self, compiled, instances, field_values=None):
+        """
+        Same as ``has_active_compiled_condition``, but ``instances`` (which
+        may include ``None``) are known to be ones the condition set can
+        execute against.
+        """
+        return_value = None
+        for instance in instances:
+            result = self.is_active_compiled(instance, compiled, field_values)
+            if result is False:
+                return False
+            elif result is True:
+                return_value = True
+        return return_value
+
+    def is_active_compiled(self, instance, compiled, field_values=None):
+        """
+        Same as ``is_active``, but checks conditions which were compiled by
+        ``compile``.
+        """
+        return_value = None
+        for name, field in compiled.fields:
+            if field_values is None:
+                value = self.get_field_value(instance, name)
+            else:
+                # instances are kept alive alongside their values, so their
+                # ids are unique within field_values
+                value_key = (id(instance), self, name)
+                try:
+                    value = field_values[value_key][1]
+                except KeyError:
+                    value = self.get_field_value(instance, name)
+                    field_values[value_key] = (instance, value)
+            result = field.is_active(value)
+            if result is False:
+                return False
+            elif result is True:
+                return_value = True
+        return return_value
+
+    def get_query(self, compiled):
+        """
+        Given a ``CompiledConditionSet``, returns a pair of lists of ``Q``
+        objects (or ``True`` and ``False`` for conditions matching every or no
+        row), which select the rows matched by the including and excluding
+        conditions respectively. Returns ``None`` if the conditions can't be
+        checked in a query.
+        """
+        return None
+
     def get_group_label(self):
         """
         Returns a string representing a human readable version
@@ -299,8 +690,18 @@ class ConditionSet(object):
 class ModelConditionSet(ConditionSet):
     percent = Percent()
 
+    dispatches_by_type = True
+
+    #: ``None`` to only add ``request.user`` when ``model`` is (or inherits
+    #: from, or is inherited by) the user model, or when ``can_execute`` is
+    #: overridden.
+    uses_request_user = None
+
     def __init__(self, model):
         self.model = model
+        if self.uses_request_user is None:
+            self.uses_request_user = self.can_execute.im_func is not ModelConditionSet.can_execute.im_func or \
+                issubclass(model, User) or issubclass(User, model)
 
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, self.model.__name__)
@@ -314,11 +715,73 @@ class ModelConditionSet(ConditionSet):
     def get_namespace(self):
         return '%s.%s' % (self.model._meta.app_label, self.model._meta.module_name)
 
+    def get_query(self, compiled):
+        include, exclude = [], []
+        for name, conditions in compiled.namespace_conditions.iteritems():
+            field = self.fields.get(name)
+            if field is None:
+                continue
+            for status, condition in conditions:
+                query = self.get_field_query(name, field, condition)
+                if query is None:
+                    return None
+                if status == EXCLUDE:
+                    exclude.append(query)
+                else:
+                    include.append(query)
+
+        for name, data in compiled.members.iteritems():
+            field = self.fields.get(name)
+            if field is None or not field.matches_equal_values():
+                return None
+            try:
+                column = self.model._meta.get_field(name).name
+            except FieldDoesNotExist:
+                return None
+            members = SwitchMember.objects.filter(switch_key=compiled.switch_key, namespace=self.get_namespace(),
+                                                  field_name=name)
+            lookup = '%s__in' % (column,)
+            include.append(Q(**{lookup: members.filter(exclude=False).values('value')}))
+            exclude.append(Q(**{lookup: members.filter(exclude=True).values('value')}))
+        return include, exclude
+
+    def get_field_query(self, field_name, field, condition):
+        """
+        Returns a ``Q`` object (or ``True`` or ``False``) selecting the rows
+        for which ``field`` matches ``condition``, or ``None`` if that can't
+        be done in a query. Subclasses which change ``get_field_value`` should
+        change this to match.
+        """
+        # ``percent`` is mapped to ``id`` by get_field_value
+        if field_name == 'percent':
+            field_name = 'id'
+        try:
+            column = self.model._meta.get_field(field_name).column
+        except FieldDoesNotExist:
+            return None
+
+        if isinstance(field, Percent):
+            try:
+                lower, upper = field.parse(condition)
+            except (TypeError, ValueError, IndexError):
+                return None
+            # Python's modulo is never negative, SQL's can be
+            column = connection.ops.quote_name(column)
+            rows = self.model._base_manager.extra(
+                where=['(%s %%%% 100 + 100) %%%% 100 BETWEEN %%s AND %%s' % (column,)],
+                params=[lower, upper],
+            )
+            return Q(pk__in=rows.values('pk'))
+        return field.get_query(field_name, condition)
+
     def get_group_label(self):
         return self.model._meta.verbose_name.title()
 
 
 class RequestConditionSet(ConditionSet):
+    uses_request_user = False
+    dispatches_by_type = True
+
     def get_namespace(self):
         return 'request'
 
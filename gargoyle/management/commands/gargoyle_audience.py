@@ -0,0 +1,55 @@
+"""
+gargoyle.management.commands.gargoyle_audience
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from gargoyle import gargoyle
+
+
+class Command(BaseCommand):
+    args = '<switch key>'
+    help = 'Counts the objects a switch is active for.'
+    option_list = BaseCommand.option_list + (
+        make_option('--model', default='auth.User',
+                    help='The model to evaluate the switch for, as app_label.Model (default: auth.User).'),
+        make_option('--processes', type='int', default=None,
+                    help='Evaluate the switch with this many worker processes, where it can\'t be done in a query.'),
+        make_option('--chunks', type='int', default=None,
+                    help='Split the table into this many primary key ranges (default: 4 per process).'),
+        make_option('--ids', default=None,
+                    help='Write the primary keys of the audience to this file, one per line.'),
+        make_option('--estimate', type='int', default=None, metavar='SAMPLE_SIZE',
+                    help='Estimate the audience from a sample of this many objects.'),
+    )
+
+    def handle(self, key=None, **options):
+        if key is None:
+            raise CommandError('A switch key is required.')
+
+        try:
+            app_label, model_name = options['model'].split('.')
+        except ValueError:
+            raise CommandError('--model must be given as app_label.Model.')
+        model = get_model(app_label, model_name)
+        if model is None:
+            raise CommandError('Unknown model %s.' % (options['model'],))
+
+        audience = gargoyle.audience(key, model._default_manager.all())
+
+        if options['estimate']:
+            estimate, sampled, matched = audience.estimate(options['estimate'])
+            self.stdout.write('%d (%d of %d sampled)\n' % (estimate, matched, sampled))
+        elif options['ids']:
+            count = audience.write_ids(options['ids'], options['processes'], options['chunks'])
+            self.stdout.write('%d\n' % (count,))
+        else:
+            count = audience.count(options['processes'], options['chunks'])
+            self.stdout.write('%d\n' % (count,))
@@ -3,13 +3,113 @@ from django.core.cache import get_cache
 from django.http import HttpRequest
 
 from gargoyle.models import Switch, DISABLED, SELECTIVE, GLOBAL, INHERIT, \
-    INCLUDE, EXCLUDE
+    INCLUDE, EXCLUDE, MEMBERS
+from gargoyle.audience import Audience, query_and, query_or, query_not, query_any
+from gargoyle.cohorts import percent_mask
+from gargoyle import signals
 from gargoyle.proxy import SwitchProxy
+from gargoyle.stats import SwitchStats
+from gargoyle.tree import SwitchTree, CONDITIONAL
 
 from modeldict import ModelDict
+from modeldict.base import NoValue
+
+import cPickle as pickle
+import itertools
+import threading
+import time
+
+
+class RequestCache(object):
+    """
+    Memoized ``is_active`` results and field values for the lifetime of a
+    single request, along with the snapshot of switches they were computed
+    from (and its tree, if the snapshot is no longer the current one).
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.switches = None
+        self.tree = None
+        self.results = {}
+        self.field_values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_field_values(self):
+        """
+        Returns the remembered field values, which are forgotten once there
+        are ``max_size`` of them, so that they don't keep every instance
+        checked during the request alive.
+        """
+        if len(self.field_values) >= self.max_size:
+            self.field_values.clear()
+        return self.field_values
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.results),
+        }
+
+
+_missing = object()
+
+
+class Evaluation(object):
+    """
+    State shared by every switch evaluated against one set of instances:
+    the instances themselves (with ``request.user`` swapped in when it is
+    needed), the tree of switches, the result of each switch key, and the
+    field values read from each instance.
+    """
+    def __init__(self, instances, field_values=None):
+        self.instances = instances
+        self.expanded = None
+        self.tree = None
+        self.results = {}
+        if field_values is None:
+            field_values = {}
+        self.field_values = field_values
+        self.executable = {}
+
+    def get_instances(self, condition_set=None):
+        """
+        Returns the instances to evaluate ``condition_set`` against. Reading
+        ``request.user`` may load the session and the user, so it is only
+        added for condition sets which use it.
+        """
+        if condition_set is not None and not condition_set.uses_request_user:
+            return self.instances
+        if self.expanded is None:
+            # HACK: support request.user by swapping in User instance
+            instances = list(self.instances)
+            for v in self.instances:
+                if isinstance(v, HttpRequest):
+                    # read once, as ``user`` may be computed on access
+                    user = getattr(v, 'user', _missing)
+                    if user is not _missing:
+                        instances.append(user)
+            self.expanded = instances
+        return self.expanded
 
 
 class SwitchManager(ModelDict):
+    """
+    ``ModelDict`` of switches, which evaluates them against the registered
+    condition sets.
+
+    By default switches are revalidated against the shared cache after every
+    request. Passing ``snapshot_timeout`` (in milliseconds) instead keeps a
+    local snapshot of the switches, which is only revalidated against the
+    shared cache's version key once it is older than ``snapshot_timeout``, and
+    at the end of each request if ``snapshot_per_request`` is ``True``.
+
+    Every save or delete of a switch is recorded in a change log in the shared
+    cache, so other processes refresh their switches by applying only the
+    changes since their own version, rather than fetching all of them again.
+    """
+
     DISABLED = DISABLED
     SELECTIVE = SELECTIVE
     GLOBAL = GLOBAL
@@ -18,10 +118,40 @@ class SwitchManager(ModelDict):
     INCLUDE = INCLUDE
     EXCLUDE = EXCLUDE
 
+    #: The most changes applied to the local switches one by one. Processes
+    #: further behind fetch every switch from the shared cache instead.
+    max_changes = 100
+
+    #: While statistics are enabled, the size and deserialize time of the
+    #: payload fetched from the shared cache are measured on the first fetch
+    #: and then once every this many fetches, as measuring it serializes and
+    #: deserializes the payload again.
+    payload_sample_interval = 100
+
     def __init__(self, *args, **kwargs):
+        self.snapshot_timeout = kwargs.pop('snapshot_timeout', None)
+        self.snapshot_per_request = kwargs.pop('snapshot_per_request', False)
+        self._snapshot_expires = 0
         self._registry = {}
+        self._namespaces = {}
+        self._dispatch = {}
+        self._compiled = {}
+        self._local = threading.local()
+        self._request_cache_stats = {'hits': 0, 'misses': 0, 'requests': 0}
+        self._overrides = {}
+        self._tree = None
+        self._stats = None
+        self._store_stats = None
+        self._fetches_until_sample = 0
+        # The change log version and last update of the local switches
+        self._version = None
         super(SwitchManager, self).__init__(*args, **kwargs)
 
+        cls_name = type(self).__name__
+        model_name = self.model.__name__
+        self.version_cache_key = '%s.version:%s:%s' % (cls_name, model_name, self.key)
+        self.change_cache_key = '%s.change:%s:%s' % (cls_name, model_name, self.key)
+
     def __repr__(self):
         return "<%s: %s (%s)>" % (self.__class__.__name__, self.model, self._registry.values())
 
@@ -40,23 +170,141 @@ class SwitchManager(ModelDict):
 
         >>> gargoyle.is_active('my_feature', request) #doctest: +SKIP
         """
+        # Fast path: switches whose result doesn't depend on the instances
+        # are answered straight from the tree, without allocating anything.
+        if not self._overrides:
+            node = self.get_tree().nodes.get(key)
+            if node is not None:
+                result = node.result
+                if result is not CONDITIONAL:
+                    if result is None:
+                        return kwargs.get('default', False)
+                    return result
+
         default = kwargs.pop('default', False)
 
-        # Check all parents for a disabled state
-        parts = key.split(':')
-        if len(parts) > 1:
-            child_kwargs = kwargs.copy()
-            child_kwargs['default'] = None
-            result = self.is_active(':'.join(parts[:-1]), *instances, **child_kwargs)
+        request_cache = getattr(self._local, 'request_cache', None)
+        if request_cache is None:
+            result = self._evaluate(key, Evaluation(instances))
+            if result is None:
+                return default
+            return result
 
-            if result is False:
+        cache_key = (key, tuple(id(i) for i in instances), default)
+        try:
+            # instances are kept alive alongside the result so that their ids
+            # can't be reused by other objects during the request
+            result = request_cache.results[cache_key][1]
+        except KeyError:
+            request_cache.misses += 1
+        else:
+            request_cache.hits += 1
+            return result
+
+        result = self._evaluate(key, Evaluation(instances, request_cache.get_field_values()))
+        if result is None:
+            result = default
+        if len(request_cache.results) < request_cache.max_size:
+            request_cache.results[cache_key] = (instances, result)
+        return result
+
+    def is_active_many(self, keys, *instances, **kwargs):
+        """
+        Returns a dictionary mapping each of ``keys`` to the result of
+        ``is_active`` for ``instances``.
+
+        Instances are expanded once, and parent switches and field values are
+        only evaluated once, no matter how many keys share them.
+
+        >>> gargoyle.is_active_many(['my_feature', 'my_other_feature'], request) #doctest: +SKIP
+        """
+        default = kwargs.pop('default', False)
+
+        field_values = None
+        request_cache = getattr(self._local, 'request_cache', None)
+        if request_cache is not None:
+            field_values = request_cache.get_field_values()
+        evaluation = Evaluation(instances, field_values)
+        results = {}
+        for key in keys:
+            result = self._evaluate(key, evaluation)
+            if result is None:
+                result = default
+            results[key] = result
+        return results
+
+    def active_switches(self, *instances, **kwargs):
+        """
+        Returns a dictionary mapping the key of every switch to the result of
+        ``is_active`` for ``instances``.
+
+        >>> gargoyle.active_switches(request) #doctest: +SKIP
+        """
+        return self.is_active_many(self._get_switches().keys(), *instances, **kwargs)
+
+    def _evaluate(self, key, evaluation):
+        """
+        Returns ``True`` or ``False`` if ``key`` is active or inactive for the
+        evaluation's instances, or ``None`` if it defers to the default.
+        """
+        results = evaluation.results
+        try:
+            return results[key]
+        except KeyError:
+            pass
+
+        if self._overrides:
+            if key in self._overrides:
+                result = results[key] = self._overrides[key]
                 return result
-            elif result is True:
-                default = result
+        else:
+            tree = evaluation.tree
+            if tree is None:
+                tree = evaluation.tree = self.get_tree()
+            node = tree.get(key)
+            if node is not None:
+                return self._evaluate_node(node, evaluation)
 
+        # Check all parents for a disabled state
+        default = None
+        if ':' in key:
+            default = self._evaluate(key.rsplit(':', 1)[0], evaluation)
+            if default is False:
+                results[key] = False
+                return False
+
+        result = results[key] = self._evaluate_switch(self._get_switch(key), default, evaluation)
+        return result
+
+    def _evaluate_node(self, node, evaluation):
+        result = node.result
+        if result is not CONDITIONAL:
+            return result
+
+        results = evaluation.results
         try:
-            switch = self[key]
+            return results[node.key]
         except KeyError:
+            pass
+
+        default = None
+        if node.parent is not None:
+            default = self._evaluate_node(node.parent, evaluation)
+
+        if default is False:
+            result = False
+        elif node.state is CONDITIONAL:
+            result = self._evaluate_switch(node.switch, default, evaluation)
+        elif node.state is None:
+            result = default
+        else:
+            result = node.state
+
+        results[node.key] = result
+        return result
+
+    def _evaluate_switch(self, switch, default, evaluation):
+        if switch is None:
             # switch is not defined, defer to parent
             return default
 
@@ -67,23 +315,23 @@ class SwitchManager(ModelDict):
         elif switch.status == INHERIT:
             return default
 
-        conditions = switch.value
         # If no conditions are set, we inherit from parents
-        if not conditions:
+        if not switch.value:
             return default
 
-        if instances:
-            # HACK: support request.user by swapping in User instance
-            instances = list(instances)
-            for v in instances:
-                if isinstance(v, HttpRequest) and hasattr(v, 'user'):
-                    instances.append(v.user)
+        field_values = evaluation.field_values
 
         # check each switch to see if it can execute
         return_value = False
 
-        for switch in self._registry.itervalues():
-            result = switch.has_active_condition(conditions, instances)
+        for compiled in self.compile(switch):
+            condition_set = compiled.condition_set
+            if condition_set.dispatches_by_type and condition_set.evaluates_compiled:
+                result = condition_set.has_active_executable_condition(
+                    compiled, self._get_executable(condition_set, evaluation), field_values)
+            else:
+                instances = evaluation.get_instances(condition_set)
+                result = compiled.has_active_condition(instances, field_values)
             if result is False:
                 return False
             elif result is True:
@@ -92,6 +340,554 @@ class SwitchManager(ModelDict):
         # there were no matching conditions, so it must not be enabled
         return return_value
 
+    def _get_executable(self, condition_set, evaluation):
+        """
+        Returns the evaluation's instances (and ``None``) which
+        ``condition_set`` can execute against, looked up by type.
+        """
+        try:
+            return evaluation.executable[condition_set]
+        except KeyError:
+            pass
+
+        executable = []
+        for instance in itertools.chain(evaluation.get_instances(condition_set), [None]):
+            cls = instance.__class__
+            try:
+                condition_sets = self._dispatch[cls]
+            except KeyError:
+                condition_sets = self._dispatch[cls] = frozenset([
+                    c for c in self._registry.itervalues()
+                    if c.dispatches_by_type and c.can_execute(instance)
+                ])
+            if condition_set in condition_sets:
+                executable.append(instance)
+        evaluation.executable[condition_set] = executable
+        return executable
+
+    def override(self, overrides):
+        """
+        Forces the switches in ``overrides``, a dictionary of switch keys to
+        booleans, to the given state, replacing any previous overrides.
+        Returns the previous overrides.
+
+        This is generally handled by ``gargoyle.testutils.switches``.
+        """
+        previous, self._overrides = self._overrides, overrides
+
+        # results memoized for this request may not hold anymore
+        request_cache = getattr(self._local, 'request_cache', None)
+        if request_cache is not None:
+            request_cache.results.clear()
+        return previous
+
+    def percent_mask(self, key, ids, condition_set, field_name='percent'):
+        """
+        Returns a mask of which of ``ids`` are included by the ``Percent``
+        conditions of switch ``key`` on ``field_name`` of ``condition_set``
+        (a condition set id), without loading an object per id. Only those
+        conditions are considered, not the switch's status or other
+        conditions.
+
+        ``ids`` may be a NumPy array, giving a boolean NumPy array, or any
+        sequence of integers such as an ``array('l')``, giving an
+        ``array('B')``. See ``gargoyle.cohorts.percent_mask``.
+
+        >>> gargoyle.percent_mask('my_feature', user_ids, 'gargoyle.builtins.UserConditionSet(auth.user)') #doctest: +SKIP
+        """
+        condition_set = self.get_condition_set_by_id(condition_set)
+        field = condition_set.fields[field_name]
+        switch = self._get_switch(key)
+
+        conditions = ()
+        if switch is not None:
+            conditions = switch.value.get(condition_set.get_namespace(), {}).get(field_name, ())
+        return percent_mask(field.buckets(conditions), ids)
+
+    def audience(self, key, queryset):
+        """
+        Returns an ``Audience`` of the objects in ``queryset`` for which
+        switch ``key`` is active, as ``is_active(key, obj)`` would return.
+
+        Conditions are translated into a query where possible, so that the
+        audience can be streamed with ``iterator()`` or counted in the
+        database. Otherwise, objects are checked in Python.
+
+        >>> gargoyle.audience('my_feature', User.objects.all()).count() #doctest: +SKIP
+        """
+        query = self._get_audience_query(key, queryset.model)
+        if query is not None:
+            query = query[0]
+        return Audience(self, key, queryset, query)
+
+    def _get_audience_query(self, key, model):
+        """
+        Mirrors ``_evaluate`` for instances of ``model``, returning the pair
+        of queries selecting the rows for which ``key`` is active and
+        inactive, or ``None`` if the conditions can't be checked in a query.
+        """
+        if key in self._overrides:
+            result = self._overrides[key]
+            return result is True, result is False
+
+        default = (False, False)
+        if ':' in key:
+            default = self._get_audience_query(key.rsplit(':', 1)[0], model)
+            if default is None:
+                return None
+            elif default[1] is True:
+                return False, True
+
+        result = self._get_switch_audience_query(self._get_switch(key), default, model)
+        if result is None or default[1] is False:
+            return result
+        # Inactive parents disable their children
+        return query_and(result[0], query_not(default[1])), query_or(result[1], default[1])
+
+    def _get_switch_audience_query(self, switch, default, model):
+        if switch is None:
+            return default
+
+        if switch.status == GLOBAL:
+            return True, False
+        elif switch.status == DISABLED:
+            return False, True
+        elif switch.status == INHERIT:
+            return default
+
+        if not switch.value:
+            return default
+
+        instance = model()
+        include = exclude = False
+        for compiled in self.compile(switch):
+            condition_set = compiled.condition_set
+            if not condition_set.can_execute(instance):
+                # the result doesn't depend on the instance
+                result = compiled.has_active_condition([])
+                active, inactive = result is True, result is False
+            elif condition_set.can_execute(None) or not condition_set.evaluates_compiled:
+                return None
+            else:
+                queries = condition_set.get_query(compiled)
+                if queries is None:
+                    return None
+                inactive = query_any(queries[1])
+                active = query_and(query_any(queries[0]), query_not(inactive))
+            include = query_or(include, active)
+            exclude = query_or(exclude, inactive)
+
+        active = query_and(include, query_not(exclude))
+        return active, query_not(active)
+
+    def _get_switches(self):
+        """
+        Returns the dictionary of all switches. Within a request cache, this
+        is the snapshot taken when the request first needed one.
+        """
+        request_cache = getattr(self._local, 'request_cache', None)
+        if request_cache is None:
+            return self._populate()
+        if request_cache.switches is None:
+            request_cache.switches = self._populate()
+        return request_cache.switches
+
+    def _get_switch(self, key):
+        """
+        Returns the ``Switch`` stored under ``key``, or ``None`` if it does
+        not exist.
+        """
+        try:
+            return self._get_switches()[key]
+        except KeyError:
+            value = self.get_default(key)
+            if value is NoValue:
+                return None
+            return value
+
+    def get_tree(self):
+        """
+        Returns the ``SwitchTree`` of the current switches, which is built
+        once each time they are loaded.
+
+        When switches are created on first use, ancestors which don't exist
+        are left out of the tree, so that evaluating them creates them.
+
+        A request cache holding an older snapshot than the current one keeps
+        the tree of its snapshot itself, so that requests which started
+        before a reload don't keep replacing the tree of the current one.
+        """
+        switches = self._get_switches()
+        tree = self._tree
+        if tree is not None and tree.switches is switches:
+            return tree
+
+        request_cache = getattr(self._local, 'request_cache', None)
+        if request_cache is not None and switches is not self._cache:
+            tree = request_cache.tree
+            if tree is None or tree.switches is not switches:
+                tree = request_cache.tree = SwitchTree(switches, missing_ancestors=not self.auto_create)
+            return tree
+
+        tree = self._tree = SwitchTree(switches, missing_ancestors=not self.auto_create)
+        return tree
+
+    def clear_tree(self):
+        """
+        Discards the ``SwitchTree``, so it is rebuilt from the current state
+        of the switches. ``SwitchProxy`` calls this whenever a switch is
+        modified in place.
+        """
+        self._tree = None
+        request_cache = getattr(self._local, 'request_cache', None)
+        if request_cache is not None:
+            request_cache.tree = None
+
+    def enable_request_cache(self, max_size=1000):
+        """
+        Memoizes ``is_active`` results in the current thread, for at most
+        ``max_size`` distinct calls, until ``disable_request_cache`` is called.
+        Every switch is read from a single snapshot in the meantime.
+
+        This is generally handled by ``gargoyle.middleware.SwitchCacheMiddleware``.
+        """
+        self._local.request_cache = RequestCache(max_size)
+
+    def disable_request_cache(self):
+        """
+        Discards the current thread's memoized results, and returns the
+        number of hits and misses they saw (or ``None`` if the request cache
+        was not enabled).
+        """
+        request_cache = getattr(self._local, 'request_cache', None)
+        if request_cache is None:
+            return None
+        self._local.request_cache = None
+
+        stats = self._request_cache_stats
+        stats['hits'] += request_cache.hits
+        stats['misses'] += request_cache.misses
+        stats['requests'] += 1
+        return request_cache.get_stats()
+
+    def get_request_cache_stats(self):
+        """
+        Returns the total number of request cache hits and misses, and the
+        number of requests they were recorded over.
+        """
+        return self._request_cache_stats.copy()
+
+    def enable_stats(self):
+        """
+        Starts recording the number of calls to ``is_active`` for each key,
+        how many were active, and a histogram of how long they took.
+
+        Until this is called (and after ``disable_stats``), ``is_active`` is
+        not instrumented at all.
+        """
+        if self._stats is None:
+            self._stats = SwitchStats()
+        self._store_stats = self._stats
+        # Shadow the method on the instance, rather than checking a flag on
+        # every call
+        self.is_active = self._is_active_with_stats
+
+    def disable_stats(self):
+        """
+        Stops recording statistics. Those already recorded are kept.
+        """
+        self.__dict__.pop('is_active', None)
+        self._store_stats = None
+
+    @property
+    def stats_enabled(self):
+        """
+        ``True`` between ``enable_stats`` and ``disable_stats``.
+        """
+        return self._store_stats is not None
+
+    def reset_stats(self):
+        if self._stats is not None:
+            self._stats.reset()
+
+    def stats(self):
+        """
+        Returns the statistics recorded by this process: ``switches`` maps
+        each key checked with ``is_active`` to its counters and latency
+        histogram (see ``SwitchStats.get_stats``), ``store`` counts how the
+        switches were read from the local snapshot, the shared cache and the
+        database (see ``SwitchStats.get_store_stats``), and ``request_cache``
+        holds the totals of ``get_request_cache_stats``.
+
+        >>> gargoyle.stats()['switches']['my_feature']['calls'] #doctest: +SKIP
+        """
+        stats = self._stats
+        if stats is None:
+            stats = SwitchStats()
+        return {
+            'switches': stats.get_stats(),
+            'store': stats.get_store_stats(),
+            'request_cache': self.get_request_cache_stats(),
+        }
+
+    def _is_active_with_stats(self, key, *instances, **kwargs):
+        start = time.time()
+        result = type(self).is_active(self, key, *instances, **kwargs)
+        self._stats.record(key, result, time.time() - start)
+        return result
+
+    def compile(self, switch):
+        """
+        Returns the conditions of ``switch`` compiled as a list of
+        ``CompiledConditionSet`` instances, one for each registered condition
+        set whose namespace the switch has conditions or membership lists in.
+
+        Compiled conditions are cached by the switch's key and
+        ``date_modified``, and recompiled whenever the switch is reloaded.
+        """
+        try:
+            value, date_modified, compiled = self._compiled[switch.key]
+        except KeyError:
+            pass
+        else:
+            if value is switch.value and date_modified == switch.date_modified:
+                return compiled
+
+        namespaces = [n for n in switch.value if n != MEMBERS]
+        for namespace in switch.value.get(MEMBERS, ()):
+            if namespace not in switch.value:
+                namespaces.append(namespace)
+
+        compiled = []
+        for namespace in namespaces:
+            for condition_set in self._namespaces.get(namespace, ()):
+                compiled.append(condition_set.compile(switch.value, switch.key))
+        self._compiled[switch.key] = (switch.value, switch.date_modified, compiled)
+        return compiled
+
+    def _populate(self, reset=False):
+        if self.snapshot_timeout is None:
+            return self._populate_shared(reset)
+
+        now = time.time()
+        if reset or self._cache is None or self._last_updated is None:
+            self._populate_shared(reset)
+        elif now >= self._snapshot_expires:
+            # Only the version key is fetched, unless it has changed
+            if self.has_global_changed() is not False:
+                self._cache = self._get_shared_cache_data()
+                self._last_updated = int(now)
+                if self._cache is None:
+                    self._update_cache_data()
+            elif self._store_stats is not None:
+                self._store_stats.count('local_hits')
+        else:
+            if self._store_stats is not None:
+                self._store_stats.count('local_hits')
+            return self._cache
+
+        self._snapshot_expires = now + self.snapshot_timeout / 1000.0
+        return self._cache
+
+    def _populate_shared(self, reset=False):
+        # ``ModelDict._populate``, with the shared cache read through
+        # ``_get_shared_cache_data``
+        if reset:
+            self._cache = None
+        elif self.is_local_expired():
+            now = int(time.time())
+            # Avoid hitting the cache if we don't have a local copy
+            if self._cache is None:
+                global_changed = True
+            else:
+                global_changed = self.has_global_changed()
+
+            if global_changed or self._cache is None:
+                self._cache = self._get_shared_cache_data()
+
+                # If last_updated_cache_key was missing (but the data wasn't),
+                # set it to prevent continuous fetches
+                if global_changed is None and self._cache is not None:
+                    self.cache.add(self.last_updated_cache_key, now)
+            elif self._store_stats is not None:
+                self._store_stats.count('local_hits')
+
+            self._last_updated = now
+        elif self._store_stats is not None and self._cache is not None:
+            self._store_stats.count('local_hits')
+
+        if self._cache is None:
+            self._update_cache_data()
+        return self._cache
+
+    def has_global_changed(self):
+        """
+        Returns ``True`` if the switches in the shared cache have changed
+        since they were last loaded, and ``None`` if there are none. Changes
+        recorded in the change log are applied to the local switches, and
+        don't count as changed.
+        """
+        if self._store_stats is not None:
+            self._store_stats.count('version_checks')
+
+        version, last_updated = self._get_global_version()
+        if last_updated is None:
+            return None
+        if self._version is None:
+            return True
+        if (version, last_updated) == self._version:
+            return False
+        return not self._apply_changes(version, last_updated)
+
+    def _get_global_version(self):
+        """
+        Returns the change log version and last update of the switches in the
+        shared cache, as a ``(version, last_updated)`` pair.
+        """
+        data = self.cache.get_many([self.version_cache_key, self.last_updated_cache_key])
+        last_updated = data.get(self.last_updated_cache_key)
+        if last_updated:
+            last_updated = int(last_updated)
+        else:
+            last_updated = None
+        return data.get(self.version_cache_key), last_updated
+
+    def _get_change_key(self, version):
+        return '%s:%d' % (self.change_cache_key, version)
+
+    def _log_change(self, key):
+        """
+        Records in the change log that the switch ``key`` was saved or
+        deleted, along with its new state (``None`` once deleted) and the
+        last update it was written with.
+
+        The state is taken from the switches just reloaded for the shared
+        cache, so other processes apply the same state as a full fetch would
+        give them, without reading the database themselves (where the change
+        may not be committed yet).
+        """
+        self.cache.add(self.version_cache_key, 0)
+        try:
+            version = self.cache.incr(self.version_cache_key)
+        except ValueError:
+            # The version was evicted, so other processes will fetch every
+            # switch anyway
+            return
+        self.cache.set(self._get_change_key(version), (key, self._cache.get(key), self._last_updated))
+
+    def _apply_changes(self, version, last_updated):
+        """
+        Applies the changes logged between the local version and ``version``
+        to a copy of the local switches, returning ``False`` if the change log
+        doesn't hold every change in between.
+        """
+        current = self._version[0]
+        if current is None or version is None or not 0 < version - current <= self.max_changes:
+            return False
+
+        change_keys = [self._get_change_key(v) for v in xrange(current + 1, version + 1)]
+        changes = self.cache.get_many(change_keys)
+        if len(changes) != len(change_keys) or changes[change_keys[-1]][2] != last_updated:
+            # Some of the log was evicted, or the switches were also written
+            # without being logged
+            return False
+
+        start = time.time()
+        keys = set()
+        switches = dict(self._cache)
+        for change_key in change_keys:
+            key, value, key_last_updated = changes[change_key]
+            keys.add(key)
+            if value is None:
+                switches.pop(key, None)
+            else:
+                switches[key] = value
+        duration = time.time() - start
+
+        self._cache = switches
+        self._version = (version, last_updated)
+        if self._store_stats is not None:
+            self._store_stats.count('change_refreshes')
+            self._store_stats.count('changed_switches', len(keys))
+
+        signals.switches_patched.send(sender=self, duration=duration, keys=keys)
+        return True
+
+    def _get_shared_cache_data(self):
+        """
+        Fetches the switches from the shared cache, returning ``None`` if they
+        aren't there.
+        """
+        # The version is read first, so that any change made after it is
+        # applied again rather than missed
+        version = self._get_global_version()
+        start = time.time()
+        data = self.cache.get(self.cache_key)
+        duration = time.time() - start
+        if data is not None:
+            self._version = version
+
+        size = deserialize_duration = None
+        stats = self._store_stats
+        if stats is not None:
+            stats.count('cache_fetches')
+            stats.count('cache_fetch_usec', duration * 1e6)
+            if data is None:
+                stats.count('cache_misses')
+            elif self._fetches_until_sample > 0:
+                self._fetches_until_sample -= 1
+            else:
+                self._fetches_until_sample = self.payload_sample_interval - 1
+                # The cache backend deserializes the payload itself, so it is
+                # measured by serializing it again
+                payload = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+                size = len(payload)
+                deserialize_start = time.time()
+                pickle.loads(payload)
+                deserialize_duration = time.time() - deserialize_start
+                stats.last_payload = (size, deserialize_duration * 1e6)
+
+        signals.switches_cache_fetched.send(sender=self, hit=data is not None, duration=duration,
+                                            size=size, deserialize_duration=deserialize_duration)
+        return data
+
+    def _get_cache_data(self):
+        start = time.time()
+        data = super(SwitchManager, self)._get_cache_data()
+        duration = time.time() - start
+
+        if self._store_stats is not None:
+            self._store_stats.count('database_reloads')
+            self._store_stats.count('database_reload_usec', duration * 1e6)
+
+        signals.switches_reloaded.send(sender=self, duration=duration, count=len(data))
+        return data
+
+    def _update_cache_data(self):
+        version = self.cache.get(self.version_cache_key)
+        super(SwitchManager, self)._update_cache_data()
+        self._version = (version, self._last_updated)
+
+    def _post_save(self, sender, instance, created, **kwargs):
+        super(SwitchManager, self)._post_save(sender, instance, created, **kwargs)
+        self._log_change(getattr(instance, self.key))
+
+    def _post_delete(self, sender, instance, **kwargs):
+        super(SwitchManager, self)._post_delete(sender, instance, **kwargs)
+        self._log_change(getattr(instance, self.key))
+
+    def _cleanup(self, *args, **kwargs):
+        if self.snapshot_timeout is None:
+            return super(SwitchManager, self)._cleanup(*args, **kwargs)
+        if self.snapshot_per_request:
+            self._snapshot_expires = 0
+
+    def clear_cache(self):
+        super(SwitchManager, self).clear_cache()
+        self._version = None
+        self._compiled.clear()
+        self._tree = None
+
     def register(self, condition_set):
         """
         Registers a condition set with the manager.
@@ -103,6 +899,7 @@ class SwitchManager(ModelDict):
         if callable(condition_set):
             condition_set = condition_set()
         self._registry[condition_set.get_id()] = condition_set
+        self._index_condition_sets()
 
     def unregister(self, condition_set):
         """
@@ -113,6 +910,20 @@ class SwitchManager(ModelDict):
         if callable(condition_set):
             condition_set = condition_set()
         self._registry.pop(condition_set.get_id(), None)
+        self._index_condition_sets()
+
+    def _index_condition_sets(self):
+        """
+        Rebuilds the namespace index of registered condition sets, so
+        evaluation only visits the namespaces a switch has conditions in, and
+        forgets which condition sets apply to each type of instance.
+        """
+        namespaces = {}
+        for condition_set in self._registry.itervalues():
+            namespaces.setdefault(condition_set.get_namespace(), []).append(condition_set)
+        self._namespaces = namespaces
+        self._dispatch = {}
+        self._compiled.clear()
 
     def get_condition_set_by_id(self, switch_id):
         """
@@ -149,7 +960,14 @@ class SwitchManager(ModelDict):
 if hasattr(settings, 'GARGOYLE_CACHE_NAME'):
     gargoyle = SwitchManager(Switch, key='key', value='value', instances=True,
                          auto_create=getattr(settings, 'GARGOYLE_AUTO_CREATE', True),
+                         snapshot_timeout=getattr(settings, 'GARGOYLE_SNAPSHOT_TIMEOUT', None),
+                         snapshot_per_request=getattr(settings, 'GARGOYLE_SNAPSHOT_PER_REQUEST', False),
                          cache=get_cache(settings.GARGOYLE_CACHE_NAME))
 else:
     gargoyle = SwitchManager(Switch, key='key', value='value', instances=True,
-                         auto_create=getattr(settings, 'GARGOYLE_AUTO_CREATE', True))
+                         auto_create=getattr(settings, 'GARGOYLE_AUTO_CREATE', True),
+                         snapshot_timeout=getattr(settings, 'GARGOYLE_SNAPSHOT_TIMEOUT', None),
+                         snapshot_per_request=getattr(settings, 'GARGOYLE_SNAPSHOT_PER_REQUEST', False))
+
+if getattr(settings, 'GARGOYLE_STATS', False):
+    gargoyle.enable_stats()
@@ -101,7 +101,8 @@ $(document).ready(function () {
                     row.find(".toggled").removeClass("toggled");
                     el.addClass("toggled");
                     row.attr('data-switch-status', swtch.status);
-                    if ($.isArray(swtch.conditions) && swtch.conditions.length < 1 && swtch.status == 2) {
+                    if ($.isArray(swtch.conditions) && swtch.conditions.length < 1 &&
+                            !(swtch.members && swtch.members.length) && swtch.status == 2) {
                         swtch.status = 3;
                     }
                     row.find('.status p').text(labels[swtch.status]);
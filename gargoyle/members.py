@@ -0,0 +1,136 @@
+"""
+gargoyle.members
+~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import base64
+import math
+import struct
+
+from hashlib import md5
+
+from gargoyle.models import SwitchMember
+
+#: The rate at which ``BloomFilter`` reports values it doesn't hold as
+#: members, when it holds as many values as its capacity.
+FALSE_POSITIVE_RATE = 0.01
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class BloomFilter(object):
+    """
+    A compact set of strings, which may report strings it doesn't hold as
+    members (at about ``FALSE_POSITIVE_RATE``) but never misses one it holds.
+    """
+    def __init__(self, size, hashes, bits=None):
+        self.size = size
+        self.hashes = hashes
+        if bits is None:
+            bits = bytearray((size + 7) // 8)
+        self.bits = bits
+
+    @classmethod
+    def with_capacity(cls, capacity):
+        """
+        Returns an empty filter sized for ``capacity`` values.
+        """
+        capacity = max(capacity, 1)
+        size = max(int(math.ceil(-capacity * math.log(FALSE_POSITIVE_RATE) / math.log(2) ** 2)), 8)
+        hashes = max(int(round(float(size) / capacity * math.log(2))), 1)
+        return cls(size, hashes)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['size'], data['hashes'], bytearray(base64.b64decode(data['bits'])))
+
+    def to_dict(self):
+        return {
+            'size': self.size,
+            'hashes': self.hashes,
+            'bits': base64.b64encode(str(self.bits)),
+        }
+
+    def _get_indexes(self, value):
+        # double hashing, with both hashes taken from a single digest
+        h1, h2 = struct.unpack('<II', md5(_encode(value)).digest()[:8])
+        size = self.size
+        return [(h1 + i * h2) % size for i in xrange(self.hashes)]
+
+    def add(self, value):
+        bits = self.bits
+        for index in self._get_indexes(value):
+            bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, value):
+        bits = self.bits
+        for index in self._get_indexes(value):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+
+class CompiledMembers(object):
+    """
+    The membership list of a field on a switch, along with the field's other
+    conditions (if any). Values which may be members according to the list's
+    ``BloomFilter`` are looked up in ``SwitchMember`` by the switch's key.
+    """
+    #: The number of looked up values remembered.
+    max_lookups = 1000
+
+    def __init__(self, switch_key, namespace, field_name, data, compiled=None):
+        self.key = switch_key
+        self.namespace = namespace
+        self.field_name = field_name
+        self.filter = BloomFilter.from_dict(data['filter'])
+        self.compiled = compiled
+        self.lookups = {}
+
+    def lookup(self, value):
+        """
+        Returns ``True`` if ``value`` is an excluded member of the list,
+        ``False`` if it is an included one, and ``None`` if it isn't one.
+        """
+        try:
+            return self.lookups[value]
+        except KeyError:
+            pass
+
+        excluded = list(SwitchMember.objects.filter(
+            switch_key=self.key,
+            namespace=self.namespace,
+            field_name=self.field_name,
+            value=value,
+        ).values_list('exclude', flat=True)[:1]) or [None]
+
+        if len(self.lookups) >= self.max_lookups:
+            self.lookups.clear()
+        self.lookups[value] = excluded[0]
+        return excluded[0]
+
+    def is_active(self, value):
+        """
+        Returns ``False`` if ``value`` is excluded (by the list or any other
+        condition), ``True`` if it is included, and ``None`` otherwise.
+        """
+        return_value = None
+        if self.compiled is not None:
+            return_value = self.compiled.is_active(value)
+            if return_value is False:
+                return False
+
+        if isinstance(value, basestring) and value in self.filter:
+            excluded = self.lookup(value)
+            if excluded:
+                return False
+            elif excluded is not None:
+                return_value = True
+        return return_value
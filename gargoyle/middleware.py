@@ -0,0 +1,31 @@
+"""
+gargoyle.middleware
+~~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from django.conf import settings
+
+from gargoyle import gargoyle
+
+
+class SwitchCacheMiddleware(object):
+    """
+    Memoizes ``gargoyle.is_active`` results for the duration of each request,
+    so checking the same switch several times while rendering a page only
+    evaluates it once.
+
+    The number of results kept per request is bounded by
+    ``GARGOYLE_REQUEST_CACHE_SIZE`` (defaults to 1000).
+    """
+    def __init__(self, gargoyle=gargoyle):
+        self.gargoyle = gargoyle
+
+    def process_request(self, request):
+        self.gargoyle.enable_request_cache(getattr(settings, 'GARGOYLE_REQUEST_CACHE_SIZE', 1000))
+
+    def process_response(self, request, response):
+        self.gargoyle.disable_request_cache()
+        return response
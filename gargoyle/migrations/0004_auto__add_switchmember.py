@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+
+        # Adding model 'SwitchMember'
+        db.create_table('gargoyle_switchmember', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('switch_key', self.gf('django.db.models.fields.CharField')(max_length=64)),
+            ('namespace', self.gf('django.db.models.fields.CharField')(max_length=64)),
+            ('field_name', self.gf('django.db.models.fields.CharField')(max_length=64)),
+            ('value', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('exclude', self.gf('django.db.models.fields.BooleanField')(default=False)),
+        ))
+        db.send_create_signal('gargoyle', ['SwitchMember'])
+
+        # Adding unique constraint on 'SwitchMember', fields ['switch_key', 'namespace', 'field_name', 'value']
+        db.create_unique('gargoyle_switchmember', ['switch_key', 'namespace', 'field_name', 'value'])
+
+    def backwards(self, orm):
+
+        # Removing unique constraint on 'SwitchMember', fields ['switch_key', 'namespace', 'field_name', 'value']
+        db.delete_unique('gargoyle_switchmember', ['switch_key', 'namespace', 'field_name', 'value'])
+
+        # Deleting model 'SwitchMember'
+        db.delete_table('gargoyle_switchmember')
+
+    models = {
+        'gargoyle.switch': {
+            'Meta': {'object_name': 'Switch'},
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'date_modified': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'description': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '64', 'primary_key': 'True'}),
+            'label': ('django.db.models.fields.CharField', [], {'max_length': '64', 'null': 'True'}),
+            'status': ('django.db.models.fields.PositiveSmallIntegerField', [], {'default': '1'}),
+            'value': ('jsonfield.fields.JSONField', [], {'default': "'{}'"})
+        },
+        'gargoyle.switchmember': {
+            'Meta': {'unique_together': "(('switch_key', 'namespace', 'field_name', 'value'),)", 'object_name': 'SwitchMember'},
+            'exclude': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'field_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'namespace': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'switch_key': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'value': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        }
+    }
+
+    complete_apps = ['gargoyle']
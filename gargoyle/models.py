@@ -6,7 +6,8 @@ gargoyle.models
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 try:
@@ -25,6 +26,13 @@ INHERIT = 4
 INCLUDE = 'i'
 EXCLUDE = 'e'
 
+#: The key of ``Switch.value`` holding the filters of membership lists, by
+#: namespace and then by field.
+MEMBERS = '__members__'
+
+#: The number of rows written or deleted at once by membership list changes.
+MEMBERS_BATCH_SIZE = 100
+
 
 class Switch(models.Model):
     """
@@ -104,6 +112,7 @@ class Switch(models.Model):
             'date_modified': self.date_modified,
             'date_created': self.date_created,
             'conditions': [],
+            'members': [],
         }
 
         last = None
@@ -122,6 +131,14 @@ class Switch(models.Model):
         if last:
             data['conditions'].append(last)
 
+        for condition_set_id, field_name, count in self.get_member_counts(manager):
+            data['members'].append({
+                'id': condition_set_id,
+                'label': manager.get_condition_set_by_id(condition_set_id).get_group_label(),
+                'field': field_name,
+                'count': count,
+            })
+
         return data
 
     def add_condition(self, manager, condition_set, field_name, condition, exclude=False, commit=True):
@@ -146,10 +163,113 @@ class Switch(models.Model):
             self.value[namespace][field_name] = []
         if condition not in self.value[namespace][field_name]:
             self.value[namespace][field_name].append((exclude and EXCLUDE or INCLUDE, condition))
+            self.date_modified = now()
 
         if commit:
             self.save()
 
+    def add_conditions(self, manager, condition_set, field_name, conditions, exclude=False, commit=True):
+        """
+        Adds each of ``conditions`` to a field, saving the switch once.
+        Conditions the field already has are moved to ``exclude``. Returns
+        the conditions which were added or moved.
+
+        If ``commit`` is ``False``, the data will not be written to the database.
+
+        >>> switch = gargoyle['my_switch'] #doctest: +SKIP
+        >>> switch.add_conditions(condition_set_id, 'username', ['alice', 'bob']) #doctest: +SKIP
+        """
+        condition_set = manager.get_condition_set_by_id(condition_set)
+
+        for condition in conditions:
+            assert isinstance(condition, basestring), 'conditions must be strings'
+
+        namespace = condition_set.get_namespace()
+        status = exclude and EXCLUDE or INCLUDE
+
+        field_conditions = self.value.get(namespace, {}).get(field_name, [])
+        existing = dict((c[1], c[0]) for c in field_conditions)
+        changed = []
+        for condition in conditions:
+            if existing.get(condition) != status:
+                existing[condition] = status
+                changed.append(condition)
+
+        if changed:
+            changed_set = set(changed)
+            field_conditions = [c for c in field_conditions if c[1] not in changed_set]
+            field_conditions.extend([(status, condition) for condition in changed])
+            self._set_field_conditions(namespace, field_name, field_conditions)
+            self.date_modified = now()
+
+            if commit:
+                self.save()
+        return changed
+
+    def remove_conditions(self, manager, condition_set, field_name, conditions, commit=True):
+        """
+        Removes each of ``conditions`` from a field, saving the switch once.
+        Returns the conditions which were removed.
+
+        If ``commit`` is ``False``, the data will not be written to the database.
+
+        >>> switch = gargoyle['my_switch'] #doctest: +SKIP
+        >>> switch.remove_conditions(condition_set_id, 'username', ['alice', 'bob']) #doctest: +SKIP
+        """
+        condition_set = manager.get_condition_set_by_id(condition_set)
+        namespace = condition_set.get_namespace()
+
+        conditions = set(conditions)
+        field_conditions = self.value.get(namespace, {}).get(field_name, [])
+        removed = [c[1] for c in field_conditions if c[1] in conditions]
+
+        if removed:
+            self._set_field_conditions(namespace, field_name, [c for c in field_conditions if c[1] not in conditions])
+            self.date_modified = now()
+
+            if commit:
+                self.save()
+        return removed
+
+    def replace_conditions(self, manager, condition_set, field_name, conditions, exclude=False, commit=True):
+        """
+        Replaces every condition of a field with ``conditions``, saving the
+        switch once.
+
+        If ``commit`` is ``False``, the data will not be written to the database.
+
+        >>> switch = gargoyle['my_switch'] #doctest: +SKIP
+        >>> switch.replace_conditions(condition_set_id, 'username', ['alice', 'bob']) #doctest: +SKIP
+        """
+        condition_set = manager.get_condition_set_by_id(condition_set)
+
+        for condition in conditions:
+            assert isinstance(condition, basestring), 'conditions must be strings'
+
+        namespace = condition_set.get_namespace()
+        status = exclude and EXCLUDE or INCLUDE
+
+        seen = set()
+        field_conditions = []
+        for condition in conditions:
+            if condition not in seen:
+                seen.add(condition)
+                field_conditions.append((status, condition))
+
+        self._set_field_conditions(namespace, field_name, field_conditions)
+        self.date_modified = now()
+
+        if commit:
+            self.save()
+
+    def _set_field_conditions(self, namespace, field_name, field_conditions):
+        if field_conditions:
+            self.value.setdefault(namespace, {})[field_name] = field_conditions
+        elif field_name in self.value.get(namespace, {}):
+            del self.value[namespace][field_name]
+            if not self.value[namespace]:
+                del self.value[namespace]
+
     def remove_condition(self, manager, condition_set, field_name, condition, commit=True):
         """
         Removes a condition and updates the global ``gargoyle`` switch manager.
@@ -178,6 +298,8 @@ class Switch(models.Model):
             if not self.value[namespace]:
                 del self.value[namespace]
 
+        self.date_modified = now()
+
         if commit:
             self.save()
 
@@ -213,9 +335,194 @@ class Switch(models.Model):
         else:
             del self.value[namespace][field_name]
 
+        self.date_modified = now()
+
         if commit:
             self.save()
 
+    def add_members(self, manager, condition_set, field_name, values, exclude=False):
+        """
+        Adds ``values`` to the membership list of a field, and saves the
+        switch. Members match values equal to them, like conditions of the
+        field, but are stored as ``SwitchMember`` rows: the switch only keeps
+        a compact filter of them, so it stays small however long the list
+        grows. Values already in the list are moved to ``exclude``.
+
+        >>> switch = gargoyle['my_switch'] #doctest: +SKIP
+        >>> switch.add_members(condition_set_id, 'username', beta_usernames) #doctest: +SKIP
+        """
+        condition_set = manager.get_condition_set_by_id(condition_set)
+        namespace = condition_set.get_namespace()
+        self._check_members_field(condition_set, field_name)
+
+        values = list(set(values))
+        for value in values:
+            assert isinstance(value, basestring), 'members must be strings'
+
+        members = SwitchMember.objects.filter(switch_key=self.key, namespace=namespace, field_name=field_name)
+        added = []
+        with transaction.commit_on_success():
+            for i in xrange(0, len(values), MEMBERS_BATCH_SIZE):
+                batch = values[i:i + MEMBERS_BATCH_SIZE]
+                existing = set(members.filter(value__in=batch).values_list('value', flat=True))
+                if existing:
+                    members.filter(value__in=existing).exclude(exclude=exclude).update(exclude=exclude)
+                new = [v for v in batch if v not in existing]
+                SwitchMember.objects.bulk_create([
+                    SwitchMember(switch_key=self.key, namespace=namespace, field_name=field_name,
+                                 value=value, exclude=exclude)
+                    for value in new
+                ])
+                added.extend(new)
+
+            data = self.value.get(MEMBERS, {}).get(namespace, {}).get(field_name)
+            if data is None or data['count'] + len(added) > data['capacity']:
+                self._rebuild_members(namespace, field_name)
+            elif added:
+                from gargoyle.members import BloomFilter
+
+                bloom_filter = BloomFilter.from_dict(data['filter'])
+                for value in added:
+                    bloom_filter.add(value)
+                data['filter'] = bloom_filter.to_dict()
+                data['count'] += len(added)
+
+            self.date_modified = now()
+            self.save()
+
+    def replace_members(self, manager, condition_set, field_name, values, exclude=False):
+        """
+        Replaces the membership list of a field with ``values``, and saves the
+        switch.
+
+        >>> switch = gargoyle['my_switch'] #doctest: +SKIP
+        >>> switch.replace_members(condition_set_id, 'username', beta_usernames) #doctest: +SKIP
+        """
+        condition_set = manager.get_condition_set_by_id(condition_set)
+        namespace = condition_set.get_namespace()
+        self._check_members_field(condition_set, field_name)
+
+        values = list(set(values))
+        for value in values:
+            assert isinstance(value, basestring), 'members must be strings'
+
+        members = SwitchMember.objects.filter(switch_key=self.key, namespace=namespace, field_name=field_name)
+        with transaction.commit_on_success():
+            members.delete()
+            for i in xrange(0, len(values), MEMBERS_BATCH_SIZE):
+                SwitchMember.objects.bulk_create([
+                    SwitchMember(switch_key=self.key, namespace=namespace, field_name=field_name,
+                                 value=value, exclude=exclude)
+                    for value in values[i:i + MEMBERS_BATCH_SIZE]
+                ])
+
+            self._rebuild_members(namespace, field_name)
+            self.date_modified = now()
+            self.save()
+
+    def remove_members(self, manager, condition_set, field_name, values):
+        """
+        Removes ``values`` from the membership list of a field, and saves the
+        switch.
+
+        >>> switch = gargoyle['my_switch'] #doctest: +SKIP
+        >>> switch.remove_members(condition_set_id, 'username', ['alice']) #doctest: +SKIP
+        """
+        condition_set = manager.get_condition_set_by_id(condition_set)
+        namespace = condition_set.get_namespace()
+
+        values = list(values)
+        members = SwitchMember.objects.filter(switch_key=self.key, namespace=namespace, field_name=field_name)
+        with transaction.commit_on_success():
+            for i in xrange(0, len(values), MEMBERS_BATCH_SIZE):
+                members.filter(value__in=values[i:i + MEMBERS_BATCH_SIZE]).delete()
+
+            # filters can't forget values, so they are rebuilt
+            self._rebuild_members(namespace, field_name)
+            self.date_modified = now()
+            self.save()
+
+    def clear_members(self, manager, condition_set, field_name=None):
+        """
+        Clears the membership lists of a condition set, or of one of its
+        fields, and saves the switch.
+
+        >>> switch = gargoyle['my_switch'] #doctest: +SKIP
+        >>> switch.clear_members(condition_set_id, 'username') #doctest: +SKIP
+        """
+        condition_set = manager.get_condition_set_by_id(condition_set)
+        namespace = condition_set.get_namespace()
+
+        members = SwitchMember.objects.filter(switch_key=self.key, namespace=namespace)
+        namespace_members = self.value.get(MEMBERS, {}).get(namespace, {})
+        if field_name:
+            members = members.filter(field_name=field_name)
+            namespace_members.pop(field_name, None)
+        else:
+            namespace_members.clear()
+        self._clean_members(namespace)
+
+        with transaction.commit_on_success():
+            members.delete()
+            self.date_modified = now()
+            self.save()
+
+    def get_member_counts(self, manager):
+        """
+        Returns a list of ``(condition set id, field name, count)`` tuples,
+        one for each membership list of the switch.
+        """
+        counts = []
+        members = self.value.get(MEMBERS, {})
+        for condition_set in manager.get_condition_sets():
+            for field_name, data in sorted(members.get(condition_set.get_namespace(), {}).iteritems()):
+                counts.append((condition_set.get_id(), field_name, data['count']))
+        return counts
+
+    def _check_members_field(self, condition_set, field_name):
+        """
+        Raises ``ValueError`` unless ``field_name`` is a field of
+        ``condition_set`` which matches values equal to its conditions, as
+        only those can match the strings of a membership list.
+        """
+        field = condition_set.fields.get(field_name)
+        if field is None or not field.matches_equal_values():
+            raise ValueError('%r of %s does not support membership lists' % (field_name, condition_set.get_id()))
+
+    def _rebuild_members(self, namespace, field_name):
+        """
+        Rebuilds the filter of a membership list from its rows.
+        """
+        from gargoyle.members import BloomFilter
+
+        members = SwitchMember.objects.filter(switch_key=self.key, namespace=namespace, field_name=field_name)
+        count = members.count()
+        if not count:
+            self.value.get(MEMBERS, {}).get(namespace, {}).pop(field_name, None)
+            self._clean_members(namespace)
+            return
+
+        # leave room for the list to double before it is rebuilt again
+        capacity = max(count * 2, 1000)
+        bloom_filter = BloomFilter.with_capacity(capacity)
+        for value in members.values_list('value', flat=True).iterator():
+            bloom_filter.add(value)
+
+        self.value.setdefault(MEMBERS, {}).setdefault(namespace, {})[field_name] = {
+            'count': count,
+            'capacity': capacity,
+            'filter': bloom_filter.to_dict(),
+        }
+
+    def _clean_members(self, namespace):
+        members = self.value.get(MEMBERS)
+        if members is None:
+            return
+        if not members.get(namespace, True):
+            del members[namespace]
+        if not members:
+            del self.value[MEMBERS]
+
     def get_active_conditions(self, manager):
         """
         Returns a generator which yields groups of lists of conditions.
@@ -242,3 +549,29 @@ class Switch(models.Model):
             status = self.status
 
         return self.STATUS_LABELS[status]
+
+
+class SwitchMember(models.Model):
+    """
+    A value of a switch's membership list for a field (such as the usernames
+    of a private beta). See ``Switch.add_members``.
+    """
+    switch_key = models.CharField(max_length=64)
+    namespace = models.CharField(max_length=64)
+    field_name = models.CharField(max_length=64)
+    value = models.CharField(max_length=255)
+    exclude = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = (('switch_key', 'namespace', 'field_name', 'value'),)
+        verbose_name = _('switch member')
+        verbose_name_plural = _('switch members')
+
+    def __unicode__(self):
+        return u"%s: %s.%s=%s" % (self.switch_key, self.namespace, self.field_name, self.value)
+
+
+def delete_members(sender, instance, **kwargs):
+    SwitchMember.objects.filter(switch_key=instance.key).delete()
+
+post_delete.connect(delete_members, sender=Switch)
@@ -0,0 +1,182 @@
+"""
+gargoyle.networks
+~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+
+HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+
+#: IPv4 addresses mapped into IPv6 (``::ffff:0:0/96``) are treated as IPv4.
+IPV4_MAPPED = 0xffff << 32
+
+
+def parse_address(value):
+    """
+    Parses an IPv4 or IPv6 address, returning it as a ``(bits, integer)``
+    tuple, where ``bits`` is 32 or 128. Raises ``ValueError`` if ``value``
+    isn't a valid address.
+    """
+    if not isinstance(value, basestring):
+        raise ValueError('%r is not an IP address' % (value,))
+
+    if ':' in value:
+        address = _parse_ipv6(value)
+        if address >> 32 == IPV4_MAPPED >> 32:
+            return 32, address & 0xffffffff
+        return 128, address
+    return 32, _parse_ipv4(value)
+
+
+def _parse_ipv4(value):
+    octets = value.split('.')
+    if len(octets) != 4:
+        raise ValueError('%r is not an IP address' % (value,))
+
+    address = 0
+    for octet in octets:
+        if not octet.isdigit() or int(octet) > 255:
+            raise ValueError('%r is not an IP address' % (value,))
+        address = address << 8 | int(octet)
+    return address
+
+
+def _parse_ipv6_groups(value, allow_ipv4):
+    if not value:
+        return []
+
+    parts = value.split(':')
+    groups = []
+    for i, part in enumerate(parts):
+        if allow_ipv4 and i == len(parts) - 1 and '.' in part:
+            address = _parse_ipv4(part)
+            groups.extend([address >> 16, address & 0xffff])
+        elif 0 < len(part) <= 4 and not set(part) - HEX_DIGITS:
+            groups.append(int(part, 16))
+        else:
+            raise ValueError('%r is not an IP address' % (value,))
+    return groups
+
+
+def _parse_ipv6(value):
+    # ignore any zone index (fe80::1%eth0)
+    address = value.split('%', 1)[0]
+
+    if address.count('::') > 1:
+        raise ValueError('%r is not an IP address' % (value,))
+
+    if '::' in address:
+        head, tail = address.split('::')
+        head = _parse_ipv6_groups(head, False)
+        tail = _parse_ipv6_groups(tail, True)
+        if len(head) + len(tail) > 7:
+            raise ValueError('%r is not an IP address' % (value,))
+        groups = head + [0] * (8 - len(head) - len(tail)) + tail
+    else:
+        groups = _parse_ipv6_groups(address, True)
+        if len(groups) != 8:
+            raise ValueError('%r is not an IP address' % (value,))
+
+    result = 0
+    for group in groups:
+        result = result << 16 | group
+    return result
+
+
+def parse_network(value):
+    """
+    Parses an IP network in CIDR notation (``10.0.0.0/8``) or a single IP
+    address, returning it as a ``(bits, prefix length, integer)`` tuple with
+    the host bits cleared. Raises ``ValueError`` if ``value`` isn't valid.
+    """
+    if isinstance(value, basestring) and '/' in value:
+        address, length = value.split('/', 1)
+        bits, parsed = parse_address(address)
+        if not length.isdigit():
+            raise ValueError('%r is not an IP network' % (value,))
+        length = int(length)
+        if bits == 32 and ':' in address:
+            # an IPv4-mapped network
+            length -= 96
+        if not 0 <= length <= bits:
+            raise ValueError('%r is not an IP network' % (value,))
+        address = parsed
+    else:
+        bits, address = parse_address(value)
+        length = bits
+    return bits, length, address >> (bits - length) << (bits - length)
+
+
+def format_network(network):
+    """
+    Returns the CIDR notation of a network returned by ``parse_network``.
+    Single addresses are formatted without a prefix length.
+    """
+    bits, length, address = network
+    if bits == 32:
+        formatted = '.'.join([str(address >> shift & 0xff) for shift in (24, 16, 8, 0)])
+    else:
+        formatted = _format_ipv6(address)
+    if length == bits:
+        return formatted
+    return '%s/%d' % (formatted, length)
+
+
+def _format_ipv6(address):
+    groups = [address >> shift & 0xffff for shift in range(112, -16, -16)]
+
+    # compress the longest run of two or more zero groups
+    best_start, best_length = None, 1
+    start = None
+    for i, group in enumerate(groups + [None]):
+        if group == 0:
+            if start is None:
+                start = i
+        elif start is not None:
+            if i - start > best_length:
+                best_start, best_length = start, i - start
+            start = None
+
+    hexed = ['%x' % group for group in groups]
+    if best_start is None:
+        return ':'.join(hexed)
+    return '%s::%s' % (':'.join(hexed[:best_start]), ':'.join(hexed[best_start + best_length:]))
+
+
+class NetworkSet(object):
+    """
+    A set of IP networks, which can be tested for the addresses they contain.
+
+    Networks are kept in one hash set per prefix length, so checking an
+    address costs one lookup for each distinct prefix length in the set,
+    however many networks it holds.
+    """
+    def __init__(self, networks=()):
+        self.prefixes = {}
+        for network in networks:
+            self.add(network)
+
+    def __len__(self):
+        return sum([len(p) for p in self.prefixes.itervalues()])
+
+    def __contains__(self, address):
+        """
+        Returns ``True`` if ``address``, as returned by ``parse_address``,
+        belongs to one of the networks.
+        """
+        bits, address = address
+        for (prefix_bits, length), prefixes in self.prefixes.iteritems():
+            if prefix_bits == bits and address >> (bits - length) in prefixes:
+                return True
+        return False
+
+    def add(self, network):
+        """
+        Adds a network, either as a string or as returned by ``parse_network``.
+        """
+        if not isinstance(network, tuple):
+            network = parse_network(network)
+        bits, length, address = network
+        self.prefixes.setdefault((bits, length), set()).add(address >> (bits - length))
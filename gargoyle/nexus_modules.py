@@ -6,6 +6,7 @@ gargoyle.nexus_modules
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
+import csv
 import logging
 import nexus
 import os.path
@@ -13,13 +14,15 @@ import os.path
 from functools import wraps
 
 from django.conf import settings
+from django.db import transaction
 from django.http import HttpResponse, HttpResponseNotFound
 
 from gargoyle import gargoyle, autodiscover
 from gargoyle.helpers import dumps
-from gargoyle.models import Switch, DISABLED
+from gargoyle.models import Switch, SwitchMember, DISABLED
 from gargoyle.conditions import ValidationError
 from gargoyle import signals
+from gargoyle.stats import percentile
 
 
 GARGOYLE_ROOT = os.path.dirname(__file__)
@@ -88,6 +91,8 @@ class GargoyleModule(nexus.NexusModule):
                                url(r'^status/$', self.as_view(self.status), name='status'),
                                url(r'^conditions/add/$', self.as_view(self.add_condition), name='add-condition'),
                                url(r'^conditions/remove/$', self.as_view(self.remove_condition), name='remove-condition'),
+                               url(r'^conditions/bulk/$', self.as_view(self.bulk_conditions), name='bulk-conditions'),
+                               url(r'^stats/$', self.as_view(self.stats), name='stats'),
                                url(r'^$', self.as_view(self.index), name='index'),
                                )
 
@@ -117,6 +122,50 @@ class GargoyleModule(nexus.NexusModule):
             "sorted_by": sort_by
         }, request)
 
+    def stats(self, request):
+        """
+        Lists every switch with the statistics this process recorded for it,
+        most checked first; switches which were never checked come last.
+        """
+        stats = gargoyle.stats()
+        switch_stats = stats['switches']
+
+        rows = []
+        keys = set()
+        for switch in Switch.objects.all():
+            keys.add(switch.key)
+            rows.append(self._get_stats_row(switch.key, switch, switch_stats.get(switch.key)))
+        # keys which were checked, but have no switch (e.g. deleted ones)
+        for key, key_stats in switch_stats.iteritems():
+            if key not in keys:
+                rows.append(self._get_stats_row(key, None, key_stats))
+        rows.sort(key=lambda row: (-row['calls'], row['key']))
+
+        return self.render_to_response("gargoyle/stats.html", {
+            "enabled": gargoyle.stats_enabled,
+            "rows": rows,
+            "request_cache": stats['request_cache'],
+            "store": stats['store'],
+        }, request)
+
+    def _get_stats_row(self, key, switch, key_stats):
+        row = {
+            'key': key,
+            'switch': switch,
+            'calls': 0,
+        }
+        if key_stats:
+            calls = key_stats['calls']
+            row.update({
+                'calls': calls,
+                'active': key_stats['active'],
+                'active_percent': 100 * key_stats['active'] // calls,
+                'mean_usec': key_stats['total_usec'] / calls,
+                'p50_usec': percentile(key_stats['histogram'], 0.5),
+                'p99_usec': percentile(key_stats['histogram'], 0.99),
+            })
+        return row
+
     def add(self, request):
         key = request.POST.get("key")
 
@@ -174,19 +223,23 @@ class GargoyleModule(nexus.NexusModule):
         )
 
         changes = {}
-        for key, value in values.iteritems():
-            new_value = getattr(switch, key)
+        for name, value in values.iteritems():
+            new_value = getattr(switch, name)
             if new_value != value:
-                changes[key] = (value, new_value)
+                changes[name] = (value, new_value)
 
         if changes:
-            if switch.key != key:
-                switch.delete()
-                switch.key = key
-
-            switch.label = label
-            switch.description = request.POST.get("desc")
-            switch.save()
+            with transaction.commit_on_success():
+                if switch.key != key:
+                    # members are moved to the new key first, so that
+                    # deleting the old switch doesn't delete them
+                    SwitchMember.objects.filter(switch_key=switch.key).update(switch_key=key)
+                    switch.delete()
+                    switch.key = key
+
+                switch.label = label
+                switch.description = request.POST.get("desc")
+                switch.save()
 
             logger.info('Switch %r updated %%s' % switch.key,
                         ', '.join('%s=%r->%r' % (k, v[0], v[1]) for k, v in sorted(changes.iteritems())))
@@ -306,6 +359,113 @@ class GargoyleModule(nexus.NexusModule):
         return switch.to_dict(gargoyle)
     remove_condition = json(remove_condition)
 
+    def bulk_conditions(self, request):
+        """
+        Adds, removes or replaces (depending on ``action``) many conditions
+        of a field at once, or the members of its membership list if
+        ``members`` is set. Values are given one per line in ``values``, or
+        in the first column of an uploaded CSV ``file``. They are all
+        validated before the switch is saved, once.
+        """
+        key = request.POST.get("key")
+        condition_set_id = request.POST.get("id")
+        field_name = request.POST.get("field")
+        action = request.POST.get("action") or "add"
+        exclude = bool(int(request.POST.get("exclude") or 0))
+        members = bool(int(request.POST.get("members") or 0))
+
+        if not all([key, condition_set_id, field_name]):
+            raise GargoyleException("Fields cannot be empty")
+
+        if action not in ("add", "remove", "replace"):
+            raise GargoyleException("Action must be one of add, remove or replace")
+
+        field = gargoyle.get_condition_set_by_id(condition_set_id).fields[field_name]
+        values = self._clean_bulk_values(field, self._get_bulk_values(request), members)
+
+        # each of these saves the switch in a transaction of its own
+        switch = gargoyle[key]
+        if action == "remove":
+            if members:
+                switch.remove_members(condition_set_id, field_name, values)
+            else:
+                switch.remove_conditions(condition_set_id, field_name, values)
+        elif action == "add":
+            if members:
+                switch.add_members(condition_set_id, field_name, values, exclude=exclude)
+            else:
+                switch.add_conditions(condition_set_id, field_name, values, exclude=exclude)
+        elif members:
+            switch.replace_members(condition_set_id, field_name, values, exclude=exclude)
+        else:
+            switch.replace_conditions(condition_set_id, field_name, values, exclude=exclude)
+
+        logger.info('Conditions updated on %r (%s %d values, %r, %s, exclude=%r, members=%r)' % (switch.key,
+                    action, len(values), condition_set_id, field_name, exclude, members))
+
+        signals.switch_conditions_updated.send(
+            sender=self,
+            request=request,
+            switch=switch,
+            action=action,
+            conditions={
+                'condition_set_id': condition_set_id,
+                'field_name': field_name,
+                'values': values,
+                'exclude': exclude,
+                'members': members,
+            },
+        )
+
+        return switch.to_dict(gargoyle)
+    bulk_conditions = json(bulk_conditions)
+
+    def _get_bulk_values(self, request):
+        values = [line.strip() for line in request.POST.get("values", "").splitlines()]
+
+        upload = request.FILES.get("file")
+        if upload is not None:
+            try:
+                for row in csv.reader(upload):
+                    if row:
+                        values.append(row[0].decode('utf-8').strip())
+            except (csv.Error, UnicodeDecodeError), e:
+                raise GargoyleException("Could not read the uploaded file: %s" % e)
+
+        seen = set()
+        unique = []
+        for value in values:
+            if value and value not in seen:
+                seen.add(value)
+                unique.append(value)
+
+        if not unique:
+            raise GargoyleException("No values were given")
+        return unique
+
+    def _clean_bulk_values(self, field, values, members=False):
+        if members and not field.matches_equal_values():
+            raise GargoyleException("%s does not support membership lists" % field.label)
+
+        max_length = SwitchMember._meta.get_field('value').max_length
+        cleaned = []
+        invalid = []
+        for value in values:
+            try:
+                value = field.clean(value)
+            except ValidationError:
+                invalid.append(value)
+                continue
+            if members and len(value) > max_length:
+                invalid.append(value)
+            else:
+                cleaned.append(value)
+
+        if invalid:
+            raise GargoyleException("%d invalid values: %s%s" % (
+                len(invalid), ', '.join(invalid[:10]), len(invalid) > 10 and ', ...' or ''))
+        return cleaned
+
     @property
     def valid_sort_orders(self):
         fields = ['label', 'date_created', 'date_modified']
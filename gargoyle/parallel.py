@@ -0,0 +1,204 @@
+"""
+gargoyle.parallel
+~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import os
+import random
+import time
+from multiprocessing import Pool
+
+from django.db import connections
+from django.db.models import Min, Max
+
+from gargoyle.manager import SwitchManager
+from gargoyle.models import Switch
+
+
+class Snapshot(object):
+    """
+    A frozen copy of a switch, its parents and the registered condition sets,
+    which can be sent to worker processes and evaluated there without reading
+    switches from the database or the cache.
+    """
+    def __init__(self, manager, key):
+        self.key = key
+        self.switches = {}
+        parts = key.split(':')
+        for i in xrange(1, len(parts) + 1):
+            parent_key = ':'.join(parts[:i])
+            switch = manager._get_switch(parent_key)
+            if switch is not None:
+                self.switches[parent_key] = switch
+        self.condition_sets = list(manager.get_condition_sets())
+        self.overrides = dict(manager._overrides)
+
+    def get_manager(self):
+        """
+        Returns a ``SwitchManager`` which only knows about the snapshot's
+        switches, and never revalidates them.
+        """
+        manager = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=False,
+                                snapshot_timeout=0)
+        for condition_set in self.condition_sets:
+            manager.register(condition_set)
+        manager._overrides = self.overrides
+        manager._cache = self.switches
+        manager._last_updated = int(time.time())
+        manager._snapshot_expires = float('inf')
+        return manager
+
+
+def get_ranges(queryset, chunks):
+    """
+    Splits the primary keys of ``queryset`` into at most ``chunks`` ranges of
+    equal width, as ``(lower, upper)`` pairs including ``lower`` and
+    excluding ``upper``. Primary keys must be integers.
+    """
+    bounds = queryset.aggregate(lower=Min('pk'), upper=Max('pk'))
+    lower, upper = bounds['lower'], bounds['upper']
+    if lower is None:
+        return []
+
+    upper += 1
+    size = max((upper - lower + chunks - 1) // chunks, 1)
+    return [(start, min(start + size, upper)) for start in xrange(lower, upper, size)]
+
+
+# The switch being evaluated by a worker process, as ``(key, manager)``
+_worker_switch = None
+
+
+def _close_connections():
+    """
+    Closes the database connections of this process, so that worker
+    processes forked afterwards don't inherit (and, when they exit, close)
+    the same sockets; each process opens its own connection when it next
+    needs one. SQLite connections hold no server state and are kept (which
+    in-memory databases rely on).
+    """
+    for connection in connections.all():
+        if connection.vendor != 'sqlite':
+            connection.close()
+
+
+def _init_worker(snapshot):
+    global _worker_switch
+    _worker_switch = (snapshot.key, snapshot.get_manager())
+
+
+def _evaluate_range(args):
+    """
+    Evaluates the worker's switch for each object of ``model`` matching
+    ``query``, with a primary key between ``lower`` and ``upper``. Returns the
+    number of objects it is active for, writing their primary keys to
+    ``path`` (one per line) if it is given.
+    """
+    model, query, using, lower, upper, path = args
+    key, manager = _worker_switch
+
+    # querysets are evaluated when pickled, so only their query is sent
+    queryset = model._default_manager.using(using).all()
+    queryset.query = query
+    queryset = queryset.filter(pk__gte=lower, pk__lt=upper).order_by('pk')
+    count = 0
+    fp = path and open(path, 'w')
+    try:
+        for obj in queryset.iterator():
+            if manager.is_active(key, obj):
+                count += 1
+                if fp:
+                    fp.write('%s\n' % (obj.pk,))
+    finally:
+        if fp:
+            fp.close()
+    return count
+
+
+def evaluate(audience, processes=None, chunks=None, path=None):
+    """
+    Counts the objects of ``audience`` with a pool of ``processes`` worker
+    processes (by default, one per CPU), each evaluating a snapshot of the
+    switch over ranges of primary keys. The queryset is split into
+    ``chunks`` ranges (by default, four per process).
+
+    The database connections of the calling process are closed before the
+    workers are started, so it must not be inside a transaction.
+
+    If ``path`` is given, the primary keys of the audience are written to it,
+    one per line and in order.
+    """
+    if processes is None:
+        from multiprocessing import cpu_count
+        processes = cpu_count()
+    if chunks is None:
+        chunks = processes * 4
+
+    snapshot = Snapshot(audience.manager, audience.key)
+    ranges = get_ranges(audience.base_queryset, chunks)
+    paths = [None] * len(ranges)
+    if path is not None:
+        paths = ['%s.%d' % (path, i) for i in xrange(len(ranges))]
+
+    queryset = audience.base_queryset
+    tasks = [(queryset.model, queryset.query, queryset.db, lower, upper, range_path)
+             for (lower, upper), range_path in zip(ranges, paths)]
+
+    _close_connections()
+    pool = Pool(processes, _init_worker, (snapshot,))
+    try:
+        counts = pool.map(_evaluate_range, tasks, 1)
+    finally:
+        pool.terminate()
+
+    if path is not None:
+        fp = open(path, 'w')
+        try:
+            for range_path in paths:
+                part = open(range_path)
+                try:
+                    for line in part:
+                        fp.write(line)
+                finally:
+                    part.close()
+                os.unlink(range_path)
+        finally:
+            fp.close()
+    return sum(counts)
+
+
+def estimate(audience, sample_size=1000, window=100):
+    """
+    Estimates the size of ``audience`` from a sample of about ``sample_size``
+    objects, read in windows of ``window`` consecutive primary keys starting
+    at random points (and wrapping around at the end of the table). Returns a
+    ``(estimate, sampled, matched)`` tuple.
+    """
+    queryset = audience.base_queryset
+    total = queryset.count()
+    if not total:
+        return 0, 0, 0
+
+    bounds = queryset.aggregate(lower=Min('pk'), upper=Max('pk'))
+    manager = Snapshot(audience.manager, audience.key).get_manager()
+    seen = set()
+    sampled = matched = 0
+    for i in xrange(max(sample_size // window, 1)):
+        start = random.randint(bounds['lower'], bounds['upper'])
+        objs = list(queryset.filter(pk__gte=start).order_by('pk')[:window])
+        if len(objs) < window:
+            # wrap around to the start of the table
+            objs.extend(queryset.filter(pk__lt=start).order_by('pk')[:window - len(objs)])
+        for obj in objs:
+            if obj.pk in seen:
+                continue
+            seen.add(obj.pk)
+            sampled += 1
+            if manager.is_active(audience.key, obj):
+                matched += 1
+        if sampled >= total:
+            break
+    return int(round(float(matched) / sampled * total)), sampled, matched
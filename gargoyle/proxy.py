@@ -1,28 +1,43 @@
+def _call_with_manager(name, changes_switch=True):
+    """
+    Returns a method which calls the switch's method ``name`` with the
+    manager, and resets the manager's tree if it ``changes_switch``.
+    """
+    def method(self, *args, **kwargs):
+        result = getattr(self._switch, name)(self._manager, *args, **kwargs)
+        if changes_switch:
+            self._manager.clear_tree()
+        return result
+    method.__name__ = name
+    return method
+
+
 class SwitchProxy(object):
+    __slots__ = ('_switch', '_manager')
+
     def __init__(self, manager, switch):
-        self._switch = switch
-        self._manager = manager
+        object.__setattr__(self, '_switch', switch)
+        object.__setattr__(self, '_manager', manager)
 
     def __getattr__(self, attr):
-        if attr in self.__dict__:
-            return self.__dict__[attr]
-        else:
-            return getattr(self._switch, attr)
+        return getattr(self._switch, attr)
 
     def __setattr__(self, attr, value):
-        if attr in ('_switch', '_manager'):
+        if attr in self.__slots__:
             object.__setattr__(self, attr, value)
         else:
             setattr(self._switch, attr, value)
+            self._manager.clear_tree()
 
-    def add_condition(self, *args, **kwargs):
-        return self._switch.add_condition(self._manager, *args, **kwargs)
-
-    def remove_condition(self, *args, **kwargs):
-        return self._switch.remove_condition(self._manager, *args, **kwargs)
-
-    def clear_conditions(self, *args, **kwargs):
-        return self._switch.clear_conditions(self._manager, *args, **kwargs)
-
-    def get_active_conditions(self, *args, **kwargs):
-        return self._switch.get_active_conditions(self._manager, *args, **kwargs)
+    add_condition = _call_with_manager('add_condition')
+    remove_condition = _call_with_manager('remove_condition')
+    clear_conditions = _call_with_manager('clear_conditions')
+    add_conditions = _call_with_manager('add_conditions')
+    remove_conditions = _call_with_manager('remove_conditions')
+    replace_conditions = _call_with_manager('replace_conditions')
+    add_members = _call_with_manager('add_members')
+    replace_members = _call_with_manager('replace_members')
+    remove_members = _call_with_manager('remove_members')
+    clear_members = _call_with_manager('clear_members')
+    get_member_counts = _call_with_manager('get_member_counts', changes_switch=False)
+    get_active_conditions = _call_with_manager('get_active_conditions', changes_switch=False)
@@ -67,3 +67,62 @@ switch_condition_added = django.dispatch.Signal(providing_args=["request", "swit
 #:      from gargoyle.signals import switch_condition_deleted
 #:      switch_condition_deleted.connect(switch_condition_deleted_callback)
 switch_condition_removed = django.dispatch.Signal(providing_args=["request", "switch", "condition"])
+
+#: This signal is sent once when the conditions (or membership list) of a
+#: switch's field are edited in bulk, instead of a ``switch_condition_added``
+#: or ``switch_condition_removed`` signal per value. ``action`` is ``add``,
+#: ``remove`` or ``replace``, and ``conditions`` is a dictionary with the
+#: ``condition_set_id``, ``field_name``, ``values``, ``exclude`` and
+#: ``members`` of the edit.
+#:
+#: Example subscriber::
+#:
+#:     def switch_conditions_updated_callback(sender, request, switch, action, conditions, **extra):
+#:         logging.debug('Switch has %s %d conditions: %r', action, len(conditions['values']), switch.label)
+#:
+#:     from gargoyle.signals import switch_conditions_updated
+#:     switch_conditions_updated.connect(switch_conditions_updated_callback)
+switch_conditions_updated = django.dispatch.Signal(providing_args=["request", "switch", "action", "conditions"])
+
+#: This signal is sent by a ``SwitchManager`` when it fetches the switches from
+#: the shared cache. ``hit`` is ``False`` if they weren't there, and
+#: ``duration`` is in seconds. When statistics are enabled and the fetch is
+#: sampled (see ``SwitchManager.payload_sample_interval``), ``size`` is the
+#: size of the payload in bytes and ``deserialize_duration`` the time taken to
+#: deserialize it; otherwise both are ``None``.
+#:
+#: Example subscriber::
+#:
+#:     def switches_cache_fetched_callback(sender, hit, duration, **extra):
+#:         statsd.timing('gargoyle.cache_fetch', duration * 1000)
+#:
+#:     from gargoyle.signals import switches_cache_fetched
+#:     switches_cache_fetched.connect(switches_cache_fetched_callback)
+switches_cache_fetched = django.dispatch.Signal(providing_args=["hit", "duration", "size", "deserialize_duration"])
+
+#: This signal is sent by a ``SwitchManager`` when it reloads every switch from
+#: the database. ``duration`` is in seconds, and ``count`` is the number of
+#: switches loaded.
+#:
+#: Example subscriber::
+#:
+#:     def switches_reloaded_callback(sender, duration, count, **extra):
+#:         statsd.timing('gargoyle.reload', duration * 1000)
+#:
+#:     from gargoyle.signals import switches_reloaded
+#:     switches_reloaded.connect(switches_reloaded_callback)
+switches_reloaded = django.dispatch.Signal(providing_args=["duration", "count"])
+
+#: This signal is sent by a ``SwitchManager`` when it applies the switches
+#: changed by other processes from the change log, rather than fetching all of
+#: them from the shared cache. ``duration`` is in seconds, and ``keys`` is the
+#: set of keys changed.
+#:
+#: Example subscriber::
+#:
+#:     def switches_patched_callback(sender, duration, keys, **extra):
+#:         statsd.incr('gargoyle.patched', len(keys))
+#:
+#:     from gargoyle.signals import switches_patched
+#:     switches_patched.connect(switches_patched_callback)
+switches_patched = django.dispatch.Signal(providing_args=["duration", "keys"])
@@ -0,0 +1,205 @@
+"""
+gargoyle.stats
+~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import threading
+import weakref
+
+from bisect import bisect_left
+
+#: Upper bounds (in microseconds) of the latency histogram's buckets. The
+#: last bucket counts everything slower.
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 50000)
+
+
+class SwitchStats(object):
+    """
+    Per-key call counts, active counts and latency histograms of switch
+    checks, and counters of how the switches were loaded.
+
+    Each thread records into its own dictionaries, so recording takes no
+    lock; the dictionaries are only combined when ``get_stats`` or
+    ``get_store_stats`` is called. Those of threads which have exited are
+    merged into a single pair of totals.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._finished = ({}, {})
+        self.last_payload = None
+
+    def _get_counters(self):
+        try:
+            return self._local.counters
+        except AttributeError:
+            counters = self._local.counters = {}
+            store = self._local.store = {}
+            self._lock.acquire()
+            try:
+                self._prune()
+                self._threads.append((weakref.ref(threading.current_thread()), counters, store))
+            finally:
+                self._lock.release()
+            return counters
+
+    def _prune(self):
+        """
+        Merges the dictionaries of threads which have exited into the totals
+        of finished threads. Must be called with the lock held.
+        """
+        finished_counters, finished_store = self._finished
+        alive = []
+        for thread_ref, counters, store in self._threads:
+            thread = thread_ref()
+            if thread is not None and thread.is_alive():
+                alive.append((thread_ref, counters, store))
+                continue
+
+            for key, (calls, active, total_usec, histogram) in counters.items():
+                try:
+                    counter = finished_counters[key]
+                except KeyError:
+                    counter = finished_counters[key] = [0, 0, 0.0, [0] * len(histogram)]
+                counter[0] += calls
+                counter[1] += active
+                counter[2] += total_usec
+                for i, count in enumerate(histogram):
+                    counter[3][i] += count
+            for name, value in store.items():
+                finished_store[name] = finished_store.get(name, 0) + value
+        self._threads = alive
+
+    def _get_store_counters(self):
+        try:
+            return self._local.store
+        except AttributeError:
+            self._get_counters()
+            return self._local.store
+
+    def count(self, name, amount=1):
+        """
+        Adds ``amount`` to the store counter ``name``.
+        """
+        store = self._get_store_counters()
+        store[name] = store.get(name, 0) + amount
+
+    def get_store_stats(self):
+        """
+        Returns the totals of the store counters: ``local_hits``,
+        ``version_checks``, ``cache_fetches``, ``cache_misses``,
+        ``cache_fetch_usec``, ``database_reloads``, ``database_reload_usec``,
+        ``change_refreshes`` and ``changed_switches``. ``payload_bytes`` and
+        ``deserialize_usec`` describe the last payload measured (see
+        ``SwitchManager.payload_sample_interval``).
+        """
+        stats = {
+            'local_hits': 0,
+            'version_checks': 0,
+            'cache_fetches': 0,
+            'cache_misses': 0,
+            'cache_fetch_usec': 0.0,
+            'database_reloads': 0,
+            'database_reload_usec': 0.0,
+            'change_refreshes': 0,
+            'changed_switches': 0,
+            'payload_bytes': None,
+            'deserialize_usec': None,
+        }
+        for counters, store in self._get_threads():
+            for name, value in store.items():
+                stats[name] = stats.get(name, 0) + value
+
+        if self.last_payload is not None:
+            stats['payload_bytes'], stats['deserialize_usec'] = self.last_payload
+        return stats
+
+    def _get_threads(self):
+        """
+        Returns the ``(counters, store)`` dictionaries of every live thread,
+        followed by the totals of finished threads.
+        """
+        self._lock.acquire()
+        try:
+            self._prune()
+            return [(counters, store) for thread_ref, counters, store in self._threads] + [self._finished]
+        finally:
+            self._lock.release()
+
+    def record(self, key, result, elapsed):
+        """
+        Records a check of ``key`` which returned ``result`` after
+        ``elapsed`` seconds.
+        """
+        try:
+            counters = self._local.counters
+        except AttributeError:
+            counters = self._get_counters()
+
+        usec = elapsed * 1e6
+        try:
+            counter = counters[key]
+        except KeyError:
+            # calls, active, total microseconds, histogram
+            counter = counters[key] = [0, 0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)]
+        counter[0] += 1
+        if result:
+            counter[1] += 1
+        counter[2] += usec
+        counter[3][bisect_left(LATENCY_BUCKETS, usec)] += 1
+
+    def get_stats(self):
+        """
+        Returns a dictionary mapping each key checked to its ``calls``,
+        ``active`` and ``inactive`` counts, ``total_usec`` and ``histogram``,
+        a list of ``(upper bound, count)`` pairs (the last bound is ``None``).
+        """
+        stats = {}
+        bounds = list(LATENCY_BUCKETS) + [None]
+        for counters, store in self._get_threads():
+            for key, (calls, active, total_usec, histogram) in counters.items():
+                try:
+                    key_stats = stats[key]
+                except KeyError:
+                    key_stats = stats[key] = {
+                        'calls': 0,
+                        'active': 0,
+                        'inactive': 0,
+                        'total_usec': 0.0,
+                        'histogram': [0] * len(bounds),
+                    }
+                key_stats['calls'] += calls
+                key_stats['active'] += active
+                key_stats['inactive'] += calls - active
+                key_stats['total_usec'] += total_usec
+                for i, count in enumerate(histogram):
+                    key_stats['histogram'][i] += count
+
+        for key_stats in stats.itervalues():
+            key_stats['histogram'] = zip(bounds, key_stats['histogram'])
+        return stats
+
+    def reset(self):
+        for counters, store in self._get_threads():
+            counters.clear()
+            store.clear()
+        self.last_payload = None
+
+
+def percentile(histogram, fraction):
+    """
+    Returns the upper bound of the bucket of ``histogram`` (as returned by
+    ``SwitchStats.get_stats``) which holds the given ``fraction`` of calls,
+    or ``None`` if it is the last, unbounded bucket.
+    """
+    total = sum([count for bound, count in histogram])
+    seen = 0
+    for bound, count in histogram:
+        seen += count
+        if seen >= total * fraction:
+            return bound
+    return None
@@ -34,8 +34,8 @@ class SwitchContextManager(object):
     """
     def __init__(self, gargoyle=gargoyle, **keys):
         self.gargoyle = gargoyle
-        self.is_active_func = gargoyle.is_active
         self.keys = keys
+        self._previous = {}
         self._state = {}
         self._values = {
             True: gargoyle.GLOBAL,
@@ -56,18 +56,15 @@ class SwitchContextManager(object):
         self.unpatch()
 
     def patch(self):
-        def is_active(gargoyle):
-            is_active_func = gargoyle.is_active
-
-            def wrapped(key, *args, **kwargs):
-                if key in self.keys:
-                    return self.keys[key]
-                return is_active_func(key, *args, **kwargs)
-            return wrapped
-
-        self.gargoyle.is_active = is_active(self.gargoyle)
+        previous = self.gargoyle.override(self.keys)
+        if previous:
+            # nested contexts keep the outer switches
+            overrides = previous.copy()
+            overrides.update(self.keys)
+            self.gargoyle.override(overrides)
+        self._previous = previous
 
     def unpatch(self):
-        self.gargoyle.is_active = self.is_active_func
+        self.gargoyle.override(self._previous)
 
 switches = SwitchContextManager
@@ -0,0 +1,100 @@
+"""
+gargoyle.tree
+~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from gargoyle.models import DISABLED, SELECTIVE, GLOBAL
+
+#: The result of a node which depends on the instances being checked.
+CONDITIONAL = object()
+
+
+class SwitchNode(object):
+    """
+    A switch key within a ``SwitchTree``.
+
+    ``state`` is the switch's own result when it doesn't depend on the
+    instances: ``True``, ``False``, or ``None`` when it defers to its parent.
+    ``result`` combines it with the states of every ancestor. Either may be
+    ``CONDITIONAL`` when the switch (or an ancestor) has conditions to check.
+    """
+    def __init__(self, key, switch, parent):
+        self.key = key
+        self.switch = switch
+        self.parent = parent
+
+        if switch is None:
+            self.state = None
+        elif switch.status == GLOBAL:
+            self.state = True
+        elif switch.status == DISABLED:
+            self.state = False
+        elif switch.status == SELECTIVE and switch.value:
+            self.state = CONDITIONAL
+        else:
+            # inherit, or selective without any conditions
+            self.state = None
+
+        if parent is None:
+            inherited = None
+        else:
+            inherited = parent.result
+
+        if inherited is False:
+            self.result = False
+        elif inherited is CONDITIONAL or self.state is CONDITIONAL:
+            self.result = CONDITIONAL
+        elif self.state is None:
+            self.result = inherited
+        else:
+            self.result = self.state
+
+
+class SwitchTree(object):
+    """
+    Every switch in a snapshot of switches, arranged by the ``parent:child``
+    structure of their keys.
+
+    If ``missing_ancestors`` is ``True``, ancestors which don't exist as
+    switches are included as nodes without a switch. Otherwise they (and
+    every switch below them) are left out, so that looking them up goes
+    through the manager, which may create them, unless they are below a
+    disabled switch and therefore never looked up.
+    """
+    def __init__(self, switches, missing_ancestors=True):
+        self.switches = switches
+        self.missing_ancestors = missing_ancestors
+        self.nodes = {}
+        for key in switches:
+            self.add(key)
+
+    def add(self, key):
+        """
+        Returns the node of ``key``, adding it and its ancestors to the tree
+        if needed, or ``None`` if it is left out of the tree.
+        """
+        try:
+            return self.nodes[key]
+        except KeyError:
+            pass
+
+        switch = self.switches.get(key)
+        if ':' in key:
+            parent = self.add(key.rsplit(':', 1)[0])
+            if parent is None:
+                return None
+        else:
+            parent = None
+
+        if switch is None and not self.missing_ancestors:
+            if parent is None or parent.result is not False:
+                return None
+
+        node = self.nodes[key] = SwitchNode(key, switch, parent)
+        return node
+
+    def get(self, key):
+        return self.nodes.get(key)
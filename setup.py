@@ -28,7 +28,7 @@ setup(
     author_email='opensource@disqus.com',
     url='http://github.com/disqus/gargoyle',
     description='Gargoyle is a platform built on top of Django which allows you to switch functionality of your application on and off based on conditions.',
-    packages=find_packages(exclude=["example_project", "tests"]),
+    packages=find_packages(exclude=["example_project", "tests", "benchmarks"]),
     zip_safe=False,
     install_requires=install_requires,
     license='Apache License 2.0',
@@ -5,21 +5,49 @@
 
 import datetime
 
+from array import array
+
 from django.conf import settings
 from django.contrib.auth.models import User, AnonymousUser
 from django.core.cache import cache
-from django.http import HttpRequest, Http404, HttpResponse
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.http import HttpRequest, Http404, HttpResponse, QueryDict
 from django.test import TestCase
 from django.template import Context, Template, TemplateSyntaxError
-
-from gargoyle.builtins import IPAddressConditionSet, UserConditionSet, HostConditionSet
+from django.utils.datastructures import MultiValueDict
+
+from gargoyle import gargoyle
+from gargoyle.builtins import IPAddressConditionSet, UserConditionSet, HostConditionSet, IPAddress, \
+    get_hostname
+from gargoyle.cohorts import numpy
+from gargoyle.conditions import Percent, Range, BeforeDate, OnOrAfterDate, ValidationError, \
+    ModelConditionSet, Boolean, String, CompiledField, CompiledString
 from gargoyle.decorators import switch_is_active
 from gargoyle.helpers import MockRequest
-from gargoyle.models import Switch, SELECTIVE, DISABLED, GLOBAL, INHERIT
+from gargoyle.members import BloomFilter
+from gargoyle.models import Switch, SwitchMember, SELECTIVE, DISABLED, GLOBAL, INHERIT, INCLUDE, EXCLUDE, \
+    MEMBERS
 from gargoyle.manager import SwitchManager
+from gargoyle.middleware import SwitchCacheMiddleware
+from gargoyle.networks import NetworkSet, format_network, parse_address, parse_network
+from gargoyle.parallel import get_ranges
+from gargoyle.signals import switches_cache_fetched, switches_reloaded, switches_patched, \
+    switch_conditions_updated
+from gargoyle.stats import percentile
 from gargoyle.testutils import switches
+from gargoyle.tree import CONDITIONAL
+
+from StringIO import StringIO
 
+import json
+import os
 import socket
+import tempfile
+import threading
+import time
 
 
 class APITest(TestCase):
@@ -464,6 +492,58 @@ class APITest(TestCase):
 
         self.assertFalse(self.gargoyle.is_active('test', request))
 
+    def test_lazy_request_user(self):
+        loads = []
+
+        class LazyUserRequest(HttpRequest):
+            @property
+            def user(self):
+                loads.append(1)
+                return User(pk=5)
+
+        Switch.objects.create(key='ip', status=SELECTIVE)
+        self.gargoyle['ip'].add_condition(
+            condition_set='gargoyle.builtins.IPAddressConditionSet',
+            field_name='ip_address',
+            condition='192.168.1.1',
+        )
+        Switch.objects.create(key='user', status=SELECTIVE)
+        self.gargoyle['user'].add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='percent',
+            condition='0-50',
+        )
+
+        request = LazyUserRequest()
+        request.META['REMOTE_ADDR'] = '192.168.1.1'
+
+        self.assertTrue(self.gargoyle.is_active('ip', request))
+        self.assertEquals(loads, [])
+
+        self.assertTrue(self.gargoyle.is_active('user', request))
+        self.assertEquals(len(loads), 1)
+
+        # the user is resolved once per evaluation
+        del loads[:]
+        self.assertEquals(self.gargoyle.is_active_many(['ip', 'user'], request), {'ip': True, 'user': True})
+        self.assertEquals(len(loads), 1)
+
+        # model condition sets only use it when their model is the user model
+        self.assertTrue(ModelConditionSet(User).uses_request_user)
+        self.assertTrue(UserConditionSet(User).uses_request_user)
+        self.assertFalse(ModelConditionSet(Switch).uses_request_user)
+
+        self.gargoyle.register(ModelConditionSet(Switch))
+        Switch.objects.create(key='model', status=SELECTIVE)
+        self.gargoyle['model'].add_condition(
+            condition_set='gargoyle.conditions.ModelConditionSet(gargoyle.switch)',
+            field_name='percent',
+            condition='0-50',
+        )
+        del loads[:]
+        self.assertFalse(self.gargoyle.is_active('model', request))
+        self.assertEquals(loads, [])
+
     def test_ip_address(self):
         condition_set = 'gargoyle.builtins.IPAddressConditionSet'
 
@@ -524,6 +604,132 @@ class APITest(TestCase):
         )
         self.assertFalse(self.gargoyle.is_active('test', request))
 
+    def test_ip_address_networks(self):
+        condition_set = 'gargoyle.builtins.IPAddressConditionSet'
+
+        Switch.objects.create(
+            key='test',
+            status=SELECTIVE,
+        )
+        switch = self.gargoyle['test']
+
+        switch.add_condition(
+            condition_set=condition_set,
+            field_name='ip_address',
+            condition='10.0.0.0/8',
+        )
+        switch.add_condition(
+            condition_set=condition_set,
+            field_name='ip_address',
+            condition='10.1.0.0/16',
+            exclude=True,
+        )
+
+        self.assertTrue(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='10.0.0.1')))
+        self.assertTrue(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='10.255.0.1')))
+        self.assertFalse(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='10.1.0.1')))
+        self.assertFalse(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='11.0.0.1')))
+        self.assertFalse(self.gargoyle.is_active('test', self.gargoyle.as_request()))
+
+    def test_ip_address_ipv6(self):
+        condition_set = 'gargoyle.builtins.IPAddressConditionSet'
+
+        Switch.objects.create(
+            key='test',
+            status=SELECTIVE,
+        )
+        switch = self.gargoyle['test']
+
+        switch.add_condition(
+            condition_set=condition_set,
+            field_name='ip_address',
+            condition='2001:db8::/32',
+        )
+        switch.add_condition(
+            condition_set=condition_set,
+            field_name='ip_address',
+            condition='10.0.0.0/8',
+        )
+
+        self.assertTrue(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='2001:db8::1')))
+        self.assertTrue(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='2001:DB8:0:0:0:0:0:ff')))
+        self.assertFalse(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='2001:db9::1')))
+        # IPv4-mapped addresses match IPv4 networks
+        self.assertTrue(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='::ffff:10.1.2.3')))
+        self.assertFalse(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='::10.1.2.3')))
+
+    def test_ip_address_parsed_once(self):
+        condition_set = IPAddressConditionSet()
+        request = self.gargoyle.as_request(ip_address='192.168.1.1')
+
+        self.assertEquals(condition_set.get_field_value(request, 'ip_address'), (32, 0xc0a80101))
+        self.assertEquals(condition_set.get_field_value(request, 'percent'), 0xc0a80101)
+        self.assertEquals(request._gargoyle_addresses, {'192.168.1.1': (32, 0xc0a80101)})
+
+        request = self.gargoyle.as_request(ip_address='unknown')
+        self.assertEquals(condition_set.get_field_value(request, 'ip_address'), 'unknown')
+        self.assertEquals(condition_set.get_field_value(request, 'percent'), None)
+
+    def test_ip_address_percent_invalid(self):
+        condition_set = 'gargoyle.builtins.IPAddressConditionSet'
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        switch = self.gargoyle['test']
+        switch.add_condition(
+            condition_set=condition_set,
+            field_name='percent',
+            condition='0-100',
+        )
+
+        for address in ('', 'unknown'):
+            request = HttpRequest()
+            request.META['REMOTE_ADDR'] = address
+            self.assertFalse(self.gargoyle.is_active('test', request))
+        self.assertFalse(Percent().is_active('0-100', None))
+
+    def test_ip_address_internal_networks(self):
+        condition_set = 'gargoyle.builtins.IPAddressConditionSet'
+
+        Switch.objects.create(
+            key='test',
+            status=SELECTIVE,
+        )
+        switch = self.gargoyle['test']
+        switch.add_condition(
+            condition_set=condition_set,
+            field_name='internal_ip',
+            condition='1',
+        )
+
+        request = self.gargoyle.as_request(ip_address='192.168.1.1')
+
+        settings.INTERNAL_IPS = ('127.0.0.1', '192.168.0.0/16')
+        self.assertTrue(self.gargoyle.is_active('test', request))
+
+        settings.INTERNAL_IPS = ('127.0.0.1', '192.168.2.0/24')
+        self.assertFalse(self.gargoyle.is_active('test', request))
+
+        # edited in place
+        settings.INTERNAL_IPS = ['127.0.0.1', '192.168.2.0/24']
+        self.assertFalse(self.gargoyle.is_active('test', request))
+        settings.INTERNAL_IPS.append('192.168.1.0/24')
+        self.assertTrue(self.gargoyle.is_active('test', request))
+
+        class Wildcards(object):
+            def __contains__(self, value):
+                return value.startswith('192.168.')
+
+        settings.INTERNAL_IPS = Wildcards()
+        self.assertTrue(self.gargoyle.is_active('test', request))
+        self.assertFalse(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='10.0.0.1')))
+
+        class WildcardList(list):
+            def __contains__(self, value):
+                return value.startswith('10.')
+
+        settings.INTERNAL_IPS = WildcardList(['192.168.0.0/16'])
+        self.assertFalse(self.gargoyle.is_active('test', request))
+
     def test_to_dict(self):
         condition_set = 'gargoyle.builtins.IPAddressConditionSet'
 
@@ -573,6 +779,8 @@ class APITest(TestCase):
         self.assertTrue(inner_condition[2], '192.168.1.1')
         self.assertFalse(inner_condition[3])
 
+        self.assertEquals(result['members'], [])
+
     def test_remove_condition(self):
         condition_set = 'gargoyle.builtins.UserConditionSet(auth.user)'
 
@@ -1031,6 +1239,57 @@ class HostConditionSetTest(TestCase):
 
         self.assertTrue(self.gargoyle.is_active('test'))
 
+    def test_compiled_once(self):
+        condition_set = 'gargoyle.builtins.HostConditionSet'
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        switch = self.gargoyle['test']
+        switch.add_condition(
+            condition_set=condition_set,
+            field_name='hostname',
+            condition='not-' + socket.gethostname(),
+        )
+        switch.add_condition(
+            condition_set=condition_set,
+            field_name='hostname',
+            condition=socket.gethostname(),
+            exclude=True,
+        )
+
+        compiled = self.gargoyle.compile(self.gargoyle['test'])[0]
+        self.assertEquals(compiled.result, False)
+        self.assertFalse(self.gargoyle.is_active('test'))
+
+    def test_get_hostname(self):
+        self.assertEquals(get_hostname(), socket.gethostname())
+
+    def test_get_hostname_after_fork(self):
+        lookups = []
+
+        def gethostname():
+            lookups.append(1)
+            return 'host%d' % len(lookups)
+
+        getpid, original_gethostname = os.getpid, socket.gethostname
+        pid = getpid()
+        socket.gethostname = gethostname
+        try:
+            os.getpid = lambda: pid
+            get_hostname()
+            del lookups[:]
+            # looked up once per process
+            self.assertEquals(get_hostname(), get_hostname())
+            self.assertEquals(lookups, [])
+
+            # a forked child has a new pid, and looks it up again
+            os.getpid = lambda: pid + 1
+            self.assertEquals(get_hostname(), 'host1')
+            self.assertEquals(get_hostname(), 'host1')
+            self.assertEquals(lookups, [1])
+        finally:
+            os.getpid, socket.gethostname = getpid, original_gethostname
+        self.assertEquals(get_hostname(), socket.gethostname())
+
 
 class SwitchContextManagerTest(TestCase):
     def setUp(self):
@@ -1073,3 +1332,1269 @@ class SwitchContextManagerTest(TestCase):
             self.assertFalse(self.gargoyle.is_active('test'))
 
         self.assertEquals(self.gargoyle['test'].status, GLOBAL)
+
+
+class CompiledConditionsTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        self.gargoyle.register(UserConditionSet(User))
+        self.gargoyle.register(IPAddressConditionSet())
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.switch = self.gargoyle['test']
+        self.switch.add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='percent',
+            condition='0-50',
+        )
+
+    def test_compiled_once(self):
+        switch = self.gargoyle['test']
+        compiled = self.gargoyle.compile(switch)
+        self.assertTrue(compiled is self.gargoyle.compile(switch))
+        self.assertEquals(len(compiled), 1)
+
+    def test_recompiled_on_change(self):
+        switch = self.gargoyle['test']
+        compiled = self.gargoyle.compile(switch)
+
+        switch.add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='bob',
+            commit=False,
+        )
+
+        self.assertFalse(compiled is self.gargoyle.compile(switch))
+        self.assertTrue(self.gargoyle.is_active('test', User(pk=8771, username='bob')))
+
+    def test_recompiled_on_register(self):
+        compiled = self.gargoyle.compile(self.gargoyle['test'])
+        self.gargoyle.register(HostConditionSet())
+        self.assertFalse(compiled is self.gargoyle.compile(self.gargoyle['test']))
+
+    def test_namespace_index(self):
+        self.gargoyle.register(HostConditionSet())
+        self.assertEquals(sorted(self.gargoyle._namespaces), ['auth.user', 'host', 'ip'])
+
+        compiled = self.gargoyle.compile(self.gargoyle['test'])
+        self.assertEquals([c.condition_set.get_namespace() for c in compiled], ['auth.user'])
+
+        self.gargoyle.unregister(UserConditionSet(User))
+        self.assertFalse('auth.user' in self.gargoyle._namespaces)
+        self.assertEquals(self.gargoyle.compile(self.gargoyle['test']), [])
+
+    def test_compiled_field(self):
+        field = UserConditionSet.fields['username']
+        compiled = field.compile([('i', 'foo'), ('e', 'bar')])
+        self.assertTrue(compiled.is_active('foo'))
+        self.assertFalse(compiled.is_active('bar'))
+        self.assertEquals(compiled.is_active('baz'), None)
+
+    def test_condition_set_is_active(self):
+        condition_set = UserConditionSet(User)
+        conditions = self.gargoyle['test'].value
+        conditions['auth.user']['username'] = [[EXCLUDE, 'bob']]
+
+        # one-off checks don't compile the conditions
+        condition_set.compile = None
+        self.assertTrue(condition_set.is_active(User(pk=8720, username='alice'), conditions))
+        self.assertFalse(condition_set.is_active(User(pk=8720, username='bob'), conditions))
+        self.assertEquals(condition_set.is_active(User(pk=8771, username='alice'), conditions), None)
+
+    def test_compiled_string(self):
+        compiled = String().compile([('i', 'foo'), ('i', 'bar'), ('e', 'bar')])
+        self.assertTrue(isinstance(compiled, CompiledString))
+        self.assertTrue(compiled.is_active('foo'))
+        self.assertTrue(compiled.is_active(u'foo'))
+        # exclude wins
+        self.assertFalse(compiled.is_active('bar'))
+        self.assertEquals(compiled.is_active('baz'), None)
+        self.assertEquals(compiled.is_active(None), None)
+        self.assertEquals(compiled.is_active(['foo']), None)
+
+        class Prefix(String):
+            def is_active(self, condition, value):
+                return value.startswith(condition)
+
+        compiled = Prefix().compile([('i', 'foo')])
+        self.assertTrue(isinstance(compiled, CompiledField))
+        self.assertTrue(compiled.is_active('foobar'))
+
+    def test_large_include_list(self):
+        self.switch.clear_conditions(condition_set='gargoyle.builtins.UserConditionSet(auth.user)')
+        for i in xrange(200):
+            self.switch.add_condition(
+                condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+                field_name='username',
+                condition='user%d' % i,
+                commit=False,
+            )
+        self.switch.add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='user10',
+            exclude=True,
+        )
+        self.assertTrue(self.gargoyle.is_active('test', User(pk=1, username='user199')))
+        self.assertFalse(self.gargoyle.is_active('test', User(pk=1, username='user10')))
+        self.assertFalse(self.gargoyle.is_active('test', User(pk=1, username='user200')))
+
+    def test_raw_is_active_override(self):
+        class EveryoneConditionSet(UserConditionSet):
+            def is_active(self, instance, conditions):
+                return True
+
+        self.assertFalse(EveryoneConditionSet.evaluates_compiled)
+        self.assertTrue(UserConditionSet.evaluates_compiled)
+
+        self.gargoyle.unregister(UserConditionSet(User))
+        self.gargoyle.register(EveryoneConditionSet(User))
+
+        self.assertTrue(self.gargoyle.is_active('test', User(pk=8771)))
+
+
+    def test_dispatch_by_type(self):
+        user = User(pk=5)
+        request = HttpRequest()
+        request.META['REMOTE_ADDR'] = '10.0.0.1'
+        self.assertTrue(self.gargoyle.is_active('test', request, user, Switch(key='other')))
+
+        condition_set = UserConditionSet(User)
+        self.assertEquals(self.gargoyle._dispatch[User], frozenset([self.gargoyle._registry[condition_set.get_id()]]))
+        self.assertEquals(self.gargoyle._dispatch[Switch], frozenset())
+        self.assertTrue(type(None) in self.gargoyle._dispatch)
+
+        self.gargoyle.register(HostConditionSet())
+        self.assertEquals(self.gargoyle._dispatch, {})
+
+    def test_field_getters(self):
+        self.assertEquals(sorted(UserConditionSet.field_getters), sorted(UserConditionSet.fields))
+        user = User(pk=8771, username='bob')
+        condition_set = UserConditionSet(User)
+        self.assertEquals(condition_set.get_field_value(user, 'percent'), 8771)
+        self.assertEquals(condition_set.get_field_value(user, 'username'), 'bob')
+        self.assertEquals(condition_set.get_field_value(user, 'is_anonymous'), False)
+        # attributes which aren't fields are still read
+        self.assertEquals(condition_set.get_field_value(user, 'pk'), 8771)
+
+    def test_field_values_per_request(self):
+        reads = []
+
+        class CountingUser(User):
+            class Meta:
+                proxy = True
+
+            @property
+            def username(self):
+                reads.append(1)
+                return 'bob'
+
+            @username.setter
+            def username(self, value):
+                pass
+
+        for i in xrange(5):
+            Switch.objects.create(key='username%d' % i, status=SELECTIVE)
+            self.gargoyle['username%d' % i].add_condition(
+                condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+                field_name='username',
+                condition='bob',
+            )
+        user = CountingUser(pk=8771)
+
+        for i in xrange(5):
+            self.assertTrue(self.gargoyle.is_active('username%d' % i, user))
+        self.assertEquals(len(reads), 5)
+
+        del reads[:]
+        self.gargoyle.enable_request_cache()
+        try:
+            for i in xrange(5):
+                self.assertTrue(self.gargoyle.is_active('username%d' % i, user))
+            self.assertTrue(self.gargoyle.is_active_many(['username0', 'username1'], user)['username0'])
+        finally:
+            self.gargoyle.disable_request_cache()
+        self.assertEquals(len(reads), 1)
+
+    def test_field_values_bounded(self):
+        Switch.objects.create(key='username', status=SELECTIVE)
+        self.gargoyle['username'].add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='user0',
+        )
+
+        self.gargoyle.enable_request_cache(max_size=10)
+        try:
+            request_cache = self.gargoyle._local.request_cache
+            for i in xrange(100):
+                user = User(pk=i, username='user%d' % i)
+                self.assertEquals(self.gargoyle.is_active('username', user), not i)
+                self.assertEquals(self.gargoyle.is_active_many(['username'], user), {'username': not i})
+                self.assertTrue(len(request_cache.results) <= 10)
+                self.assertTrue(len(request_cache.field_values) <= 10)
+        finally:
+            self.gargoyle.disable_request_cache()
+
+    def test_can_execute_override(self):
+        class OddConditionSet(UserConditionSet):
+            def can_execute(self, instance):
+                return isinstance(instance, User) and instance.pk % 2 == 1
+
+        self.assertFalse(OddConditionSet.dispatches_by_type)
+        self.assertTrue(UserConditionSet.dispatches_by_type)
+
+        self.gargoyle.unregister(UserConditionSet(User))
+        self.gargoyle.register(OddConditionSet(User))
+
+        # evaluated for each instance, as the type alone doesn't decide
+        self.assertTrue(self.gargoyle.is_active('test', User(pk=1)))
+        self.assertFalse(self.gargoyle.is_active('test', User(pk=2)))
+        self.assertEquals(self.gargoyle._dispatch.get(User, frozenset()), frozenset())
+
+
+class RangeFieldTest(TestCase):
+    def setUp(self):
+        self.field = Percent(label='Percent')
+
+    def test_parse(self):
+        self.assertEquals(self.field.parse('0-50'), (0, 50))
+        self.assertEquals(self.field.parse([10, 20]), (10, 20))
+        self.assertTrue('0-50' in Range.parsed_ranges)
+
+    def test_is_active(self):
+        self.assertTrue(self.field.is_active('0-50', 150))
+        self.assertFalse(self.field.is_active('0-50', 151))
+
+        is_active = self.field.compile_condition('0-50')
+        self.assertTrue(is_active(150))
+        self.assertFalse(is_active(151))
+
+    def test_buckets(self):
+        buckets = self.field.buckets([(INCLUDE, '0-50'), (EXCLUDE, '40-60'), (INCLUDE, '90-100')])
+        self.assertEquals(len(buckets), 100)
+        self.assertEquals(buckets[:40], [True] * 40)
+        self.assertEquals(buckets[40:61], [False] * 21)
+        self.assertEquals(buckets[61:90], [None] * 29)
+        self.assertEquals(buckets[90:], [True] * 10)
+
+    def test_display(self):
+        self.assertEquals(self.field.display('10-60'), 'Percent: 50% (10-60)')
+        self.assertEquals(Range(label='Range').display('10-60'), 'Range: 10-60')
+
+    def test_clean(self):
+        self.assertEquals(self.field.clean(['0', '50']), '0-50')
+        self.assertRaises(ValidationError, self.field.clean, ['0', '150'])
+        self.assertRaises(ValidationError, self.field.clean, ['60', '50'])
+
+
+class PercentMaskTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=False)
+        self.gargoyle.register(UserConditionSet(User))
+        self.condition_set = 'gargoyle.builtins.UserConditionSet(auth.user)'
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        switch = self.gargoyle['test']
+        switch.add_condition(
+            condition_set=self.condition_set,
+            field_name='percent',
+            condition='0-50',
+        )
+        switch.add_condition(
+            condition_set=self.condition_set,
+            field_name='percent',
+            condition='10-20',
+            exclude=True,
+        )
+
+    def test_matches_is_active(self):
+        ids = array('l', range(-150, 250) + [2 ** 40 + 5])
+        mask = self.gargoyle.percent_mask('test', ids, self.condition_set)
+        self.assertTrue(isinstance(mask, array))
+        self.assertEquals(len(mask), len(ids))
+        for pk, included in zip(ids, mask):
+            self.assertEquals(bool(included), self.gargoyle.is_active('test', User(pk=pk)), pk)
+
+    def test_numpy(self):
+        if numpy is None:
+            return
+        ids = numpy.arange(-150, 250, dtype=numpy.int64)
+        mask = self.gargoyle.percent_mask('test', ids, self.condition_set)
+        self.assertEquals(mask.dtype, bool)
+        self.assertEquals(list(mask), map(bool, self.gargoyle.percent_mask('test', list(ids), self.condition_set)))
+
+    def test_no_conditions(self):
+        self.assertEquals(list(self.gargoyle.percent_mask('missing', [1, 2], self.condition_set)), [0, 0])
+
+
+class EvenConditionSet(ModelConditionSet):
+    even = Boolean()
+
+    def get_namespace(self):
+        return 'even'
+
+    def get_field_value(self, instance, field_name):
+        return instance.pk % 2 == 0
+
+
+class AudienceTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=False)
+        self.gargoyle.register(UserConditionSet(User))
+        self.gargoyle.register(HostConditionSet())
+        self.condition_set = 'gargoyle.builtins.UserConditionSet(auth.user)'
+
+        for i in xrange(1, 61):
+            User.objects.create(
+                username='user%d' % i,
+                email='user%d@example.com' % (i % 7),
+                is_staff=i % 3 == 0,
+                is_superuser=i % 11 == 0,
+                is_active=i % 13 != 0,
+                date_joined=datetime.datetime(2011, 1, 1) + datetime.timedelta(days=i),
+            )
+
+    def add_condition(self, key, field_name, condition, exclude=False, condition_set=None):
+        self.gargoyle[key].add_condition(
+            condition_set=condition_set or self.condition_set,
+            field_name=field_name,
+            condition=condition,
+            exclude=exclude,
+        )
+
+    def assertAudience(self, key, exact=True):
+        audience = self.gargoyle.audience(key, User.objects.all())
+        self.assertEquals(audience.exact, exact)
+        expected = sorted([u.pk for u in User.objects.all() if self.gargoyle.is_active(key, u)])
+        self.assertEquals(sorted([u.pk for u in audience]), expected)
+        self.assertEquals(audience.count(), len(expected))
+        return expected
+
+    def test_members(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.gargoyle['test'].add_members(self.condition_set, 'username', ['user%d' % i for i in xrange(1, 20)])
+        self.gargoyle['test'].add_members(self.condition_set, 'username', ['user3', 'user4'], exclude=True)
+        self.add_condition('test', 'username', 'user30')
+        self.assertEquals(len(self.assertAudience('test')), 18)
+
+    def test_conditions(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'percent', '0-40')
+        self.add_condition('test', 'percent', '90-100')
+        self.add_condition('test', 'username', 'user55')
+        self.add_condition('test', 'email', 'user3@example.com', exclude=True)
+        self.add_condition('test', 'is_superuser', '1', exclude=True)
+        self.add_condition('test', 'date_joined', '2011-01-10')
+        self.assertTrue(self.assertAudience('test'))
+
+        self.add_condition('test', 'is_staff', '1')
+        self.add_condition('test', 'is_active', '1', exclude=True)
+        self.add_condition('test', 'is_anonymous', '1')
+        self.assertTrue(self.assertAudience('test'))
+
+    def test_statuses(self):
+        Switch.objects.create(key='global', status=GLOBAL)
+        Switch.objects.create(key='disabled', status=DISABLED)
+        Switch.objects.create(key='selective', status=SELECTIVE)
+        Switch.objects.create(key='global:inherit', status=INHERIT)
+        Switch.objects.create(key='disabled:global', status=GLOBAL)
+        Switch.objects.create(key='selective:percent', status=SELECTIVE)
+        Switch.objects.create(key='selective:percent:inherit', status=INHERIT)
+        self.add_condition('selective', 'is_staff', '1')
+        self.add_condition('selective:percent', 'percent', '0-50')
+
+        self.assertEquals(len(self.assertAudience('global')), 60)
+        self.assertEquals(self.assertAudience('disabled'), [])
+        self.assertEquals(len(self.assertAudience('global:inherit')), 60)
+        self.assertEquals(self.assertAudience('disabled:global'), [])
+        self.assertEquals(self.assertAudience('missing'), [])
+        self.assertTrue(self.assertAudience('selective:percent'))
+        self.assertTrue(self.assertAudience('selective:percent:inherit'))
+
+        with switches(self.gargoyle, selective=True):
+            self.assertEquals(self.gargoyle.audience('selective', User.objects.all()).queryset.count(), 60)
+
+    def test_instance_independent_conditions(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'username', 'user1')
+        self.add_condition('test', 'hostname', get_hostname(), condition_set='gargoyle.builtins.HostConditionSet')
+        self.assertEquals(len(self.assertAudience('test')), 60)
+
+        self.add_condition('test', 'hostname', get_hostname(), exclude=True,
+                           condition_set='gargoyle.builtins.HostConditionSet')
+        self.assertEquals(self.assertAudience('test'), [])
+
+    def add_even_switch(self):
+        self.gargoyle.register(EvenConditionSet(User))
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'even', '1', condition_set=EvenConditionSet(User).get_id())
+        self.add_condition('test', 'is_staff', '1', exclude=True)
+        return [u.pk for u in User.objects.order_by('pk') if u.pk % 2 == 0 and not u.is_staff]
+
+    def test_fallback(self):
+        expected = self.add_even_switch()
+        self.assertEquals(self.assertAudience('test', exact=False), expected)
+
+        audience = self.gargoyle.audience('test', User.objects.filter(pk__gt=expected[0]))
+        self.assertEquals([u.pk for u in audience.filter(chunk_size=7)], expected[1:])
+
+    def test_parallel(self):
+        expected = self.add_even_switch()
+        audience = self.gargoyle.audience('test', User.objects.all())
+        self.assertEquals(audience.count(processes=2, chunks=5), len(expected))
+
+        path = tempfile.mktemp()
+        try:
+            self.assertEquals(audience.write_ids(path, processes=2, chunks=5), len(expected))
+            self.assertEquals([int(line) for line in open(path)], expected)
+        finally:
+            os.unlink(path)
+
+        self.assertEquals(get_ranges(User.objects.filter(pk__in=[3, 10]), 3), [(3, 6), (6, 9), (9, 11)])
+        self.assertEquals(get_ranges(User.objects.none(), 3), [])
+
+    def test_estimate(self):
+        expected = self.add_even_switch()
+        audience = self.gargoyle.audience('test', User.objects.all())
+        estimate, sampled, matched = audience.estimate(sample_size=100, window=10)
+        self.assertEquals(estimate, int(round(float(matched) / sampled * 60)))
+        self.assertTrue(0 < sampled <= 60)
+
+        # every object is sampled once the sample covers the whole table
+        self.assertEquals(audience.estimate(sample_size=10000, window=60), (len(expected), 60, len(expected)))
+
+    def test_command(self):
+        self.gargoyle = gargoyle
+        expected = self.add_even_switch()
+        try:
+            stdout = StringIO()
+            call_command('gargoyle_audience', 'test', processes=2, stdout=stdout)
+            self.assertEquals(stdout.getvalue(), '%d\n' % len(expected))
+
+            stdout = StringIO()
+            call_command('gargoyle_audience', 'test', estimate=10000, stdout=stdout)
+            self.assertEquals(stdout.getvalue(), '%d (%d of 60 sampled)\n' % (len(expected), len(expected)))
+        finally:
+            gargoyle.unregister(EvenConditionSet(User))
+
+
+class SwitchStatsTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=False)
+        self.gargoyle.register(UserConditionSet(User))
+
+        Switch.objects.create(key='global', status=GLOBAL)
+        Switch.objects.create(key='selective', status=SELECTIVE)
+        self.gargoyle['selective'].add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='percent',
+            condition='0-50',
+        )
+
+    def test_disabled(self):
+        self.assertFalse('is_active' in self.gargoyle.__dict__)
+        self.gargoyle.is_active('global')
+        self.assertEquals(self.gargoyle.stats()['switches'], {})
+
+    def test_counters(self):
+        self.gargoyle.enable_stats()
+        for pk in xrange(100):
+            self.gargoyle.is_active('selective', User(pk=pk))
+        self.gargoyle.is_active('global')
+        self.gargoyle.is_active('missing')
+
+        stats = self.gargoyle.stats()['switches']
+        self.assertEquals(sorted(stats), ['global', 'missing', 'selective'])
+        self.assertEquals(stats['selective']['calls'], 100)
+        self.assertEquals(stats['selective']['active'], 51)
+        self.assertEquals(stats['selective']['inactive'], 49)
+        self.assertEquals(sum([count for bound, count in stats['selective']['histogram']]), 100)
+        self.assertEquals(stats['selective']['histogram'][-1][0], None)
+        self.assertTrue(stats['selective']['total_usec'] > 0)
+        self.assertEquals((stats['global']['calls'], stats['global']['active']), (1, 1))
+        self.assertEquals((stats['missing']['calls'], stats['missing']['active']), (1, 0))
+
+        self.assertTrue(self.gargoyle.stats_enabled)
+        self.gargoyle.disable_stats()
+        self.assertFalse(self.gargoyle.stats_enabled)
+        self.assertFalse('is_active' in self.gargoyle.__dict__)
+        self.gargoyle.is_active('global')
+        self.assertEquals(self.gargoyle.stats()['switches']['global']['calls'], 1)
+
+        self.gargoyle.reset_stats()
+        self.assertEquals(self.gargoyle.stats()['switches'], {})
+
+    def test_threads(self):
+        self.gargoyle.enable_stats()
+        self.gargoyle.is_active('global')
+
+        def check():
+            for i in xrange(10):
+                self.gargoyle.is_active('global')
+
+        threads = [threading.Thread(target=check) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(self.gargoyle.stats()['switches']['global']['calls'], 41)
+
+        # the counters of threads which have exited are merged
+        self.assertEquals(len(self.gargoyle._stats._threads), 1)
+        thread = threading.Thread(target=check)
+        thread.start()
+        thread.join()
+        self.assertEquals(self.gargoyle.stats()['switches']['global']['calls'], 51)
+        self.assertEquals(len(self.gargoyle._stats._threads), 1)
+
+        self.gargoyle.reset_stats()
+        self.assertEquals(self.gargoyle.stats()['switches'], {})
+
+    def test_store(self):
+        self.gargoyle.payload_sample_interval = 2
+        self.gargoyle.enable_stats()
+        self.gargoyle._populate(reset=True)
+        store = self.gargoyle.stats()['store']
+        self.assertEquals(store['database_reloads'], 1)
+        self.assertTrue(store['database_reload_usec'] > 0)
+
+        self.gargoyle.is_active('global')
+        self.assertEquals(self.gargoyle.stats()['store']['local_hits'], 1)
+
+        # A process without a local copy reads the shared cache
+        self.gargoyle._cache = None
+        self.gargoyle._last_updated = None
+        self.gargoyle.is_active('global')
+        store = self.gargoyle.stats()['store']
+        self.assertEquals((store['cache_fetches'], store['cache_misses']), (1, 0))
+        self.assertEquals(store['database_reloads'], 1)
+        self.assertTrue(store['payload_bytes'] > 0)
+        self.assertTrue(store['deserialize_usec'] >= 0)
+
+        # later fetches are only measured once in a while
+        self.gargoyle._stats.last_payload = None
+        for i in xrange(2):
+            self.gargoyle._cache = None
+            self.gargoyle._last_updated = None
+            self.gargoyle.is_active('global')
+            self.assertEquals(self.gargoyle.stats()['store']['payload_bytes'] is not None, bool(i))
+
+        self.gargoyle._cleanup()
+        self.gargoyle.is_active('global')
+        self.assertEquals(self.gargoyle.stats()['store']['version_checks'], 1)
+
+        self.gargoyle.reset_stats()
+        store = self.gargoyle.stats()['store']
+        self.assertEquals((store['local_hits'], store['payload_bytes']), (0, None))
+
+        self.gargoyle.disable_stats()
+        self.gargoyle._populate(reset=True)
+        self.assertEquals(self.gargoyle.stats()['store']['database_reloads'], 0)
+
+    def test_store_signals(self):
+        fetches = []
+        reloads = []
+
+        def fetched(sender, **kwargs):
+            fetches.append(kwargs)
+
+        def reloaded(sender, **kwargs):
+            reloads.append(kwargs)
+
+        switches_cache_fetched.connect(fetched, sender=self.gargoyle)
+        switches_reloaded.connect(reloaded, sender=self.gargoyle)
+        try:
+            self.gargoyle._populate(reset=True)
+            self.gargoyle._cache = None
+            self.gargoyle._last_updated = None
+            self.gargoyle.is_active('global')
+        finally:
+            switches_cache_fetched.disconnect(fetched, sender=self.gargoyle)
+            switches_reloaded.disconnect(reloaded, sender=self.gargoyle)
+
+        self.assertEquals(len(reloads), 1)
+        self.assertEquals(reloads[0]['count'], 2)
+        self.assertEquals(len(fetches), 1)
+        self.assertTrue(fetches[0]['hit'])
+        self.assertEquals(fetches[0]['size'], None)
+
+    def test_percentile(self):
+        histogram = [(1, 50), (2, 0), (5, 49), (None, 1)]
+        self.assertEquals(percentile(histogram, 0.5), 1)
+        self.assertEquals(percentile(histogram, 0.99), 5)
+        self.assertEquals(percentile(histogram, 1), None)
+
+
+class SwitchMembersTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=False)
+        self.gargoyle.register(UserConditionSet(User))
+        self.condition_set = 'gargoyle.builtins.UserConditionSet(auth.user)'
+        Switch.objects.create(key='beta', status=SELECTIVE)
+
+    def test_members(self):
+        usernames = ['user%d' % i for i in xrange(5000)]
+        self.gargoyle['beta'].add_members(self.condition_set, 'username', usernames)
+
+        self.assertEquals(SwitchMember.objects.filter(switch_key='beta').count(), 5000)
+        self.assertEquals(self.gargoyle['beta'].get_member_counts(), [(self.condition_set, 'username', 5000)])
+        # the switch only keeps a filter of the members
+        self.assertTrue(len(json.dumps(self.gargoyle['beta'].value)) < 20000)
+
+        self.assertTrue(self.gargoyle.is_active('beta', User(pk=1, username='user4999')))
+        self.assertTrue(self.gargoyle.is_active('beta', User(pk=1, username=u'user0')))
+        self.assertFalse(self.gargoyle.is_active('beta', User(pk=1, username='user5000')))
+        self.assertFalse(self.gargoyle.is_active('beta', User(pk=1, username=None)))
+
+        # exclude wins, whether in the list or in conditions
+        self.gargoyle['beta'].add_members(self.condition_set, 'username', ['user1'], exclude=True)
+        self.gargoyle['beta'].add_condition(condition_set=self.condition_set, field_name='username',
+                                            condition='user2', exclude=True)
+        self.assertFalse(self.gargoyle.is_active('beta', User(pk=1, username='user1')))
+        self.assertFalse(self.gargoyle.is_active('beta', User(pk=1, username='user2')))
+        self.assertTrue(self.gargoyle.is_active('beta', User(pk=1, username='user3')))
+
+        self.gargoyle['beta'].remove_members(self.condition_set, 'username', ['user3'])
+        self.assertFalse(self.gargoyle.is_active('beta', User(pk=1, username='user3')))
+        self.assertEquals(self.gargoyle['beta'].get_member_counts(), [(self.condition_set, 'username', 4999)])
+
+        self.gargoyle['beta'].clear_members(self.condition_set)
+        self.assertFalse(MEMBERS in self.gargoyle['beta'].value)
+        self.assertFalse(SwitchMember.objects.exists())
+        self.assertFalse(self.gargoyle.is_active('beta', User(pk=1, username='user4')))
+
+    def test_incremental(self):
+        self.gargoyle['beta'].add_members(self.condition_set, 'username', ['alice'])
+        data = self.gargoyle['beta'].value[MEMBERS]['auth.user']['username']
+        self.assertEquals((data['count'], data['capacity']), (1, 1000))
+
+        self.gargoyle['beta'].add_members(self.condition_set, 'username', ['alice', 'bob'])
+        data = self.gargoyle['beta'].value[MEMBERS]['auth.user']['username']
+        self.assertEquals((data['count'], data['capacity']), (2, 1000))
+        self.assertTrue(self.gargoyle.is_active('beta', User(pk=1, username='bob')))
+
+        self.gargoyle['beta'].add_members(self.condition_set, 'username', ['user%d' % i for i in xrange(1000)])
+        data = self.gargoyle['beta'].value[MEMBERS]['auth.user']['username']
+        self.assertEquals((data['count'], data['capacity']), (1002, 2004))
+
+    def test_unsupported_fields(self):
+        self.gargoyle.register(IPAddressConditionSet())
+        switch = self.gargoyle['beta']
+        self.assertRaises(ValueError, switch.add_members, self.condition_set, 'is_staff', ['1'])
+        self.assertRaises(ValueError, switch.add_members, self.condition_set, 'percent', ['0-50'])
+        self.assertRaises(ValueError, switch.replace_members, 'gargoyle.builtins.IPAddressConditionSet',
+                          'ip_address', ['10.0.0.1'])
+        self.assertRaises(ValueError, switch.add_members, self.condition_set, 'missing', ['alice'])
+        self.assertFalse(SwitchMember.objects.exists())
+        self.assertFalse(MEMBERS in self.gargoyle['beta'].value)
+
+    def test_delete(self):
+        self.gargoyle['beta'].add_members(self.condition_set, 'username', ['alice'])
+        Switch.objects.get(key='beta').delete()
+        self.assertFalse(SwitchMember.objects.exists())
+
+    def test_bloom_filter(self):
+        bloom_filter = BloomFilter.with_capacity(1000)
+        for i in xrange(1000):
+            bloom_filter.add('member%d' % i)
+        bloom_filter = BloomFilter.from_dict(json.loads(json.dumps(bloom_filter.to_dict())))
+
+        for i in xrange(1000):
+            self.assertTrue('member%d' % i in bloom_filter)
+        false_positives = len([i for i in xrange(10000) if 'other%d' % i in bloom_filter])
+        self.assertTrue(false_positives < 300, false_positives)
+        self.assertTrue(u'\xe9t\xe9' not in bloom_filter)
+
+
+class BulkConditionsTest(TestCase):
+    def setUp(self):
+        from gargoyle.nexus_modules import GargoyleModule
+        import nexus
+
+        self.module = GargoyleModule(nexus.site)
+        self.condition_set = 'gargoyle.builtins.UserConditionSet(auth.user)'
+        Switch.objects.create(key='beta', status=SELECTIVE)
+
+        self.saves = []
+        post_save.connect(self.saved, sender=Switch)
+        self.updates = []
+        switch_conditions_updated.connect(self.updated)
+
+    def tearDown(self):
+        post_save.disconnect(self.saved, sender=Switch)
+        switch_conditions_updated.disconnect(self.updated)
+
+    def saved(self, sender, instance, **kwargs):
+        self.saves.append(instance.key)
+
+    def updated(self, sender, **kwargs):
+        self.updates.append(kwargs)
+
+    def post(self, data, upload=None):
+        request = HttpRequest()
+        request.method = 'POST'
+        request.POST = QueryDict('', mutable=True)
+        request.POST.update(data)
+        if upload is not None:
+            request.FILES = MultiValueDict({'file': [SimpleUploadedFile('values.csv', upload)]})
+        return json.loads(self.module.bulk_conditions(request).content)
+
+    def test_api(self):
+        switch = gargoyle['beta']
+        self.assertEquals(switch.add_conditions(self.condition_set, 'username', ['alice', 'bob', 'alice']),
+                          ['alice', 'bob'])
+        self.assertEquals(switch.add_conditions(self.condition_set, 'username', ['bob', 'carol'], exclude=True),
+                          ['bob', 'carol'])
+        self.assertEquals(gargoyle['beta'].value['auth.user']['username'],
+                          [['i', 'alice'], ['e', 'bob'], ['e', 'carol']])
+
+        self.assertEquals(switch.remove_conditions(self.condition_set, 'username', ['bob', 'dave']), ['bob'])
+        switch.replace_conditions(self.condition_set, 'username', ['erin'])
+        self.assertEquals(gargoyle['beta'].value['auth.user']['username'], [['i', 'erin']])
+        self.assertTrue(gargoyle.is_active('beta', User(pk=1, username='erin')))
+
+        switch.replace_conditions(self.condition_set, 'username', [])
+        self.assertEquals(gargoyle['beta'].value, {})
+        self.assertEquals(len(self.saves), 5)
+
+    def test_add(self):
+        usernames = ['user%d' % i for i in xrange(500)]
+        response = self.post({'key': 'beta', 'id': self.condition_set, 'field': 'username',
+                              'values': '\n'.join(usernames + [' user0 ', ''])})
+        self.assertTrue(response['success'], response)
+        self.assertEquals(len(gargoyle['beta'].value['auth.user']['username']), 500)
+        self.assertEquals(self.saves, ['beta'])
+
+        self.assertEquals(len(self.updates), 1)
+        self.assertEquals(self.updates[0]['action'], 'add')
+        self.assertEquals(self.updates[0]['conditions']['values'], usernames)
+
+        response = self.post({'key': 'beta', 'id': self.condition_set, 'field': 'username',
+                              'action': 'remove', 'values': 'user0\nuser1'})
+        self.assertTrue(response['success'], response)
+        self.assertEquals(len(gargoyle['beta'].value['auth.user']['username']), 498)
+
+    def test_remove_cleaned(self):
+        ip_condition_set = 'gargoyle.builtins.IPAddressConditionSet'
+        gargoyle['beta'].add_conditions(ip_condition_set, 'ip_address', ['2001:db8::1', '10.0.0.1'])
+
+        response = self.post({'key': 'beta', 'id': ip_condition_set, 'field': 'ip_address',
+                              'action': 'remove', 'values': '2001:DB8:0::1\nfoo'})
+        self.assertFalse(response['success'])
+        self.assertEquals(response['data'], '1 invalid values: foo')
+
+        response = self.post({'key': 'beta', 'id': ip_condition_set, 'field': 'ip_address',
+                              'action': 'remove', 'values': '2001:DB8:0::1'})
+        self.assertTrue(response['success'], response)
+        self.assertEquals(gargoyle['beta'].value['ip']['ip_address'], [['i', '10.0.0.1']])
+
+    def test_csv_members(self):
+        upload = 'alice,Alice\n"bob",Bob\n\xc3\xa9mile,\xc3\x89mile\n'
+        response = self.post({'key': 'beta', 'id': self.condition_set, 'field': 'username',
+                              'action': 'replace', 'members': '1'}, upload)
+        self.assertTrue(response['success'], response)
+        self.assertEquals(sorted(SwitchMember.objects.values_list('value', flat=True)),
+                          ['alice', 'bob', u'\xe9mile'])
+        self.assertTrue(gargoyle.is_active('beta', User(pk=1, username=u'\xe9mile')))
+        self.assertEquals(self.saves, ['beta'])
+        self.assertTrue(self.updates[0]['conditions']['members'])
+
+    def test_invalid(self):
+        response = self.post({'key': 'beta', 'id': 'gargoyle.builtins.IPAddressConditionSet',
+                              'field': 'ip_address', 'values': '10.0.0.1\nfoo\n10.0.0.0/8'})
+        self.assertFalse(response['success'])
+        self.assertEquals(response['data'], '1 invalid values: foo')
+
+        response = self.post({'key': 'beta', 'id': self.condition_set, 'field': 'username', 'values': ''})
+        self.assertFalse(response['success'])
+
+        response = self.post({'key': 'beta', 'id': 'gargoyle.builtins.IPAddressConditionSet',
+                              'field': 'ip_address', 'values': '10.0.0.1', 'members': '1'})
+        self.assertFalse(response['success'])
+        self.assertEquals(response['data'], 'IP Address does not support membership lists')
+
+        response = self.post({'key': 'beta', 'id': self.condition_set, 'field': 'username',
+                              'action': 'merge', 'values': 'alice'})
+        self.assertFalse(response['success'])
+        self.assertEquals(self.saves, [])
+        self.assertEquals(self.updates, [])
+
+    def test_rename_with_members(self):
+        gargoyle['beta'].add_members(self.condition_set, 'username', ['alice'])
+
+        request = HttpRequest()
+        request.method = 'POST'
+        request.POST = QueryDict('', mutable=True)
+        request.POST.update({'curkey': 'beta', 'key': 'gamma', 'name': 'Gamma', 'desc': ''})
+        response = json.loads(self.module.update(request).content)
+        self.assertTrue(response['success'], response)
+
+        self.assertFalse(Switch.objects.filter(key='beta').exists())
+        self.assertEquals(list(SwitchMember.objects.values_list('switch_key', flat=True)), ['gamma'])
+        self.assertEquals(gargoyle['gamma'].get_member_counts(), [(self.condition_set, 'username', 1)])
+        self.assertEquals(response['data']['members'],
+                          [{'id': self.condition_set, 'label': 'User', 'field': 'username', 'count': 1}])
+        self.assertTrue(gargoyle.is_active('gamma', User(pk=1, username='alice')))
+        self.assertFalse(gargoyle.is_active('gamma', User(pk=1, username='bob')))
+
+
+class DateFieldTest(TestCase):
+    def test_str_to_date(self):
+        field = OnOrAfterDate()
+        self.assertEquals(field.str_to_date('2011-07-01'), datetime.date(2011, 7, 1))
+        self.assertTrue('2011-07-01' in OnOrAfterDate.parsed_dates)
+        self.assertRaises(ValueError, field.str_to_date, '07/01/2011')
+
+    def test_compile_condition(self):
+        is_active = OnOrAfterDate().compile_condition('2011-07-01')
+        self.assertTrue(is_active(datetime.date(2011, 7, 1)))
+        self.assertTrue(is_active(datetime.datetime(2011, 7, 1, 12)))
+        self.assertFalse(is_active(datetime.datetime(2011, 6, 30, 12)))
+
+        is_active = BeforeDate().compile_condition('2011-07-01')
+        self.assertFalse(is_active(datetime.date(2011, 7, 1)))
+        self.assertTrue(is_active(datetime.datetime(2011, 6, 30, 12)))
+
+
+class RequestCacheTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        self.gargoyle.register(UserConditionSet(User))
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.gargoyle['test'].add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='foo',
+        )
+
+    def tearDown(self):
+        self.gargoyle.disable_request_cache()
+
+    def test_memoizes_results(self):
+        user = User(username='foo')
+        self.gargoyle.enable_request_cache()
+
+        self.assertTrue(self.gargoyle.is_active('test', user))
+        self.assertTrue(self.gargoyle.is_active('test', user))
+        self.assertFalse(self.gargoyle.is_active('test', User(username='bar')))
+
+        stats = self.gargoyle.disable_request_cache()
+        self.assertEquals(stats, {'hits': 1, 'misses': 2, 'size': 2})
+        self.assertEquals(self.gargoyle.get_request_cache_stats(), {'hits': 1, 'misses': 2, 'requests': 1})
+        self.assertEquals(self.gargoyle.disable_request_cache(), None)
+
+    def test_consistent_snapshot(self):
+        self.gargoyle.enable_request_cache()
+        self.assertFalse(self.gargoyle.is_active('test'))
+
+        # saved elsewhere, e.g. from Nexus
+        switch = Switch.objects.get(key='test')
+        switch.status = GLOBAL
+        switch.save()
+
+        self.assertFalse(self.gargoyle.is_active('test'))
+        self.assertFalse(self.gargoyle.is_active('test', User(username='bar')))
+
+        self.gargoyle.disable_request_cache()
+        self.assertTrue(self.gargoyle.is_active('test'))
+
+    def test_max_size(self):
+        self.gargoyle.enable_request_cache(max_size=1)
+        self.assertFalse(self.gargoyle.is_active('test'))
+        self.assertFalse(self.gargoyle.is_active('other'))
+        self.assertEquals(self.gargoyle.disable_request_cache()['size'], 1)
+
+    def test_middleware(self):
+        middleware = SwitchCacheMiddleware(self.gargoyle)
+        request = HttpRequest()
+        request.user = User(username='foo')
+
+        middleware.process_request(request)
+        self.assertTrue(self.gargoyle.is_active('test', request))
+        self.assertTrue(self.gargoyle.is_active('test', request))
+
+        response = HttpResponse()
+        self.assertTrue(middleware.process_response(request, response) is response)
+        self.assertEquals(self.gargoyle.get_request_cache_stats()['hits'], 1)
+
+
+class BulkEvaluationTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=False)
+        self.gargoyle.register(UserConditionSet(User))
+        self.gargoyle.register(IPAddressConditionSet())
+
+        condition_set = 'gargoyle.builtins.UserConditionSet(auth.user)'
+
+        Switch.objects.create(key='global', status=GLOBAL)
+        Switch.objects.create(key='disabled', status=DISABLED)
+        Switch.objects.create(key='selective', status=SELECTIVE)
+        Switch.objects.create(key='selective:inherit', status=INHERIT)
+        Switch.objects.create(key='disabled:global', status=GLOBAL)
+        Switch.objects.create(key='global:selective', status=SELECTIVE)
+
+        self.gargoyle['selective'].add_condition(
+            condition_set=condition_set,
+            field_name='username',
+            condition='foo',
+        )
+        self.gargoyle['global:selective'].add_condition(
+            condition_set=condition_set,
+            field_name='percent',
+            condition='0-50',
+        )
+        self.gargoyle['global:selective'].add_condition(
+            condition_set='gargoyle.builtins.IPAddressConditionSet',
+            field_name='ip_address',
+            condition='192.168.1.1',
+        )
+
+        self.keys = ['global', 'disabled', 'selective', 'selective:inherit', 'disabled:global',
+                     'global:selective', 'missing', 'selective:missing']
+
+    def test_matches_is_active(self):
+        users = [User(pk=5, username='foo'), User(pk=8771, username='bar'), AnonymousUser()]
+        for user in users:
+            request = self.gargoyle.as_request(user=user, ip_address='192.168.1.1')
+            for instances in [(), (user,), (request,)]:
+                results = self.gargoyle.is_active_many(self.keys, *instances)
+                self.assertEquals(sorted(results), sorted(self.keys))
+                for key in self.keys:
+                    self.assertEquals(results[key], self.gargoyle.is_active(key, *instances), key)
+
+    def test_default(self):
+        results = self.gargoyle.is_active_many(['missing', 'selective:inherit'], default=True)
+        self.assertEquals(results, {'missing': True, 'selective:inherit': False})
+
+    def test_active_switches(self):
+        results = self.gargoyle.active_switches(User(pk=5, username='foo'))
+        self.assertEquals(results, {
+            'global': True,
+            'disabled': False,
+            'selective': True,
+            'selective:inherit': True,
+            'disabled:global': False,
+            'global:selective': True,
+        })
+
+    def test_switches_override(self):
+        with switches(self.gargoyle, disabled=True):
+            results = self.gargoyle.is_active_many(['disabled', 'disabled:global'])
+            self.assertEquals(results, {'disabled': True, 'disabled:global': True})
+
+            with switches(self.gargoyle, selective=True):
+                self.assertTrue(self.gargoyle.is_active('disabled'))
+                self.assertTrue(self.gargoyle.is_active('selective'))
+
+            self.assertFalse(self.gargoyle.is_active('selective'))
+
+        self.assertFalse(self.gargoyle.is_active('disabled:global'))
+
+
+class SwitchTreeTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=False)
+        self.gargoyle.register(UserConditionSet(User))
+
+        Switch.objects.create(key='a', status=GLOBAL)
+        Switch.objects.create(key='a:b:c', status=INHERIT)
+        Switch.objects.create(key='a:b:c:d', status=SELECTIVE)
+        Switch.objects.create(key='x', status=DISABLED)
+        Switch.objects.create(key='x:y', status=GLOBAL)
+
+    def test_nodes(self):
+        tree = self.gargoyle.get_tree()
+
+        self.assertEquals(sorted(tree.nodes), ['a', 'a:b', 'a:b:c', 'a:b:c:d', 'x', 'x:y'])
+        self.assertTrue(tree.get('a:b').switch is None)
+        self.assertTrue(tree.get('a:b:c').parent is tree.get('a:b'))
+        self.assertEquals(tree.get('missing'), None)
+
+        self.assertEquals(tree.get('a:b:c').result, True)
+        # selective without conditions inherits its parent
+        self.assertEquals(tree.get('a:b:c:d').result, True)
+        self.assertEquals(tree.get('x:y').result, False)
+
+    def test_built_once(self):
+        tree = self.gargoyle.get_tree()
+        self.assertTrue(tree is self.gargoyle.get_tree())
+
+        Switch.objects.create(key='new', status=GLOBAL)
+        self.assertFalse(tree is self.gargoyle.get_tree())
+        self.assertTrue('new' in self.gargoyle.get_tree().nodes)
+
+    def test_request_snapshots(self):
+        self.gargoyle.enable_request_cache()
+        self.assertTrue(self.gargoyle.is_active('a:b:c'))
+        old_tree = self.gargoyle.get_tree()
+
+        # another thread starts a request after a reload
+        Switch.objects.filter(key='a').update(status=DISABLED)
+        self.gargoyle._populate(reset=True)
+        thread_trees = []
+
+        def check():
+            self.gargoyle.enable_request_cache()
+            self.assertFalse(self.gargoyle.is_active('a:b:c'))
+            thread_trees.append(self.gargoyle.get_tree())
+            self.gargoyle.disable_request_cache()
+
+        thread = threading.Thread(target=check)
+        thread.start()
+        thread.join()
+
+        # each snapshot keeps its own tree
+        self.assertTrue(self.gargoyle.is_active('a:b:c'))
+        tree = self.gargoyle.get_tree()
+        self.assertTrue(tree.switches is old_tree.switches)
+        self.assertTrue(self.gargoyle.get_tree() is tree)
+        self.assertTrue(self.gargoyle._tree is thread_trees[0])
+        self.gargoyle.disable_request_cache()
+        self.assertTrue(self.gargoyle.get_tree() is thread_trees[0])
+
+    def test_static_results(self):
+        self.assertTrue(self.gargoyle.is_active('a:b:c'))
+        self.assertFalse(self.gargoyle.is_active('x:y'))
+        self.assertTrue(self.gargoyle.is_active('a:b'))
+        self.assertTrue(self.gargoyle.is_active('missing', default=True))
+
+        Switch.objects.create(key='inherit', status=INHERIT)
+        self.assertTrue(self.gargoyle.is_active('inherit', default=True))
+        self.assertFalse(self.gargoyle.is_active('inherit'))
+
+    def test_missing_parent(self):
+        gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        Switch.objects.create(key='p:q', status=GLOBAL)
+        Switch.objects.create(key='p:q:r', status=GLOBAL)
+
+        tree = gargoyle.get_tree()
+        self.assertEquals(tree.get('p'), None)
+        self.assertEquals(tree.get('p:q:r'), None)
+
+        # the missing parent is created, disabled
+        self.assertFalse(gargoyle.is_active('p:q'))
+        self.assertEquals(Switch.objects.get(key='p').status, DISABLED)
+        self.assertFalse(gargoyle.is_active('p:q:r'))
+        self.assertEquals(gargoyle.get_tree().get('p:q:r').result, False)
+
+        self.assertFalse(gargoyle.is_active('created'))
+        self.assertTrue(Switch.objects.filter(key='created').exists())
+
+        # missing ancestors below a disabled switch are never looked up
+        Switch.objects.create(key='p:x:y', status=GLOBAL)
+        self.assertEquals(gargoyle.get_tree().get('p:x:y').result, False)
+        self.assertFalse(gargoyle.is_active('p:x:y'))
+        self.assertFalse(Switch.objects.filter(key='p:x').exists())
+
+    def test_proxy(self):
+        switch = self.gargoyle['a']
+        self.assertRaises(AttributeError, object.__getattribute__, switch, '__dict__')
+        self.assertEquals(switch.key, 'a')
+        self.assertEquals(switch.status, GLOBAL)
+
+        switch.label = 'A'
+        self.assertEquals(switch._switch.label, 'A')
+
+    def test_modified_through_proxy(self):
+        switch = self.gargoyle['a:b:c:d']
+        switch.add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='foo',
+            commit=False,
+        )
+
+        self.assertTrue(self.gargoyle.get_tree().get('a:b:c:d').result is CONDITIONAL)
+        self.assertTrue(self.gargoyle.is_active('a:b:c:d', User(username='foo')))
+        self.assertFalse(self.gargoyle.is_active('a:b:c:d', User(username='bar')))
+
+        self.gargoyle['a'].status = DISABLED
+        self.assertEquals(self.gargoyle.get_tree().get('a:b:c:d').result, False)
+        self.assertFalse(self.gargoyle.is_active('a:b:c:d', User(username='foo')))
+
+
+class LocalSnapshotTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True,
+                                      snapshot_timeout=1000)
+        Switch.objects.create(key='test', status=DISABLED)
+
+    def update_elsewhere(self, status):
+        # simulates another process saving the switch
+        switch = Switch(key='test', status=status)
+        cache.set(self.gargoyle.cache_key, {'test': switch})
+        cache.set(self.gargoyle.last_updated_cache_key, int(time.time()) + 1)
+
+    def test_bounded_staleness(self):
+        self.assertFalse(self.gargoyle.is_active('test'))
+
+        self.update_elsewhere(GLOBAL)
+        self.gargoyle._cleanup()
+
+        # the snapshot is still fresh
+        self.assertFalse(self.gargoyle.is_active('test'))
+
+        self.gargoyle._snapshot_expires = 0
+        self.assertTrue(self.gargoyle.is_active('test'))
+        self.assertTrue(self.gargoyle._snapshot_expires > time.time())
+
+    def test_per_request(self):
+        self.gargoyle.snapshot_per_request = True
+        self.assertFalse(self.gargoyle.is_active('test'))
+
+        self.update_elsewhere(GLOBAL)
+        self.assertFalse(self.gargoyle.is_active('test'))
+
+        self.gargoyle._cleanup()
+        self.assertTrue(self.gargoyle.is_active('test'))
+
+    def test_local_save(self):
+        self.assertFalse(self.gargoyle.is_active('test'))
+
+        switch = self.gargoyle['test']
+        switch.status = GLOBAL
+        switch.save()
+
+        self.assertTrue(self.gargoyle.is_active('test'))
+
+
+class ChangeLogTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=False)
+        # The manager stands for another process, which doesn't see saves
+        post_save.disconnect(self.gargoyle._post_save, sender=Switch)
+        post_delete.disconnect(self.gargoyle._post_delete, sender=Switch)
+        # every manager still alive in the test run logs each save, and the
+        # log mustn't be culled by the local memory cache
+        self.gargoyle.max_changes = 10000
+        cache.clear()
+        Switch.objects.create(key='test', status=DISABLED)
+        Switch.objects.create(key='other', status=GLOBAL)
+        self.assertFalse(self.gargoyle.is_active('test'))
+        self.gargoyle.enable_stats()
+
+    def refresh(self):
+        self.gargoyle._cleanup()
+        self.gargoyle._populate()
+        return self.gargoyle.stats()['store']
+
+    def test_unchanged(self):
+        store = self.refresh()
+        self.assertEquals(store['version_checks'], 1)
+        self.assertEquals((store['cache_fetches'], store['change_refreshes']), (0, 0))
+
+    def test_save(self):
+        other = self.gargoyle._cache['other']
+        switch = Switch.objects.get(key='test')
+        switch.status = GLOBAL
+        switch.save()
+
+        patched = []
+
+        def callback(sender, **kwargs):
+            patched.append(kwargs['keys'])
+
+        switches_patched.connect(callback, sender=self.gargoyle)
+        try:
+            store = self.refresh()
+        finally:
+            switches_patched.disconnect(callback, sender=self.gargoyle)
+
+        self.assertEquals(patched, [set(['test'])])
+        self.assertEquals((store['change_refreshes'], store['changed_switches']), (1, 1))
+        self.assertEquals((store['cache_fetches'], store['database_reloads']), (0, 0))
+        self.assertTrue(self.gargoyle.is_active('test'))
+        self.assertTrue(self.gargoyle._cache['other'] is other)
+
+        # The change is only applied once
+        store = self.refresh()
+        self.assertEquals(store['change_refreshes'], 1)
+
+    def test_transaction(self):
+        with transaction.commit_on_success():
+            switch = Switch.objects.get(key='test')
+            switch.status = GLOBAL
+            switch.save()
+
+            # the change is taken from the log, not from the database, where
+            # other processes can't see it until it is committed
+            self.assertNumQueries(0, self.refresh)
+            self.assertEquals(self.gargoyle.stats()['store']['change_refreshes'], 1)
+            self.assertTrue(self.gargoyle.is_active('test'))
+
+    def test_delete(self):
+        Switch.objects.get(key='other').delete()
+        self.refresh()
+        self.assertFalse('other' in self.gargoyle._cache)
+        self.assertFalse(self.gargoyle.is_active('other'))
+
+    def test_evicted(self):
+        Switch.objects.filter(key='test').update(status=GLOBAL)
+        Switch.objects.get(key='other').save()
+        version = cache.get(self.gargoyle.version_cache_key)
+        cache.delete(self.gargoyle._get_change_key(version))
+
+        store = self.refresh()
+        self.assertEquals((store['change_refreshes'], store['cache_fetches']), (0, 1))
+        # The shared cache was written after the update
+        self.assertTrue(self.gargoyle.is_active('test'))
+
+    def test_too_many_changes(self):
+        self.gargoyle.max_changes = 0
+        Switch.objects.get(key='other').save()
+
+        store = self.refresh()
+        self.assertEquals((store['change_refreshes'], store['cache_fetches']), (0, 1))
+
+    def test_unlogged(self):
+        # Written by a process which doesn't keep the change log
+        cache.set(self.gargoyle.cache_key, {'test': Switch(key='test', status=GLOBAL)})
+        cache.set(self.gargoyle.last_updated_cache_key, int(time.time()) + 1)
+
+        store = self.refresh()
+        self.assertEquals(store['cache_fetches'], 1)
+        self.assertTrue(self.gargoyle.is_active('test'))
+
+
+class NetworksTest(TestCase):
+    def test_parse(self):
+        self.assertEquals(parse_address('10.0.0.1'), (32, 0x0a000001))
+        self.assertEquals(parse_network('10.1.2.3/8'), (32, 8, 0x0a000000))
+        self.assertEquals(parse_network('10.1.2.3'), (32, 32, 0x0a010203))
+        for value in ('10.0.0', '10.0.0.256', 'foo', '10.0.0.0/33', '10.0.0.0/x', None):
+            self.assertRaises(ValueError, parse_network, value)
+
+    def test_parse_ipv6(self):
+        self.assertEquals(parse_address('::1'), (128, 1))
+        self.assertEquals(parse_address('2001:db8::8:800:200c:417a'), (128, 0x20010db80000000000080800200c417a))
+        self.assertEquals(parse_address('fe80::1%eth0'), (128, 0xfe800000000000000000000000000001))
+        self.assertEquals(parse_address('::ffff:10.0.0.1'), (32, 0x0a000001))
+        self.assertEquals(parse_network('2001:db8::1/32'), (128, 32, 0x20010db8 << 96))
+        self.assertEquals(parse_network('::ffff:10.1.2.3/104'), (32, 8, 0x0a000000))
+        for value in ('1::2::3', '1:2:3:4:5:6:7', '1:2:3:4:5:6:7:8:9', '12345::', '::g', '::/129'):
+            self.assertRaises(ValueError, parse_network, value)
+
+    def test_format(self):
+        self.assertEquals(format_network(parse_network('2001:0db8:0:0:1:0:0:1')), '2001:db8::1:0:0:1')
+        self.assertEquals(format_network(parse_network('2001:db8:1::/48')), '2001:db8:1::/48')
+        self.assertEquals(format_network(parse_network('::')), '::')
+        self.assertEquals(format_network(parse_network('1:0:2:3:4:5:6:7')), '1:0:2:3:4:5:6:7')
+
+    def test_network_set(self):
+        networks = NetworkSet(['10.0.0.0/8', '192.168.1.1', '172.16.0.0/12'])
+        self.assertEquals(len(networks), 3)
+        self.assertTrue(parse_address('10.20.30.40') in networks)
+        self.assertTrue(parse_address('192.168.1.1') in networks)
+        self.assertTrue(parse_address('172.31.255.255') in networks)
+        self.assertFalse(parse_address('172.32.0.0') in networks)
+        self.assertFalse(parse_address('192.168.1.2') in networks)
+
+    def test_clean(self):
+        field = IPAddress()
+        self.assertEquals(field.clean('10.1.2.3/8'), '10.0.0.0/8')
+        self.assertEquals(field.clean('10.1.2.3'), '10.1.2.3')
+        self.assertRaises(ValidationError, field.clean, '10.1.2')